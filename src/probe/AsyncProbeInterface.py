@@ -0,0 +1,685 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import asyncio
+import contextlib
+import collections
+
+import ProbeCommon as pc
+import ProbeInterface as pi
+
+#
+# Encoded commands for each byte of the multi-byte registers.
+#
+GPI_RD_CMDS = tuple(c.code for c in pc.RDGPI)
+GPO_RD_CMDS = tuple(c.code for c in pc.RDGPO)
+GPO_WR_CMDS = tuple(c.code for c in pc.WRGPO)
+AXA_RD_CMDS = tuple(c.code for c in pc.RDAXA)
+AXA_WR_CMDS = tuple(c.code for c in pc.WRAXA)
+AXIRB_CMDS  = tuple(c.code for c in pc.AXIRB)
+AXIWB_CMDS  = tuple(c.code for c in pc.AXIWB)
+
+class AsyncProbeInterface(object):
+    """
+    Asyncio version of the probe interface. The port is driven through a
+    non-blocking file descriptor registered with the event loop, so any
+    number of probes can be served from one thread.
+
+    Every call sends its commands as a single contiguous frame and queues
+    the number of response bytes it expects. Responses come back in the
+    order the commands were sent, so they are matched to waiting callers
+    in FIFO order, and many calls may be outstanding on the link at once.
+    If a caller times out or is cancelled while its response is still on
+    the way, the bytes still to come can no longer be matched up, so every
+    other caller waiting for a response gets an IOError, and the next call
+    first waits for the link to go quiet and throws away what arrived.
+    Sequences built from several calls (e.g. setAXIAddress followed by
+    doRead) should be run under guard() if other tasks share the probe.
+    Helpers which need several frames, such as doRead(wait=True) and the
+    block transfers, do so themselves. The block transfers use the frames
+    of ProbeInterface and check every transaction completed in the same
+    way, so their results can be trusted just as far.
+    """
+
+    def __init__(self, window=64, timeout=None):
+        """
+        Create the interface. At most window frames which expect a response
+        are allowed to be in flight at once. timeout is the number of
+        seconds to wait for a response, or None to wait forever. Set the
+        tracer attribute to a ProbeTrace tracer to record the link.
+        """
+        self.port    = None
+        self.fd      = None
+        self.loop    = None
+        self.baud    = None
+        self.timeout = timeout
+        self.window  = asyncio.Semaphore(window)
+        self.lock    = asyncio.Lock()
+        self.pending = collections.deque()
+        self.txbuf   = bytearray()
+        self.writing = False
+        self.resync  = None
+        self.rxcount = 0
+        self.owner   = None
+        self.tracer  = None
+
+        # Completion polling (see waitRead/waitWrite), as for
+        # ProbeInterface.
+        self.waitTimeout = 1.0
+        self.pollMin     = 0.0001
+        self.pollMax     = 0.01
+
+    async def open(self, portname, baud = 9600):
+        """
+        Open the serial port (or pty) with the supplied name. Opening a
+        port can block for a while, so it is done on the loop's executor.
+        """
+        import serial
+        loop      = asyncio.get_running_loop()
+        self.baud = baud
+        self.port = await loop.run_in_executor(None, lambda: serial.Serial(
+            portname, baudrate=baud, timeout=0, bytesize=serial.EIGHTBITS,
+            xonxoff=False))
+        self.openFd(self.port.fileno())
+
+    def openFd(self, fd):
+        """
+        Use an already open file descriptor, such as one end of a pty pair,
+        as the link to the probe. Must be called from a running event loop.
+        """
+        os.set_blocking(fd, False)
+        self.fd   = fd
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(self.fd, self.__onReadable__)
+
+    def connected(self):
+        """
+        Have we successfully opened a connection to the probe?
+        """
+        return self.fd != None
+
+    def close(self):
+        """
+        Stop using the link. Any callers still waiting for a response get
+        a ConnectionError.
+        """
+        if(self.fd == None):
+            return
+        if(self.resync != None):
+            self.resync.cancel()
+            self.resync = None
+        self.loop.remove_reader(self.fd)
+        if(self.writing):
+            self.loop.remove_writer(self.fd)
+            self.writing = False
+        if(self.port != None):
+            self.port.close()
+            self.port = None
+        self.fd = None
+        self.__failPending__(ConnectionError("Probe link closed"))
+
+    # -----------------------------------------------------------------------
+    # Transport
+    # -----------------------------------------------------------------------
+
+    async def transact(self, frame, nrsp = 0):
+        """
+        Send the bytes in frame to the probe and return the nrsp bytes it
+        sends back in response. Waits for any other task running a guarded
+        sequence to finish before sending.
+        """
+        return await self.__receive__(await self.__send__(frame, nrsp))
+
+    async def __send__(self, frame, nrsp):
+        """
+        Send frame, and return the entry its nrsp response bytes will be
+        collected in for __receive__, or None if there are none. Several
+        frames may be sent before their responses are waited for.
+        """
+        async with self.guard():
+            if(self.resync != None):
+                await asyncio.shield(self.resync)
+            if(nrsp == 0):
+                self.__transmit__(frame)
+                return None
+            await self.window.acquire()
+            entry = [self.loop.create_future(), nrsp, bytearray()]
+            self.pending.append(entry)
+            self.__transmit__(frame)
+            return entry
+
+    async def __receive__(self, entry):
+        """
+        Wait for and return the response bytes collected in entry.
+        """
+        if(entry == None):
+            return b""
+        try:
+            return await asyncio.wait_for(entry[0], self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if(any(e is entry for e in self.pending)):
+                self.__lostSync__()
+            raise
+
+    @contextlib.asynccontextmanager
+    async def guard(self):
+        """
+        Hold the lock for a sequence of calls which other tasks must not
+        come between, as in:
+
+            async with probe.guard():
+                await probe.setAXIAddress(addr)
+                await probe.doRead()
+
+        Calls from other tasks wait until the sequence is done before
+        sending anything. Guards may be nested within one task. Tasks which
+        the guarded task starts and waits for (e.g. with asyncio.gather)
+        are other tasks, so must not send anything to the probe.
+        """
+        task = asyncio.current_task()
+        if(self.owner is task):
+            yield
+            return
+        async with self.lock:
+            self.owner = task
+            try:
+                yield
+            finally:
+                self.owner = None
+
+    def __lostSync__(self):
+        """
+        Called when a caller stops waiting for a response which has not
+        all arrived. Fails every other caller waiting for a response, and
+        starts throwing away whatever is still on its way back.
+        """
+        self.__failPending__(IOError("Lost sync with the probe, as a "
+            "request was abandoned part way through its response"))
+        if(self.resync == None):
+            self.resync = self.loop.create_task(self.__drain__())
+
+    async def __drain__(self):
+        """
+        Wait until nothing has arrived for long enough that no more
+        responses can be on their way. Anything arriving meanwhile finds no
+        caller waiting for it, so is thrown away.
+        """
+        quiet = 0.05 + (64 * 10.0 / self.baud if self.baud else 0)
+        while(True):
+            last = self.rxcount
+            await asyncio.sleep(quiet)
+            if(self.rxcount == last and len(self.txbuf) == 0):
+                break
+        self.resync = None
+
+    def __transmit__(self, frame):
+        """
+        Queue bytes to be written to the port, and write as many of them
+        as possible straight away.
+        """
+        if(self.tracer != None):
+            self.tracer.tx(frame)
+        self.txbuf += frame
+        if(not self.writing):
+            self.__onWritable__()
+
+    def __onWritable__(self):
+        """
+        Write queued bytes. Registers for a writable callback while the
+        port cannot take everything we have.
+        """
+        try:
+            n = os.write(self.fd, self.txbuf)
+        except BlockingIOError:
+            n = 0
+        del self.txbuf[:n]
+
+        if(len(self.txbuf) > 0 and not self.writing):
+            self.loop.add_writer(self.fd, self.__onWritable__)
+            self.writing = True
+        elif(len(self.txbuf) == 0 and self.writing):
+            self.loop.remove_writer(self.fd)
+            self.writing = False
+
+    def __onReadable__(self):
+        """
+        Hand newly arrived response bytes out to the oldest waiting
+        callers.
+        """
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close()
+            return
+        if(self.tracer != None):
+            self.tracer.rx(data)
+        self.rxcount += len(data)
+
+        view = memoryview(data)
+        while(len(view) > 0 and len(self.pending) > 0):
+            entry = self.pending[0]
+            fut, need, buf = entry
+            take = need - len(buf)
+            buf += view[:take]
+            view = view[take:]
+            if(len(buf) == need):
+                self.pending.popleft()
+                self.window.release()
+                if(not fut.done()):
+                    fut.set_result(bytes(buf))
+
+    def __failPending__(self, exc):
+        """
+        Fail every caller still waiting for a response.
+        """
+        while(len(self.pending) > 0):
+            fut = self.pending.popleft()[0]
+            self.window.release()
+            if(not fut.done()):
+                fut.set_exception(exc)
+                # Frames sent ahead by a caller which has already failed
+                # on an earlier one are never waited for, so asyncio must
+                # not complain that their exceptions went unseen.
+                fut.exception()
+
+    # -----------------------------------------------------------------------
+    # Register primitives
+    # -----------------------------------------------------------------------
+
+    async def readRegister(self, cmd):
+        """
+        Issue a single read command, e.g. pc.PROBE_CMD_RDGPI0, and return
+        the byte sent back.
+        """
+        return await self.transact(cmd, 1)
+
+    async def writeRegister(self, cmd, value):
+        """
+        Issue a single write command, e.g. pc.PROBE_CMD_WRGPO0, with a one
+        byte operand.
+        """
+        assert(len(value) == 1)
+        await self.transact(cmd + value)
+
+    async def getGPIByte(self, idx):
+        """
+        Return the gpi byte addressed by idx.
+        """
+        return await self.readRegister(GPI_RD_CMDS[idx])
+
+    async def getGPOByte(self, idx):
+        """
+        Return the gpo byte addressed by idx.
+        """
+        return await self.readRegister(GPO_RD_CMDS[idx])
+
+    async def setGPOByte(self, idx, val):
+        """
+        Set the gpo byte addressed by idx.
+        """
+        await self.writeRegister(GPO_WR_CMDS[idx], val)
+
+    # -----------------------------------------------------------------------
+    # AXI helpers
+    # -----------------------------------------------------------------------
+
+    async def getAXIAddress(self):
+        """
+        Return the 32-bit AXI address
+        """
+        rsp = await self.transact(b"".join(AXA_RD_CMDS), 4)
+        return int.from_bytes(rsp, byteorder="little")
+
+    async def setAXIAddress(self, value):
+        """
+        Set the address of the AXI bus.
+        """
+        await self.transact(self.__wordFrame__(AXA_WR_CMDS, value))
+
+    async def getAXIReadData(self):
+        """
+        Return the most recently read value from the AXI bus.
+        """
+        rsp = await self.transact(b"".join(AXIRB_CMDS), 4)
+        return int.from_bytes(rsp, byteorder="little")
+
+    async def setAXIWriteData(self, value):
+        """
+        Set the data to be written on the AXI master bus.
+        """
+        await self.transact(self.__wordFrame__(AXIWB_CMDS, value))
+
+    async def doRead(self, autoInc = None, wait = False, timeout = None):
+        """
+        Perform a single read transaction at the current address. If autoInc
+        is None the current auto-increment setting is kept. If wait is set,
+        wait for it to complete and return the read data and AXI response
+        code, as waitRead does.
+        """
+        async with self.guard():
+            csr = await self.__goCSR__(autoInc)
+            if(not wait):
+                await self.transact(pc.PROBE_CMD_AXIWRRC + csr)
+                return None
+            # Read the control register before setting go, so that a stale
+            # rv bit left by an earlier transaction is cleared.
+            await self.transact(pc.PROBE_CMD_AXIRDRC + pc.PROBE_CMD_AXIWRRC +
+                csr, 1)
+            return await self.waitRead(timeout)
+
+    async def doWrite(self, autoInc = None, wait = False, timeout = None):
+        """
+        Perform a single write transaction at the current address. If
+        autoInc is None the current auto-increment setting is kept. If wait
+        is set, wait for it to complete and return the AXI response code,
+        as waitWrite does.
+        """
+        async with self.guard():
+            csr = await self.__goCSR__(autoInc)
+            if(not wait):
+                await self.transact(pc.PROBE_CMD_AXIWRWC + csr)
+                return None
+            await self.transact(pc.PROBE_CMD_AXIRDWC + pc.PROBE_CMD_AXIWRWC +
+                csr, 1)
+            return await self.waitWrite(timeout)
+
+    async def waitRead(self, timeout = None):
+        """
+        Wait for the read transaction started by doRead to complete, and
+        return the read data and the AXI response code (one of
+        pc.AXI_RESP_*). As for ProbeInterface.waitRead, the rv bit must
+        have been clear when the read was started. Raises TimeoutError if
+        the read has not completed within timeout seconds (waitTimeout by
+        default).
+        """
+        frame = pc.PROBE_CMD_AXIRDRC + b"".join(AXIRB_CMDS)
+        rsp   = await self.__poll__(frame, 5, pc.AXI_CTRL_RV, timeout, "read")
+        return int.from_bytes(rsp[1:5], byteorder="little"), rsp[0] >> 6
+
+    async def waitWrite(self, timeout = None):
+        """
+        Wait for the write transaction started by doWrite to complete, and
+        return the AXI response code. The same caveat about stale status
+        bits applies as for waitRead.
+        """
+        rsp = await self.__poll__(pc.PROBE_CMD_AXIRDWC, 1, pc.AXI_CTRL_WV,
+            timeout, "write")
+        return rsp[0] >> 6
+
+    async def __poll__(self, frame, nrsp, mask, timeout, what):
+        """
+        Send frame, which starts with a read of a control register, until
+        one of the bits in mask is set in it, and return the response. The
+        gap between polls doubles from pollMin up to pollMax.
+        """
+        if(timeout == None):
+            timeout = self.waitTimeout
+        deadline = time.monotonic() + timeout
+        delay    = self.pollMin
+        async with self.guard():
+            while(True):
+                rsp = await self.transact(frame, nrsp)
+                if(rsp[0] & mask):
+                    return rsp
+                now = time.monotonic()
+                if(now >= deadline):
+                    raise TimeoutError("AXI %s did not complete within %gs"
+                        % (what, timeout))
+                await asyncio.sleep(min(delay, deadline - now))
+                delay = min(2 * delay, self.pollMax)
+
+    async def setAutoIncrement(self, ae):
+        """
+        Set the auto increment value for addresses when we do reads/writes
+        """
+        csr = bytes([pc.AXI_CTRL_AE if ae else 0])
+        await self.transact(pc.PROBE_CMD_AXIWRRC + csr)
+
+    async def readWord(self, addr):
+        """
+        Read the word at addr, as one frame, checked as readBlock does.
+        """
+        data = await self.readBlock(addr, 1)
+        return int.from_bytes(data, byteorder="little")
+
+    async def writeWord(self, addr, value):
+        """
+        Write value to the word at addr, as one frame, checked as
+        writeBlock does.
+        """
+        await self.writeBlock(addr, value.to_bytes(4, byteorder="little"))
+
+    async def readBlock(self, addr, nwords, chunk=pc.BLOCK_WORDS):
+        """
+        Read nwords consecutive words starting at addr and return them as
+        little-endian bytes. Every chunk is one frame built by
+        ProbeInterface.readFrame, which sets its own start address, so all
+        chunks can be in flight at once. As for the synchronous interface,
+        words whose reads were not seen to complete in time are read again
+        one at a time, once the others have arrived.
+        """
+        data = bytearray()
+        good = []
+        async with self.guard():
+            reqs = []
+            for start in range(0, nwords, chunk):
+                count = min(chunk, nwords - start)
+                frame = self.__wordFrame__(AXA_WR_CMDS, addr + 4 * start) + \
+                        pi.readFrame(count)
+                reqs.append(await self.__send__(frame,
+                    1 + pi.READ_WORD_RSP * count))
+            idle = True
+            for req in reqs:
+                part, ok, idle = pi.unpackReads(await self.__receive__(req),
+                    idle)
+                data += part
+                good += ok
+            if(not all(good)):
+                end = (addr + 4 * nwords) & 0xFFFFFFFF
+                await self.__settle__(pc.PROBE_CMD_AXIRDRC, pc.AXI_CTRL_RV,
+                    await self.__settleRun__(end, idle), "read")
+                for i in range(0, nwords):
+                    if(not good[i]):
+                        await self.setAXIAddress((addr + 4 * i) & 0xFFFFFFFF)
+                        value, resp = await self.doRead(1, wait=True)
+                        data[4*i:4*i+4] = value.to_bytes(4, "little")
+                await self.setAXIAddress(end)
+        return bytes(data)
+
+    async def writeBlock(self, addr, data, chunk=pc.BLOCK_WORDS):
+        """
+        Write the little-endian words in data to consecutive addresses
+        starting at addr. A trailing partial word is padded with zeros.
+        Every chunk is one frame built by ProbeInterface.writeFrame, and as
+        for readBlock, words whose writes were not seen to complete in time
+        are written again one at a time.
+        """
+        data = bytes(data)
+        if(len(data) % 4 != 0):
+            data += bytes(4 - len(data) % 4)
+        nwords = len(data) // 4
+        good   = []
+        async with self.guard():
+            reqs = []
+            for start in range(0, nwords, chunk):
+                count = min(chunk, nwords - start)
+                frame = self.__wordFrame__(AXA_WR_CMDS, addr + 4 * start) + \
+                        pi.fillWriteFrame(bytearray(pi.writeFrame(count)),
+                            data[4*start:4*(start+count)])
+                reqs.append(await self.__send__(frame, 1 + count))
+            idle = True
+            for req in reqs:
+                ok, idle = pi.unpackWrites(await self.__receive__(req), idle)
+                good += ok
+            if(not all(good)):
+                end = (addr + 4 * nwords) & 0xFFFFFFFF
+                await self.__settle__(pc.PROBE_CMD_AXIRDWC, pc.AXI_CTRL_WV,
+                    await self.__settleRun__(end, idle), "write")
+                for i in range(0, nwords):
+                    if(not good[i]):
+                        await self.setAXIAddress((addr + 4 * i) & 0xFFFFFFFF)
+                        await self.setAXIWriteData(int.from_bytes(
+                            data[4*i:4*i+4], "little"))
+                        await self.doWrite(1, wait=True)
+                await self.setAXIAddress(end)
+
+    async def __settleRun__(self, end, idle):
+        """
+        Tell, where unpackReads or unpackWrites could not (idle is None),
+        whether the channel is idle after a run of transactions ending just
+        before end, as ProbeInterface.__settleRun__ does.
+        """
+        if(idle != None):
+            return idle
+        return True if await self.getAXIAddress() == end else None
+
+    async def __settle__(self, frame, mask, idle, what):
+        """
+        Wait for a transaction still outstanding, unless idle, by reading
+        the control register with frame until mask is set in it, as
+        ProbeInterface.settleAXI does.
+        """
+        if(idle == True):
+            return
+        try:
+            await self.__poll__(frame, 1, mask, None, what)
+        except TimeoutError:
+            if(idle == False):
+                raise
+
+    async def __goCSR__(self, autoInc):
+        """
+        Return the control register value which starts a transaction with
+        the given auto-increment setting, reading it if autoInc is None.
+        """
+        if(autoInc == None):
+            csr     = await self.readRegister(pc.PROBE_CMD_AXIRDRC)
+            autoInc = csr[0] & pc.AXI_CTRL_AE
+        return bytes([pc.AXI_CTRL_GO | (pc.AXI_CTRL_AE if autoInc else 0)])
+
+    def __wordFrame__(self, cmds, value):
+        """
+        Encode the four byte-wise write commands in cmds which set a 32-bit
+        register to value.
+        """
+        frame = bytearray()
+        for cmd, b in zip(cmds, value.to_bytes(4, byteorder="little")):
+            frame += cmd
+            frame.append(b)
+        return bytes(frame)
+
+
+async def selfTest(baud):
+    """
+    Run the interface against a simulated probe served on a pty, and
+    return a list of what went wrong.
+    """
+    import random
+    from ProbeSim import ProbeModel, ProbeSimServer
+
+    model     = ProbeModel()
+    model.gpi = 0x44332211
+    model.errors.append((0x8000, 0x8FFF, pc.AXI_RESP_SLVERR))
+    server    = ProbeSimServer(model, baud)
+    server.start()
+    # Long enough to wait behind every byte the checks send at once.
+    timeout   = 1.0 + 20000 * 10.0 / baud
+    probe     = AsyncProbeInterface(timeout=timeout)
+    failed    = []
+    def check(ok, what):
+        if(not ok):
+            failed.append(what)
+
+    try:
+        await probe.open(server.portname, baud)
+        await probe.setAXIAddress(0x12345678)
+        check(await probe.getAXIAddress() == 0x12345678, "address")
+
+        # Bulk transfers, with other callers' requests in between.
+        data = random.Random(1).randbytes(4 * 1000)
+        await probe.writeBlock(0x1000, data)
+        got  = await asyncio.gather(probe.readBlock(0x1000, 1000, chunk=50),
+            probe.getGPIByte(1), probe.readWord(0x1004))
+        check(got[0] == data, "readBlock")
+        check(got[1] == b"\x22", "GPI byte")
+        check(got[2] == int.from_bytes(data[4:8], "little"), "readWord")
+
+        # Single transactions to a slow peripheral, and an error response.
+        model.latency = 0.005
+        await probe.setAXIAddress(0x2000)
+        await probe.setAXIWriteData(0xCAFEF00D)
+        check(await probe.doWrite(True, wait=True) == pc.AXI_RESP_OKAY,
+            "doWrite")
+        await probe.setAXIAddress(0x2000)
+        check(await probe.doRead(wait=True) == (0xCAFEF00D,
+            pc.AXI_RESP_OKAY), "doRead")
+        await probe.writeBlock(0x3000, data[:64])
+        check(await probe.readBlock(0x3000, 16, chunk=5) == data[:64],
+            "slow block transfers")
+        check(await probe.readWord(0x3004) == int.from_bytes(data[4:8],
+            "little"), "slow readWord")
+        await probe.setAXIAddress(0x8000)
+        check((await probe.doRead(wait=True))[1] == pc.AXI_RESP_SLVERR,
+            "doRead error response")
+
+        # Guarded sequences from two tasks, which would read each other's
+        # words if they were interleaved.
+        async def seq(addr):
+            async with probe.guard():
+                await probe.setAXIAddress(addr)
+                return await probe.doRead(wait=True)
+        got  = await asyncio.gather(seq(0x1000), seq(0x1004))
+        check([g[0] for g in got] == [int.from_bytes(data[i:i+4], "little")
+            for i in (0, 4)], "guard")
+        model.latency = 0.0
+
+        # A request which times out, and one which is cancelled, must not
+        # leave later responses out of step.
+        # Give up half way through the 5000 response bytes.
+        probe.timeout = 5000 * 10.0 / baud / 2
+        try:
+            await probe.readBlock(0x1000, 1000, chunk=1000)
+            check(False, "timeout")
+        except TimeoutError:
+            pass
+        probe.timeout = timeout
+        check(await probe.getGPIByte(3) == b"\x44", "resync after timeout")
+        task = asyncio.ensure_future(probe.readBlock(0x1000, 1000))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        check(await probe.getGPIByte(2) == b"\x33", "resync after cancel")
+    finally:
+        probe.close()
+        server.stop()
+    return failed
+
+
+def main():
+    """
+    Check the interface against a simulated probe on a pty.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--baud","-b", type=int, default=115200,
+        help="Emulate the timing of a UART running at this baud rate.")
+    args = parser.parse_args()
+
+    failed = asyncio.run(selfTest(args.baud))
+    for what in failed:
+        print("[ERROR] %s check failed" % what)
+    if(len(failed) > 0):
+        return 1
+    print("All checks passed")
+    return 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())
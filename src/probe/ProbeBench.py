@@ -0,0 +1,302 @@
+#!/usr/bin/python3
+
+"""
+Throughput and latency benchmarks for the probe host software, run against
+a simulated probe.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+from   ProbeSim   import ProbeModel, ProbeSimServer
+from   ProbeIfSim import ProbeIfSim
+
+PROGRAM = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "ProbeProgram.py")
+
+class CountingPort(object):
+    """
+    Wraps a serial port object and counts the bytes passed through it. If
+    simulated is set, the port runs the probe model in the caller's thread,
+    so the CPU time spent in it is counted too, to be left out of the host
+    software's figures.
+    """
+
+    def __init__(self, port, simulated=False):
+        """
+        Wrap port.
+        """
+        self.port      = port
+        self.simulated = simulated
+        self.txBytes   = 0
+        self.rxBytes   = 0
+        self.simCPU    = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def write(self, data):
+        self.txBytes += len(data)
+        if(not self.simulated):
+            return self.port.write(data)
+        cpu0 = time.thread_time()
+        try:
+            return self.port.write(data)
+        finally:
+            self.simCPU += time.thread_time() - cpu0
+
+    def read(self, size=1):
+        if(not self.simulated):
+            data = self.port.read(size)
+        else:
+            cpu0 = time.thread_time()
+            try:
+                data = self.port.read(size)
+            finally:
+                self.simCPU += time.thread_time() - cpu0
+        self.rxBytes += len(data)
+        return data
+
+
+class ProbeBench(object):
+    """
+    Runs each benchmark in turn and collects the results.
+    """
+
+    def __init__(self, probe, baud, iterations):
+        """
+        Benchmark probe, which should already be open. baud is the rate used
+        to work out how long the bytes sent would take on a real UART.
+        """
+        self.probe      = probe
+        self.baud       = baud
+        self.iterations = iterations
+        self.port       = CountingPort(probe.port,
+            isinstance(probe, ProbeIfSim))
+        self.probe.port = self.port
+        self.results    = {}
+
+    def measure(self, name, op, words=1):
+        """
+        Run op(i) for each iteration and record its timing. words is the
+        number of data words each op moves, for the bulk benchmarks. The
+        CPU time is that of the host software alone: time spent running a
+        simulated probe in the same thread is taken off.
+        """
+        latencies = []
+        tx0  = self.port.txBytes
+        rx0  = self.port.rxBytes
+        sim0 = self.port.simCPU
+        cpu0 = time.thread_time()
+        t0   = time.perf_counter()
+        for i in range(0, self.iterations):
+            start = time.perf_counter()
+            op(i)
+            latencies.append(time.perf_counter() - start)
+        wall = time.perf_counter() - t0
+        cpu  = time.thread_time() - cpu0 - (self.port.simCPU - sim0)
+        tx   = self.port.txBytes - tx0
+        rx   = self.port.rxBytes - rx0
+
+        # The UART is full duplex, so the wire time is set by the busier
+        # direction. Each byte is ten bit times with 8N1 framing.
+        wire  = max(tx, rx) * 10.0 / self.baud
+        nbyte = max(1, tx + rx)
+        latencies.sort()
+
+        self.results[name] = {
+            "iterations"       : self.iterations,
+            "ops_per_sec"      : self.iterations / wall,
+            "words_per_sec"    : self.iterations * words / wall,
+            "p50_us"           : self.percentile(latencies, 0.50) * 1e6,
+            "p99_us"           : self.percentile(latencies, 0.99) * 1e6,
+            "tx_bytes_per_op"  : tx / self.iterations,
+            "rx_bytes_per_op"  : rx / self.iterations,
+            "cpu_us_per_byte"  : cpu  * 1e6 / nbyte,
+            "wire_us_per_byte" : wire * 1e6 / nbyte,
+            "cpu_per_wire"     : cpu / wire if wire > 0 else None,
+        }
+
+    def percentile(self, ordered, p):
+        """
+        Return the p'th percentile of an already sorted list.
+        """
+        return ordered[int(round(p * (len(ordered) - 1)))]
+
+    def run(self, block_words):
+        """
+        Run all of the benchmarks.
+        """
+        probe = self.probe
+        base  = 0xC0000000
+        data  = os.urandom(4 * block_words)
+
+        def reg_read(i):
+            probe.getGPIByte(0)
+
+        def set_address(i):
+            probe.setAXIAddress(base + 4 * (i & 0xFFFF))
+
+        def axi_read(i):
+            probe.setAXIAddress(base + 4 * (i & 0xFF))
+            probe.doRead(autoInc=False)
+            probe.getAXIReadData()
+
+        def axi_write(i):
+            probe.setAXIAddress(base + 4 * (i & 0xFF))
+            probe.setAXIWriteData(i & 0xFFFFFFFF)
+            probe.doWrite(autoInc=False)
+
+        def block_write(i):
+            probe.writeBlock(base, data)
+
+        def block_read(i):
+            probe.readBlock(base, block_words)
+
+        self.measure("reg_read",    reg_read)
+        self.measure("set_address", set_address)
+        self.measure("axi_read",    axi_read)
+        self.measure("axi_write",   axi_write)
+        self.measure("block_write", block_write, words=block_words)
+        self.measure("block_read",  block_read,  words=block_words)
+        return self.results
+
+    def runStartup(self, iterations):
+        """
+        Time how long ProbeProgram takes to run short commands from a cold
+        start, against a daemon serving the simulated probe so that no
+        real port is needed. startup_python is the cost of starting the
+        interpreter alone, for comparison.
+        """
+        from ProbeDaemon import ProbeDaemon
+        path   = os.path.join(tempfile.mkdtemp(), "bench.sock")
+        daemon = ProbeDaemon(self.probe, path)
+        daemon.start()
+
+        commands = [
+            ("startup_python",     ["-c", "pass"]),
+            ("startup_help",       [PROGRAM, "--help"]),
+            ("startup_gpo_setbit", [PROGRAM, "--socket", path, "gpo",
+                                    "--setbit", "3"]),
+            ("startup_gpi_all",    [PROGRAM, "--socket", path, "gpi",
+                                    "--all"]),
+        ]
+        try:
+            for name, argv in commands:
+                self.measureStartup(name, [sys.executable] + argv,
+                    iterations)
+        finally:
+            daemon.stop()
+        return self.results
+
+    def measureStartup(self, name, argv, iterations):
+        """
+        Run the command argv iterations times and record how long each run
+        took, start to finish.
+        """
+        times = []
+        t0    = time.perf_counter()
+        for i in range(0, iterations):
+            start = time.perf_counter()
+            subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        wall = time.perf_counter() - t0
+        times.sort()
+        self.results[name] = {
+            "iterations"  : iterations,
+            "ops_per_sec" : iterations / wall,
+            "p50_us"      : self.percentile(times, 0.50) * 1e6,
+            "p99_us"      : self.percentile(times, 0.99) * 1e6,
+        }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results against a baseline results file. Returns the names of
+    benchmarks whose throughput dropped by more than tolerance.
+    """
+    with open(baseline, "r") as fh:
+        old = json.load(fh)["results"]
+    regressed = []
+    for name, res in results.items():
+        if(name not in old):
+            continue
+        ratio = res["ops_per_sec"] / old[name]["ops_per_sec"]
+        print("%-18s %10.1f ops/s  (%5.2fx baseline)" %
+            (name, res["ops_per_sec"], ratio))
+        if(ratio < 1.0 - tolerance):
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    """
+    Main entry point for the benchmarks.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--transport", choices=["sim","pty"], default="sim",
+        help="Talk to the simulated probe directly, or through a pty pair.")
+    parser.add_argument("--baud","-b", type=int, default=115200,
+        help="Baud rate used to work out wire time.")
+    parser.add_argument("--emulate", action="store_true",
+        help="Also emulate the timing of the UART at that baud rate.")
+    parser.add_argument("--iterations","-n", type=int, default=1000,
+        help="Number of times each operation is run.")
+    parser.add_argument("--block-words", type=int, default=256,
+        help="Size in words of each bulk transfer.")
+    parser.add_argument("--output","-o", type=str, default="bench.json",
+        help="File to write results to, as JSON.")
+    parser.add_argument("--baseline", type=str, default=None,
+        help="Results file to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+        help="Fractional throughput drop treated as a regression.")
+    parser.add_argument("--startup", type=int, default=0, metavar="N",
+        help="Also time N cold starts of ProbeProgram for each of a few "
+             "short commands.")
+    args = parser.parse_args()
+
+    emulated = args.baud if args.emulate else None
+    model    = ProbeModel()
+
+    if(args.transport == "sim"):
+        probe = ProbeIfSim(model)
+        probe.open(baud=emulated, timeout=5)
+    else:
+        from ProbeIfSerial import ProbeIfSerial
+        server = ProbeSimServer(model, emulated)
+        server.start()
+        probe = ProbeIfSerial()
+        probe.open(server.portname, baud=args.baud, timeout=5)
+
+    bench   = ProbeBench(probe, args.baud, args.iterations)
+    results = bench.run(args.block_words)
+    if(args.startup > 0):
+        results = bench.runStartup(args.startup)
+
+    with open(args.output, "w") as fh:
+        json.dump({"config" : vars(args), "results" : results}, fh,
+            indent=2, sort_keys=True)
+
+    for name, res in results.items():
+        cpu_per_wire = res.get("cpu_per_wire")
+        print("%-18s %10.1f ops/s  p50 %8.1fus  p99 %8.1fus  "
+              "cpu/wire %s" % (name, res["ops_per_sec"], res["p50_us"],
+              res["p99_us"], "%.3f" % cpu_per_wire
+              if cpu_per_wire != None else "-"))
+
+    if(args.baseline != None):
+        regressed = compare(results, args.baseline, args.tolerance)
+        if(len(regressed) > 0):
+            print("[FAIL] Regressions in: %s" % ", ".join(regressed))
+            return 1
+
+    return 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())
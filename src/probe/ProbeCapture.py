@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+
+"""
+Capture the general purpose inputs of a probe as fast as the link allows,
+and read back or convert the capture files it writes.
+"""
+
+import sys
+import time
+import struct
+
+import ProbeCommon as pc
+
+#
+# Capture file format
+#
+#   A header of CAPTURE_MAGIC, the wall clock time the capture started
+#   (float64) and the mask of GPIs which were sampled (uint32). Then one
+#   record per sample: the time since the start of the capture in
+#   nanoseconds (uint64) and the value of the GPIs (uint32). Bits outside
+#   the mask read as zero. All values are little-endian.
+#
+
+CAPTURE_MAGIC  = b"PRBC\x01"
+CAPTURE_HEADER = struct.Struct("<dI")
+CAPTURE_RECORD = struct.Struct("<QI")
+
+class ProbeCaptureFile(object):
+    """
+    Writes samples to a binary capture file as they arrive. Only the file
+    object's write buffer is held in memory, however long the capture.
+    """
+
+    def __init__(self, fh, mask):
+        """
+        Write the capture to fh, a file opened in binary mode. mask is the
+        set of GPIs being sampled. The header is written straight away, so
+        the file can be read even if no samples arrive, and the capture is
+        taken to start now.
+        """
+        self.fh    = fh
+        self.start = time.monotonic_ns()
+        self.mask  = mask
+        self.fh.write(CAPTURE_MAGIC +
+            CAPTURE_HEADER.pack(time.time(), self.mask))
+
+    def write(self, stamp, value):
+        """
+        Record the value of the GPIs at monotonic time stamp (ns).
+        """
+        self.fh.write(CAPTURE_RECORD.pack(max(0, stamp - self.start), value))
+
+    def close(self):
+        self.fh.close()
+
+
+class ProbeCaptureVCD(object):
+    """
+    Writes samples to a value change dump, with the GPIs as one 32-bit
+    signal, for viewing in a waveform viewer. Only changes are written.
+    """
+
+    def __init__(self, fh, mask):
+        """
+        Write the dump to fh, a file opened in text mode. The definitions
+        are written straight away, so the dump is valid even if no samples
+        arrive. Times are counted from the first sample.
+        """
+        self.fh    = fh
+        self.start = None
+        self.mask  = mask
+        self.last  = None
+        self.fh.write("$date %s $end\n" % time.asctime())
+        self.fh.write("$version ProbeCapture $end\n")
+        self.fh.write("$comment gpi mask 0x%08x $end\n" % self.mask)
+        self.fh.write("$timescale 1ns $end\n")
+        self.fh.write("$scope module probe $end\n")
+        self.fh.write("$var wire 32 ! gpi [31:0] $end\n")
+        self.fh.write("$upscope $end\n")
+        self.fh.write("$enddefinitions $end\n")
+
+    def write(self, stamp, value):
+        if(self.start == None):
+            self.start = stamp
+        if(value != self.last):
+            self.fh.write("#%d\nb%s !\n" % (stamp - self.start,
+                format(value, "b")))
+            self.last = value
+
+    def close(self):
+        self.fh.close()
+
+
+class ProbeCapture(object):
+    """
+    Samples the GPIs of a probe back to back. Only the banks of GPIs
+    covered by mask are read, so watching fewer signals gives a higher
+    sample rate. Each sample is stamped with the time its response arrived
+    at the host.
+    """
+
+    def __init__(self, probe, mask=0xFFFFFFFF, depth=64):
+        """
+        Sample probe, which should already be open. depth is the number of
+        samples kept in flight on the link at once.
+        """
+        self.probe = probe
+        self.mask  = mask & 0xFFFFFFFF
+        self.depth = depth
+        self.banks = pc.maskBanks(self.mask)
+        if(len(self.banks) == 0):
+            raise ValueError("No GPIs selected by mask 0x%08x" % mask)
+        self.frame = b"".join(pc.RDGPI[i].code for i in self.banks)
+
+    def samples(self, count=None, duration=None):
+        """
+        Yield (monotonic time in ns, value) for each sample, stopping after
+        count samples or duration seconds, whichever comes first, or never
+        if neither is given.
+        """
+        stop = None
+        if(duration != None):
+            stop = time.monotonic_ns() + int(duration * 1e9)
+        taken  = 0
+        stream = self.probe.stream(self.frame, len(self.banks), self.depth)
+        try:
+            for stamp, data in stream:
+                yield stamp, pc.joinBanks(self.banks, data) & self.mask
+                taken += 1
+                if(count != None and taken >= count):
+                    break
+                if(stop != None and stamp >= stop):
+                    break
+        finally:
+            stream.close()
+
+    def capture(self, writer, count=None, duration=None, changes=False):
+        """
+        Pass samples to writer until stopped by count, duration or a
+        keyboard interrupt. If changes is set, only samples which differ
+        from the one before (and the very first) are passed on. Returns
+        the number of samples taken, the number written and the time taken
+        in seconds.
+        """
+        taken   = 0
+        written = 0
+        last    = None
+        first   = None
+        stamp   = None
+        try:
+            for stamp, value in self.samples(count, duration):
+                if(first == None):
+                    first = stamp
+                taken += 1
+                if(changes and value == last):
+                    continue
+                writer.write(stamp, value)
+                written += 1
+                last     = value
+        except KeyboardInterrupt:
+            pass
+        if(first == None):
+            return 0, 0, 0.0
+        return taken, written, (stamp - first) / 1e9
+
+
+def readCapture(fh):
+    """
+    Read a binary capture file from fh. Returns the wall clock start time,
+    the mask of GPIs sampled and a generator of (time in seconds, value)
+    samples, which reads the file as it goes.
+    """
+    magic = fh.read(len(CAPTURE_MAGIC))
+    if(magic != CAPTURE_MAGIC):
+        raise ValueError("Not a probe capture file")
+    start, mask = CAPTURE_HEADER.unpack(fh.read(CAPTURE_HEADER.size))
+
+    def samples():
+        while(True):
+            rec = fh.read(CAPTURE_RECORD.size)
+            if(len(rec) < CAPTURE_RECORD.size):
+                return
+            stamp, value = CAPTURE_RECORD.unpack(rec)
+            yield stamp / 1e9, value
+
+    return start, mask, samples()
+
+
+def main():
+    """
+    Print a capture file, or convert it to a value change dump.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("capture", type=str, help="Capture file to read.")
+    parser.add_argument("--vcd", type=str, default=None,
+        help="Write the capture to this file as a value change dump "
+             "rather than printing it.")
+    args = parser.parse_args()
+
+    with open(args.capture, "rb") as fh:
+        start, mask, samples = readCapture(fh)
+        if(args.vcd != None):
+            vcd = ProbeCaptureVCD(open(args.vcd, "w"), mask)
+            for stamp, value in samples:
+                vcd.write(int(round(stamp * 1e9)), value)
+            vcd.close()
+            return 0
+
+        print("Capture started %s, gpi mask 0x%08x" % (time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.localtime(start)), mask))
+        for stamp, value in samples:
+            print("%12.6f %08x" % (stamp, value))
+    return 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())
@@ -1,6 +1,9 @@
 #!/usr/bin/python3
 
+import os
 import sys
+import struct
+import collections
 
 #
 # Probe Command Encodings
@@ -42,6 +45,162 @@ PROBE_CMD_AXIWRRC= bytes("\x1F", "ascii")
 PROBE_CMD_AXIRDWC= bytes("\x20", "ascii")
 PROBE_CMD_AXIWRWC= bytes("\x21", "ascii")
 
+#
+# Probe Command Table
+#
+#   One entry per command: its name, opcode, the number of operand bytes
+#   which follow it, the number of bytes the probe sends back, and the
+#   register it accesses.
+#
+
+ProbeCommand = collections.namedtuple("ProbeCommand",
+    ["name", "opcode", "code", "operands", "response", "register"])
+
+def __command__(name, code, operands, response, register):
+    return ProbeCommand(name, code[0], code, operands, response, register)
+
+PROBE_COMMANDS = (
+    __command__("RDGPI0" , PROBE_CMD_RDGPI0 , 0, 1, "gpi[7:0]"          ),
+    __command__("RDGPI1" , PROBE_CMD_RDGPI1 , 0, 1, "gpi[15:8]"         ),
+    __command__("RDGPI2" , PROBE_CMD_RDGPI2 , 0, 1, "gpi[23:16]"        ),
+    __command__("RDGPI3" , PROBE_CMD_RDGPI3 , 0, 1, "gpi[31:24]"        ),
+    __command__("RDGPO0" , PROBE_CMD_RDGPO0 , 0, 1, "gpo[7:0]"          ),
+    __command__("RDGPO1" , PROBE_CMD_RDGPO1 , 0, 1, "gpo[15:8]"         ),
+    __command__("RDGPO2" , PROBE_CMD_RDGPO2 , 0, 1, "gpo[23:16]"        ),
+    __command__("RDGPO3" , PROBE_CMD_RDGPO3 , 0, 1, "gpo[31:24]"        ),
+    __command__("WRGPO0" , PROBE_CMD_WRGPO0 , 1, 0, "gpo[7:0]"          ),
+    __command__("WRGPO1" , PROBE_CMD_WRGPO1 , 1, 0, "gpo[15:8]"         ),
+    __command__("WRGPO2" , PROBE_CMD_WRGPO2 , 1, 0, "gpo[23:16]"        ),
+    __command__("WRGPO3" , PROBE_CMD_WRGPO3 , 1, 0, "gpo[31:24]"        ),
+    __command__("RDAXA0" , PROBE_CMD_RDAXA0 , 0, 1, "axi_addr[7:0]"     ),
+    __command__("RDAXA1" , PROBE_CMD_RDAXA1 , 0, 1, "axi_addr[15:8]"    ),
+    __command__("RDAXA2" , PROBE_CMD_RDAXA2 , 0, 1, "axi_addr[23:16]"   ),
+    __command__("RDAXA3" , PROBE_CMD_RDAXA3 , 0, 1, "axi_addr[31:24]"   ),
+    __command__("WRAXA0" , PROBE_CMD_WRAXA0 , 1, 0, "axi_addr[7:0]"     ),
+    __command__("WRAXA1" , PROBE_CMD_WRAXA1 , 1, 0, "axi_addr[15:8]"    ),
+    __command__("WRAXA2" , PROBE_CMD_WRAXA2 , 1, 0, "axi_addr[23:16]"   ),
+    __command__("WRAXA3" , PROBE_CMD_WRAXA3 , 1, 0, "axi_addr[31:24]"   ),
+    __command__("AXIRB0" , PROBE_CMD_AXIRB0 , 0, 1, "axi_data[7:0]"     ),
+    __command__("AXIRB1" , PROBE_CMD_AXIRB1 , 0, 1, "axi_data[15:8]"    ),
+    __command__("AXIRB2" , PROBE_CMD_AXIRB2 , 0, 1, "axi_data[23:16]"   ),
+    __command__("AXIRB3" , PROBE_CMD_AXIRB3 , 0, 1, "axi_data[31:24]"   ),
+    __command__("AXIWB0" , PROBE_CMD_AXIWB0 , 1, 0, "m_axi_wdata[7:0]"  ),
+    __command__("AXIWB1" , PROBE_CMD_AXIWB1 , 1, 0, "m_axi_wdata[15:8]" ),
+    __command__("AXIWB2" , PROBE_CMD_AXIWB2 , 1, 0, "m_axi_wdata[23:16]"),
+    __command__("AXIWB3" , PROBE_CMD_AXIWB3 , 1, 0, "m_axi_wdata[31:24]"),
+    __command__("AXIRDRC", PROBE_CMD_AXIRDRC, 0, 1, "axi_rctrl"         ),
+    __command__("AXIWRRC", PROBE_CMD_AXIWRRC, 1, 0, "axi_rctrl"         ),
+    __command__("AXIRDWC", PROBE_CMD_AXIRDWC, 0, 1, "axi_wctrl"         ),
+    __command__("AXIWRWC", PROBE_CMD_AXIWRWC, 1, 0, "axi_wctrl"         ),
+)
+
+COMMANDS           = dict((c.name,   c) for c in PROBE_COMMANDS)
+COMMANDS_BY_OPCODE = dict((c.opcode, c) for c in PROBE_COMMANDS)
+
+#
+# Commands for each byte of the multi-byte registers, indexed by byte.
+#
+RDGPI = tuple(COMMANDS["RDGPI%d" % i] for i in range(0,4))
+RDGPO = tuple(COMMANDS["RDGPO%d" % i] for i in range(0,4))
+WRGPO = tuple(COMMANDS["WRGPO%d" % i] for i in range(0,4))
+RDAXA = tuple(COMMANDS["RDAXA%d" % i] for i in range(0,4))
+WRAXA = tuple(COMMANDS["WRAXA%d" % i] for i in range(0,4))
+AXIRB = tuple(COMMANDS["AXIRB%d" % i] for i in range(0,4))
+AXIWB = tuple(COMMANDS["AXIWB%d" % i] for i in range(0,4))
+
+#
+# Register values the probe takes on reset. These match the default
+# GPO_ON_RESET and AXI_ADDR_ON_RESET parameters of uartprobe.v.
+#
+GPO_ON_RESET      = 0xDEADBEEF
+AXI_ADDR_ON_RESET = 0x00000000
+
+#
+# AXI control status register fields.
+#
+AXI_CTRL_GO      = 0x01
+AXI_CTRL_AE      = 0x02
+AXI_CTRL_RV      = 0x08
+AXI_CTRL_WV      = 0x08
+AXI_CTRL_RESP    = 0xC0
+
+#
+# AXI4 response codes, as reported in the rr / wr control register fields.
+#
+AXI_RESP_OKAY    = 0
+AXI_RESP_EXOKAY  = 1
+AXI_RESP_SLVERR  = 2
+AXI_RESP_DECERR  = 3
+
+#
+# Encoding helpers. Every single byte value is built once up front, so
+# encoding register operands in the hot paths never allocates.
+#
+BYTE             = tuple(bytes([i]) for i in range(0, 256))
+WORD             = struct.Struct("<I")
+
+def splitWord(value):
+    """
+    Return the four bytes of a 32-bit value, least significant first, as
+    one byte bytes objects.
+    """
+    return (BYTE[ value        & 0xFF],
+            BYTE[(value >>  8) & 0xFF],
+            BYTE[(value >> 16) & 0xFF],
+            BYTE[(value >> 24) & 0xFF])
+
+def joinWord(data):
+    """
+    Return the 32-bit value of four little-endian bytes.
+    """
+    return WORD.unpack(data)[0]
+
+def maskBanks(mask):
+    """
+    Return the indices of the GPIO banks (bytes) which have bits set in the
+    32-bit mask.
+    """
+    return [i for i in range(0, 4) if (mask >> (8 * i)) & 0xFF]
+
+def joinBanks(banks, values):
+    """
+    Return the 32-bit value made of the byte values of the GPIO banks
+    listed in banks, with the bits of other banks clear.
+    """
+    word = 0
+    for bank, value in zip(banks, values):
+        word |= value << (8 * bank)
+    return word
+
+def csrByte(ae, go):
+    """
+    Return the control register operand with the given ae and go fields.
+    """
+    return BYTE[(AXI_CTRL_AE if ae else 0) | (AXI_CTRL_GO if go else 0)]
+
+#
+# Number of 32-bit words moved per batch by the bulk transfer functions, the
+# number of batches kept in flight when reading, and the number of bytes of
+# a file mapped into memory at once when streaming to or from it.
+#
+BLOCK_WORDS      = 64
+BLOCK_DEPTH      = 4
+MAP_WINDOW       = 1 << 20
+
+#
+# Number of GPI reads kept in flight while waiting on an input (see
+# ProbeInterface.waitGPI). Enough to keep the link busy through the gaps
+# in host scheduling and USB polling, while few enough to read back
+# quickly once the wait is over.
+#
+GPI_WAIT_DEPTH   = 16
+
+#
+# Directory holding what is remembered about each probe between runs.
+#
+CACHE_DIR        = os.path.join(os.path.expanduser("~"), ".cache",
+                                "verilog-probe")
+
 CMD_PRINT_REGISTERS = "print-registers"
 CMD_TRY_CONNECT     = "test"
 CMD_GPI             = "gpi"
@@ -49,6 +208,10 @@ CMD_GPO             = "gpo"
 CMD_AXI             = "axi"
 CMD_DEMO            = "demo"
 CMD_FILE            = "file"
+CMD_RUN             = "run"
+CMD_LOAD            = "load"
+CMD_LINK            = "link"
+CMD_WAVE            = "wave"
 
 cols={"RED"   : "\033[1;31m",  
       "BLUE"  : "\033[1;34m",
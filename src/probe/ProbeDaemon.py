@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+"""
+Long running daemon which owns the serial port of a probe and serves
+requests for it over a Unix domain socket. Connect to it with
+ProbeProgram --daemon, or from Python with ProbeIfDaemon.
+"""
+
+import os
+import sys
+import stat
+import socket
+import threading
+import socketserver
+
+from   ProbeIfDaemon import DAEMON_REQUEST, DAEMON_REPLY, DAEMON_EXCHANGE, \
+                            DAEMON_LOCK, DAEMON_UNLOCK, DAEMON_DISCARD, \
+                            DAEMON_OK, DAEMON_ERROR, defaultSocket
+
+class ProbeDaemonHandler(socketserver.StreamRequestHandler):
+    """
+    Serves the requests of one client connection, in order.
+    """
+
+    def handle(self):
+        daemon = self.server.daemon
+        held   = False
+        try:
+            while(True):
+                head = self.rfile.read(DAEMON_REQUEST.size)
+                if(len(head) < DAEMON_REQUEST.size):
+                    break
+                op, rid, nrsp, length = DAEMON_REQUEST.unpack(head)
+                frame = self.rfile.read(length)
+
+                status, data = DAEMON_OK, b""
+                try:
+                    if(op == DAEMON_EXCHANGE):
+                        data = daemon.exchange(frame, nrsp, held)
+                    elif(op == DAEMON_LOCK):
+                        if(not held):
+                            daemon.owner.acquire()
+                            held = True
+                    elif(op == DAEMON_UNLOCK):
+                        if(held):
+                            daemon.owner.release()
+                            held = False
+                    elif(op == DAEMON_DISCARD):
+                        daemon.discard(held)
+                    else:
+                        raise ValueError("Unknown request %d" % op)
+                except Exception as e:
+                    status, data = DAEMON_ERROR, str(e).encode()
+
+                self.wfile.write(DAEMON_REPLY.pack(rid, status, len(data)) +
+                    data)
+        except OSError:
+            pass
+        finally:
+            if(held):
+                daemon.owner.release()
+
+
+class ProbeDaemonServer(socketserver.ThreadingMixIn,
+                        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ProbeDaemon(object):
+    """
+    Serves an open probe interface on a Unix domain socket. Each client
+    gets its own thread. Every frame is sent to the probe whole, and a
+    client holding the lock has the probe to itself, so the command
+    streams of concurrent clients are never mixed up.
+    """
+
+    def __init__(self, probe, path):
+        """
+        Serve probe, which should already be open, on the socket at path.
+        A stale socket left behind by a daemon which has gone away is
+        replaced, but a live one is left alone. The socket can only be
+        used by the user running the daemon.
+        """
+        self.probe = probe
+        self.path  = path
+        self.owner = threading.Lock()
+
+        if(os.path.exists(path)):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                raise OSError("A daemon is already serving '%s'" % path)
+            except ConnectionRefusedError:
+                os.unlink(path)
+            finally:
+                sock.close()
+
+        # Bind with every permission but the owner's masked off, so that
+        # there is no moment at which anyone else can connect.
+        umask = os.umask(0o177)
+        try:
+            self.server    = ProbeDaemonServer(path, ProbeDaemonHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+
+    def exchange(self, frame, nrsp, held):
+        """
+        Exchange a frame with the probe on behalf of a client. Clients not
+        holding the lock take it for just this frame.
+        """
+        if(held):
+            return self.probe.exchange(frame, nrsp)
+        with self.owner:
+            return self.probe.exchange(frame, nrsp)
+
+    def discard(self, held):
+        """
+        Throw away anything in flight from the probe on behalf of a client,
+        taking the lock for it as exchange does.
+        """
+        if(held):
+            return self.probe.discard()
+        with self.owner:
+            return self.probe.discard()
+
+    def serve(self):
+        """
+        Serve clients until stop() is called.
+        """
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if(os.path.exists(self.path)):
+                os.unlink(self.path)
+
+    def start(self):
+        """
+        Serve clients from a background thread.
+        """
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop serving.
+        """
+        self.server.shutdown()
+
+
+def privateDir(path):
+    """
+    Create the directory path, usable only by the current user, unless it
+    exists already. Raises OSError if an existing one belongs to anyone
+    else or is open to others, as it could then hold a socket planted by
+    another user.
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if(not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+       info.st_mode & 0o077):
+        raise OSError("'%s' is not a directory private to this user" % path)
+
+
+def main():
+    """
+    Open a probe and serve it until interrupted.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("port", type=str,
+        help="The name of the TTY/COM port to connect to the probe over, "
+             "or tcp://host:port for a probe behind a terminal server.")
+    parser.add_argument("--baud","-b", type=int, default=None,
+        help="Baud rate of the serial port. Defaults to the rate chosen by "
+             "'ProbeProgram.py PORT link --tune', or 9600.")
+    parser.add_argument("--socket", type=str, default=None,
+        help="Path of the socket to listen on. Defaults to one named after "
+             "the port, in a directory private to the user under the "
+             "temporary directory.")
+    parser.add_argument("--sim", action="store_true",
+        help="Serve a simulated probe rather than opening the port.")
+    args = parser.parse_args()
+
+    try:
+        if(args.sim):
+            from ProbeIfSim import ProbeIfSim
+            probe = ProbeIfSim()
+            probe.open(timeout=1)
+        elif(args.port.startswith("tcp://")):
+            from ProbeIfSocket import ProbeIfSocket
+            probe = ProbeIfSocket()
+            probe.open(args.port)
+        else:
+            from ProbeIfSerial import ProbeIfSerial
+            from ProbeLink     import tunedLink, apply
+            tuned = tunedLink(args.port) if args.baud == None else None
+            probe = ProbeIfSerial()
+            probe.open(args.port, baud=args.baud or 9600, timeout=1)
+            if(tuned != None):
+                apply(probe, tuned)
+    except Exception as e:
+        print("[ERROR] Could not open port '%s'" % args.port)
+        print(e)
+        return 1
+
+    path = args.socket
+    if(path == None):
+        path = defaultSocket(args.port)
+
+    try:
+        if(args.socket == None):
+            privateDir(os.path.dirname(path))
+        daemon = ProbeDaemon(probe, path)
+    except OSError as e:
+        print("[ERROR] %s" % e)
+        return 1
+
+    # Treat being killed like an interrupt, so the socket is cleaned up.
+    import signal
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    print("Serving probe on port '%s' at '%s'" % (args.port, path))
+    sys.stdout.flush()
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+import os
+import time
+import struct
+import socket
+
+from   ProbeInterface import ProbeInterface
+
+#
+# Daemon request protocol
+#
+#   Every request is a REQUEST header of the operation, a request id, the
+#   number of response bytes wanted and the length of the frame which
+#   follows. EXCHANGE sends the frame to the probe and collects nrsp bytes
+#   back. LOCK gives the connection sole use of the probe until it sends
+#   UNLOCK or disconnects. DISCARD waits for anything still in flight from
+#   the probe and throws it away. Every request is answered, in order, with a
+#   REPLY header of the request id, a status and the length of the data
+#   which follows: the response bytes, or an error message if the status
+#   is not DAEMON_OK. All values are little-endian.
+#
+
+DAEMON_REQUEST  = struct.Struct("<BIII")
+DAEMON_REPLY    = struct.Struct("<IBI")
+DAEMON_EXCHANGE = 0
+DAEMON_LOCK     = 1
+DAEMON_UNLOCK   = 2
+DAEMON_DISCARD  = 3
+DAEMON_OK       = 0
+DAEMON_ERROR    = 1
+
+def defaultSocket(portname):
+    """
+    Return the path of the socket a daemon serving portname listens on
+    unless told otherwise. It is kept in a directory of its own under the
+    temporary directory, for the daemon to make private to the user.
+    """
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), "probe-%d" % os.getuid(),
+        "probe-%s.sock" % os.path.basename(portname))
+
+
+class ProbeIfDaemon(ProbeInterface):
+    """
+    Class which implements the ProbeInterface class by passing frames to a
+    ProbeDaemon over a Unix domain socket. Write-only frames are not waited
+    for: their replies are collected the next time a response is needed,
+    so runs of writes are pipelined through the daemon.
+    """
+
+    def __init__(self, window=256):
+        """
+        Create the interface. At most window requests are sent ahead of
+        their replies, so that neither end fills its socket buffer and
+        stalls.
+        """
+        ProbeInterface.__init__(self)
+        self.window  = window
+        self.sock    = None
+        self.rfile   = None
+        self.nextId  = 0
+        self.unacked = 0
+        self.locked  = False
+
+    def open(self, path, lock=True):
+        """
+        Connect to the daemon listening on path. If lock is set, take sole
+        use of the probe until close() is called, so that the commands of
+        other clients cannot be interleaved with ours.
+        """
+        self.sock  = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile("rb")
+        self.invalidateShadow()
+        if(lock):
+            self.lock()
+
+    def close(self):
+        """
+        Wait for any outstanding replies, give up the lock and disconnect.
+        """
+        if(self.sock == None):
+            return
+        try:
+            if(self.locked):
+                self.unlock()
+            self.sync()
+        finally:
+            self.rfile.close()
+            self.sock.close()
+            self.sock  = None
+            self.rfile = None
+
+    def connected(self):
+        """
+        Are we connected to a daemon?
+        """
+        return self.sock != None
+
+    def lock(self):
+        """
+        Take sole use of the probe. Blocks, at the next exchange which
+        needs a response, until any other client holding it lets go.
+        """
+        self.__request__(DAEMON_LOCK)
+        self.locked = True
+        self.invalidateShadow()
+
+    def unlock(self):
+        """
+        Let other clients use the probe again.
+        """
+        self.__request__(DAEMON_UNLOCK)
+        self.locked = False
+
+    def sync(self):
+        """
+        Wait for the replies to every request sent so far, raising IOError
+        if any of them failed.
+        """
+        error = None
+        while(self.unacked > 0):
+            self.unacked -= 1
+            ok, data = self.__reply__()
+            if(not ok and error == None):
+                error = data
+        if(error != None):
+            raise IOError("Probe daemon: %s" % error.decode(errors="replace"))
+
+    def discard(self):
+        """
+        Have the daemon wait for anything still on its way back from the
+        probe and throw it away, as the interface it owns does. Used to get
+        back in step with the probe (see ProbeReliable).
+        """
+        self.__request__(DAEMON_DISCARD)
+        self.sync()
+
+    def exchange(self, frame, nrsp):
+        """
+        Send a frame to the daemon, and return the nrsp bytes the probe sent
+        back. Write-only frames return straight away.
+        """
+        self.__request__(DAEMON_EXCHANGE, frame, nrsp)
+        if(nrsp == 0):
+            if(self.unacked >= self.window):
+                self.sync()
+            return b""
+        self.unacked -= 1
+        try:
+            self.sync()
+        finally:
+            ok, data = self.__reply__()
+        if(not ok):
+            raise IOError("Probe daemon: %s" % data.decode(errors="replace"))
+        return data
+
+    def stream(self, frame, nrsp, depth=64, count=None):
+        """
+        Send frame over and over with depth requests for it in flight at
+        the daemon. See ProbeInterface.stream.
+        """
+        assert(self.batchDepth == 0)
+        self.sync()
+        sent = 0
+        try:
+            while(sent < depth and (count == None or sent < count)):
+                self.__request__(DAEMON_EXCHANGE, frame, nrsp)
+                sent += 1
+            while(self.unacked > 0):
+                self.unacked -= 1
+                ok, data = self.__reply__()
+                if(not ok or len(data) != nrsp):
+                    raise IOError("Probe daemon: %s" % (data.decode(
+                        errors="replace") if not ok else
+                        "expected %d response bytes, got %d" %
+                        (nrsp, len(data))))
+                now = time.monotonic_ns()
+                if(count == None or sent < count):
+                    self.__request__(DAEMON_EXCHANGE, frame, nrsp)
+                    sent += 1
+                yield now, data
+        finally:
+            self.sync()
+
+    def __request__(self, op, frame=b"", nrsp=0):
+        """
+        Send one request without waiting for its reply.
+        """
+        self.nextId = (self.nextId + 1) & 0xFFFFFFFF
+        self.sock.sendall(DAEMON_REQUEST.pack(op, self.nextId, nrsp,
+            len(frame)) + frame)
+        self.unacked += 1
+
+    def __reply__(self):
+        """
+        Read the next reply. Returns whether it succeeded, and its data.
+        """
+        head = self.rfile.read(DAEMON_REPLY.size)
+        if(len(head) < DAEMON_REPLY.size):
+            raise IOError("Connection to probe daemon lost")
+        rid, status, length = DAEMON_REPLY.unpack(head)
+        return status == DAEMON_OK, self.rfile.read(length)
@@ -1,11 +1,9 @@
 #!/usr/bin/python3
 
-import os
-import sys
+import time
 
 import serial
 
-import ProbeCommon as pc
 from   ProbeInterface import ProbeInterface
 
 class ProbeIfSerial(ProbeInterface):
@@ -15,10 +13,14 @@ class ProbeIfSerial(ProbeInterface):
 
     def __init__(self, verbose=False):
         """
-        Create the interface.
+        Create the interface. If verbose is set, every byte sent and
+        recieved is printed.
         """
+        ProbeInterface.__init__(self)
         self.port       = serial.Serial()
-        self.verbose    = verbose
+        if(verbose):
+            from ProbeTrace import ProbeTracePrint
+            self.setTracer(ProbeTracePrint())
     
     def open(self, portname, baud = 9600, timeout=1000):
         """
@@ -30,6 +32,7 @@ class ProbeIfSerial(ProbeInterface):
         self.port.bytesize  = serial.EIGHTBITS
         self.port.xonxoff   = False
         self.port.open()
+        self.invalidateShadow()
 
     def connected(self):
         """
@@ -37,298 +40,72 @@ class ProbeIfSerial(ProbeInterface):
         """
         return self.port.is_open
 
-
-    def __send__(self,val):
-        """
-        Send one byte to the probe.
-        """
-        assert(len(val) == 1)
-        assert(type(val) == bytes)
-        v = int.from_bytes(val,byteorder="little")
-        if(self.verbose):
-            pc.color_stdout("GREEN")
-            print(">> %s\t - %s\t - %d"% (hex(v),bin(v),v))
-            pc.color_stdout("RESET")
-        self.port.write(val)
-
-
-    def __recv__(self):
-        """
-        Read one byte from the probe.
-        """
-        data = self.port.read(size=1)
-        v = int.from_bytes(data, byteorder="little")
-        if(self.verbose):
-            pc.color_stdout("RED")
-            print("<< %s\t - %s\t - %d"% (hex(v),bin(v),v))
-            pc.color_stdout("RESET")
-        return data
-
-    def do_RDGPI0(self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_RDGPI0))
-        return self.__recv__()
-
-    def do_RDGPI1(self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_RDGPI1))
-        return self.__recv__()
-
-    def do_RDGPI2(self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_RDGPI2))
-        return self.__recv__()
-
-    def do_RDGPI3(self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_RDGPI3))
-        return self.__recv__()
-
-    def do_RDGPO0(self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_RDGPO0))
-        return self.__recv__()
-
-    def do_RDGPO1(self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_RDGPO1))
-        return self.__recv__()
-
-    def do_RDGPO2(self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_RDGPO2))
-        return self.__recv__()
-
-    def do_RDGPO3(self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_RDGPO3))
-        return self.__recv__()
-
-    def do_WRGPO0(self, value):
-        """
-        Perform the command '' and return the result.
-        """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_WRGPO0))
-        self.__send__(value)
-        return None
-
-    def do_WRGPO1(self, value):
-        """
-        Perform the command '' and return the result.
-        """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_WRGPO1))
-        self.__send__(value)
-        return None
-
-    def do_WRGPO2(self, value):
-        """
-        Perform the command '' and return the result.
-        """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_WRGPO2))
-        self.__send__(value)
-        return None
-
-    def do_WRGPO3(self, value):
-        """
-        Perform the command '' and return the result.
-        """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_WRGPO3))
-        self.__send__(value)
-        return None
-
-    def do_RDAXA0(self):
-        """
-        Perform the command '' and return the result.
+    def close(self):
         """
-        self.__send__(bytes(pc.PROBE_CMD_RDAXA0))
-        return self.__recv__()
-
-    def do_RDAXA1(self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_RDAXA1))
-        return self.__recv__()
-
-    def do_RDAXA2(self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_RDAXA2))
-        return self.__recv__()
-
-    def do_RDAXA3(self):
-        """
-        Perform the command '' and return the result.
+        Close the serial port.
         """
-        self.__send__(bytes(pc.PROBE_CMD_RDAXA3))
-        return self.__recv__()
+        self.port.close()
 
-    def do_WRAXA0(self, value):
+    def exchange(self, frame, nrsp):
         """
-        Perform the command '' and return the result.
+        Write a frame of commands to the port with a single write() call,
+        then read back all nrsp response bytes with a single read().
         """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_WRAXA0))
-        self.__send__(value)
-        return None
+        if(len(frame) > 0):
+            self.port.write(frame)
 
-    def do_WRAXA1(self, value):
-        """
-        Perform the command '' and return the result.
-        """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_WRAXA1))
-        self.__send__(value)
-        return None
+        if(nrsp == 0):
+            return b""
 
-    def do_WRAXA2(self, value):
-        """
-        Perform the command '' and return the result.
-        """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_WRAXA2))
-        self.__send__(value)
-        return None
+        return self.port.read(size=nrsp)
 
-    def do_WRAXA3(self, value):
+    def discard(self):
         """
-        Perform the command '' and return the result.
+        Wait long enough for anything in flight to arrive, then throw away
+        whatever is in the input buffer.
         """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_WRAXA3))
-        self.__send__(value)
-        return None
+        baud = self.port.baudrate
+        time.sleep(0.05 + (64 * 10.0 / baud if baud else 0))
+        self.port.reset_input_buffer()
 
-    def do_AXIRB0 (self):
+    def stream(self, frame, nrsp, depth=64, count=None):
         """
-        Perform the command '' and return the result.
+        Send frame over and over with depth copies in flight, writing the
+        next copy as each response arrives. See ProbeInterface.stream.
         """
-        self.__send__(bytes(pc.PROBE_CMD_AXIRB0))
-        return self.__recv__()
+        assert(self.batchDepth == 0)
+        sent     = 0
+        inflight = 0
+        try:
+            first = depth if count == None else min(depth, count)
+            self.__streamWrite__(frame * first)
+            sent     = first
+            inflight = first
+            while(inflight > 0):
+                data = self.port.read(size=nrsp)
+                if(self.tracer != None and data):
+                    self.tracer.rx(data)
+                if(len(data) != nrsp):
+                    inflight = 0
+                    raise IOError("Expected %d response bytes from probe, "
+                        "got %d" % (nrsp, len(data)))
+                now       = time.monotonic_ns()
+                inflight -= 1
+                if(count == None or sent < count):
+                    self.__streamWrite__(frame)
+                    sent     += 1
+                    inflight += 1
+                yield now, data
+        finally:
+            if(inflight > 0):
+                data = self.port.read(size=nrsp * inflight)
+                if(self.tracer != None and data):
+                    self.tracer.rx(data)
 
-    def do_AXIRB1 (self):
+    def __streamWrite__(self, frame):
         """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_AXIRB1))
-        return self.__recv__()
-
-    def do_AXIRB2 (self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_AXIRB2))
-        return self.__recv__()
-
-    def do_AXIRB3 (self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_AXIRB3))
-        return self.__recv__()
-
-    def do_AXIWB0 (self, value):
-        """
-        Perform the command '' and return the result.
-        """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_AXIWB0))
-        self.__send__(value)
-        return None
-
-    def do_AXIWB1 (self, value):
+        Write part of a stream to the port, passing it to the tracer.
         """
-        Perform the command '' and return the result.
-        """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_AXIWB1))
-        self.__send__(value)
-        return None
-
-    def do_AXIWB2 (self, value):
-        """
-        Perform the command '' and return the result.
-        """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_AXIWB2))
-        self.__send__(value)
-        return None
-
-    def do_AXIWB3 (self, value):
-        """
-        Perform the command '' and return the result.
-        """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_AXIWB3))
-        self.__send__(value)
-        return None
-
-    def do_AXIRDRC(self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_AXIRDRC))
-        return self.__recv__()
-
-    def do_AXIWRRC(self, value):
-        """
-        Perform the command '' and return the result.
-        """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_AXIWRRC))
-        self.__send__(value)
-        return None
-
-    def do_AXIRDWC(self):
-        """
-        Perform the command '' and return the result.
-        """
-        self.__send__(bytes(pc.PROBE_CMD_AXIRDWC))
-        return self.__recv__()
-
-    def do_AXIWRWC(self, value):
-        """
-        Perform the command '' and return the result.
-        """
-        assert(len(value) == 1)
-        assert(type(value) == bytes)
-        self.__send__(bytes(pc.PROBE_CMD_AXIWRWC))
-        self.__send__(value)
-        return None
-
-
-
+        if(self.tracer != None):
+            self.tracer.tx(frame)
+        self.port.write(frame)
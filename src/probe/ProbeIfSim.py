@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+
+from   ProbeIfSerial import ProbeIfSerial
+from   ProbeSim      import ProbeModel, ProbeSimLink, ProbeSimPort
+
+class ProbeIfSim(ProbeIfSerial):
+    """
+    Class which implements the ProbeInterface class on top of a simulated
+    probe, rather than a serial port. All of the framing and batching of
+    ProbeIfSerial is used unchanged.
+    """
+
+    def __init__(self, model=None, verbose=False):
+        """
+        Create the interface. If no model is given, a default ProbeModel is
+        created.
+        """
+        ProbeIfSerial.__init__(self, verbose=verbose)
+        if(model == None):
+            model = ProbeModel()
+        self.model = model
+
+    def open(self, portname=None, baud=None, timeout=None, loss=0.0):
+        """
+        Connect to the simulated probe. portname is ignored. If baud is
+        given, the timing of a UART running at that rate is emulated. loss
+        is the chance of each byte going missing (see ProbeSimLink).
+        """
+        self.port = ProbeSimPort(ProbeSimLink(self.model, baud, loss),
+            timeout)
+        self.invalidateShadow()
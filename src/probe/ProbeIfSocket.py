@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+
+import time
+import select
+import socket
+
+from   ProbeInterface import ProbeInterface
+
+def isSocketPort(portname):
+    """
+    Does portname name a probe reached over TCP, as tcp://host:port?
+    """
+    return portname.startswith("tcp://")
+
+
+def parseAddress(portname):
+    """
+    Split a port name of the form tcp://host:port (or just host:port) into
+    the host and the port number.
+    """
+    if(isSocketPort(portname)):
+        portname = portname[len("tcp://"):]
+    host, sep, port = portname.rpartition(":")
+    if(sep == "" or host == ""):
+        raise ValueError("Expected tcp://host:port, not '%s'" % portname)
+    return host.strip("[]"), int(port)
+
+
+class ProbeIfSocket(ProbeInterface):
+    """
+    Class which implements the ProbeInterface class over a raw TCP
+    connection to a terminal server (such as ser2net) which passes bytes
+    straight to and from the UART of the probe. The baud rate is set on the
+    terminal server, not here.
+
+    Every frame goes out in as few send() calls as possible, with Nagle's
+    algorithm off by default so that a frame waiting for its response is
+    not held back. Long frames are sent window bytes at a time, collecting
+    whatever responses have already arrived in between, so that neither
+    side's socket buffers fill up and stall the other.
+
+    If the connection is found to have dropped before a frame is sent, it
+    is quietly reopened and the shadow registers are kept, as the probe
+    itself has not been touched. If it drops during an exchange, it is
+    reopened but the shadow registers are forgotten, and the exchange
+    fails with an IOError, as there is no telling how much of the frame
+    reached the probe.
+    """
+
+    def __init__(self, window=4096, nodelay=True, bufsize=1 << 20,
+                 retries=3):
+        """
+        Create the interface. window is the number of bytes sent at a time
+        within a frame, nodelay turns off Nagle's algorithm, bufsize is the
+        size asked for of the socket send and receive buffers, and retries
+        is the number of attempts made to reconnect after a drop.
+        """
+        ProbeInterface.__init__(self)
+        self.window  = window
+        self.nodelay = nodelay
+        self.bufsize = bufsize
+        self.retries = retries
+        self.sock    = None
+        self.address = None
+        self.timeout = None
+
+    def open(self, portname, baud=None, timeout=5):
+        """
+        Connect to the probe at portname, given as tcp://host:port. baud is
+        ignored. Reads which see nothing for timeout seconds fail.
+        """
+        self.address = parseAddress(portname)
+        self.timeout = timeout
+        self.__connect__()
+        self.invalidateShadow()
+
+    def __connect__(self):
+        """
+        Open the connection and set up the socket.
+        """
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+            1 if self.nodelay else 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.bufsize)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.bufsize)
+        self.sock = sock
+
+    def reconnect(self):
+        """
+        Close the connection and open it again, backing off between
+        attempts. The shadow registers are left alone.
+        """
+        if(self.sock != None):
+            self.sock.close()
+            self.sock = None
+        delay = 0.1
+        for attempt in range(0, self.retries):
+            try:
+                self.__connect__()
+                return
+            except OSError:
+                if(attempt == self.retries - 1):
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    def connected(self):
+        """
+        Are we connected to the probe?
+        """
+        return self.sock != None
+
+    def close(self):
+        """
+        Close the connection.
+        """
+        if(self.sock != None):
+            self.sock.close()
+            self.sock = None
+
+    def __dropped__(self):
+        """
+        Has the other end closed the connection? Checked without blocking
+        or consuming any bytes.
+        """
+        if(self.sock == None):
+            return True
+        ready, _, _ = select.select([self.sock], [], [], 0)
+        if(not ready):
+            return False
+        try:
+            return len(self.sock.recv(1, socket.MSG_PEEK)) == 0
+        except OSError:
+            return True
+
+    def __recvInto__(self, view, block):
+        """
+        Receive into the memoryview view, returning the number of bytes
+        read. Without block, only what has already arrived is taken.
+        """
+        try:
+            if(block):
+                n = self.sock.recv_into(view)
+            else:
+                n = self.sock.recv_into(view, 0, socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        if(n == 0):
+            raise ConnectionError("Connection closed by the other end")
+        return n
+
+    def __exchange__(self, frame, nrsp):
+        """
+        Send frame a window at a time and collect nrsp response bytes, or
+        as many as arrive before the read times out.
+        """
+        frame = memoryview(frame).cast("B")
+        buf   = bytearray(nrsp)
+        view  = memoryview(buf)
+        got   = 0
+        for start in range(0, len(frame), self.window):
+            self.sock.sendall(frame[start:start+self.window])
+            if(got < nrsp):
+                got += self.__recvInto__(view[got:], False)
+        try:
+            while(got < nrsp):
+                got += self.__recvInto__(view[got:], True)
+        except socket.timeout:
+            return bytes(buf[:got])
+        return bytes(buf)
+
+    def exchange(self, frame, nrsp):
+        """
+        Send a frame of commands to the probe and return the nrsp bytes it
+        sends back. As with a serial port, fewer are returned if the read
+        times out.
+        """
+        if(self.__dropped__()):
+            self.reconnect()
+        try:
+            return self.__exchange__(frame, nrsp)
+        except socket.timeout:
+            raise IOError("Timed out sending a frame to the probe")
+        except OSError as e:
+            self.invalidateShadow()
+            self.reconnect()
+            raise IOError("Connection to probe lost mid-exchange, and "
+                "reconnected: %s" % e)
+
+    def discard(self):
+        """
+        Wait a moment for anything in flight to arrive, then read and throw
+        away whatever has.
+        """
+        if(self.__dropped__()):
+            self.reconnect()
+            return
+        time.sleep(0.05)
+        buf  = bytearray(4096)
+        view = memoryview(buf)
+        try:
+            while(self.__recvInto__(view, False) > 0):
+                pass
+        except OSError:
+            self.reconnect()
+
+    def stream(self, frame, nrsp, depth=64, count=None):
+        """
+        Send frame over and over with depth copies in flight, sending the
+        next copy as each response arrives. See ProbeInterface.stream.
+        """
+        assert(self.batchDepth == 0)
+        if(self.__dropped__()):
+            self.reconnect()
+        buf      = bytearray(nrsp)
+        view     = memoryview(buf)
+        sent     = 0
+        inflight = 0
+        try:
+            first = depth if count == None else min(depth, count)
+            self.__streamSend__(frame * first)
+            sent     = first
+            inflight = first
+            while(inflight > 0):
+                got = 0
+                while(got < nrsp):
+                    got += self.__recvInto__(view[got:], True)
+                if(self.tracer != None):
+                    self.tracer.rx(bytes(buf))
+                now       = time.monotonic_ns()
+                inflight -= 1
+                if(count == None or sent < count):
+                    self.__streamSend__(frame)
+                    sent     += 1
+                    inflight += 1
+                yield now, bytes(buf)
+        except socket.timeout:
+            inflight = 0
+            raise IOError("Expected %d response bytes from probe, timed out"
+                % nrsp)
+        except OSError as e:
+            inflight = 0
+            self.invalidateShadow()
+            self.reconnect()
+            raise IOError("Connection to probe lost mid-stream, and "
+                "reconnected: %s" % e)
+        finally:
+            if(inflight > 0):
+                rest = bytearray(nrsp * inflight)
+                view = memoryview(rest)
+                got  = 0
+                while(got < len(rest)):
+                    got += self.__recvInto__(view[got:], True)
+                if(self.tracer != None):
+                    self.tracer.rx(bytes(rest))
+
+    def __streamSend__(self, frame):
+        """
+        Send part of a stream, passing it to the tracer.
+        """
+        if(self.tracer != None):
+            self.tracer.tx(frame)
+        self.sock.sendall(frame)
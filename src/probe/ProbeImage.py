@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+
+"""
+Read memory images (Intel HEX, SREC or raw binary) and load them into
+memory through the probe, writing only the words which have changed since
+the last load.
+"""
+
+import os
+import sys
+import struct
+import random
+
+import ProbeCommon as pc
+
+#
+# Model file format
+#
+#   A header of MODEL_MAGIC, followed by one record per run of consecutive
+#   words: the address of the first word and the number of words (uint32
+#   each), then the words themselves (uint32 each). All values are
+#   little-endian.
+#
+
+MODEL_MAGIC = b"PRBM\x01"
+MODEL_RUN   = struct.Struct("<II")
+
+class ProbeImage(object):
+    """
+    A sparse image of 32-bit memory, held as a dictionary mapping word
+    aligned addresses to word values. Words which have only had some of
+    their bytes set are listed in partial, mapping the address to a mask
+    of which bytes are set (bit n for byte n).
+    """
+
+    def __init__(self):
+        self.words   = {}
+        self.partial = {}
+
+    def __len__(self):
+        return len(self.words)
+
+    def setBytes(self, addr, data):
+        """
+        Set the bytes of the image starting at byte address addr.
+        """
+        for i, b in enumerate(data):
+            a     = addr + i
+            word  = a & ~3
+            shift = 8 * (a & 3)
+            if(word not in self.words):
+                self.words[word]   = 0
+                self.partial[word] = 0
+            if(word in self.partial):
+                self.partial[word] |= 1 << (a & 3)
+                if(self.partial[word] == 0xF):
+                    del self.partial[word]
+            self.words[word] = (self.words[word] & ~(0xFF << shift)) | \
+                               (b << shift)
+
+    def fill(self, known):
+        """
+        Complete the partial words of the image, taking the bytes which are
+        not set from known(addr), which should return the current value of
+        the word at addr.
+        """
+        for word, mask in sorted(self.partial.items()):
+            keep = sum(0xFF << (8 * i) for i in range(0, 4) if mask & (1 << i))
+            self.words[word] = (self.words[word] & keep) | \
+                               (known(word) & ~keep & 0xFFFFFFFF)
+        self.partial = {}
+
+    def runs(self, addrs=None):
+        """
+        Yield (address, list of values) for each run of consecutive words in
+        the image, or just of those listed in addrs.
+        """
+        if(addrs == None):
+            addrs = self.words.keys()
+        start, values = None, []
+        for a in sorted(addrs):
+            if(start != None and a == start + 4 * len(values)):
+                values.append(self.words[a])
+                continue
+            if(start != None):
+                yield start, values
+            start, values = a, [self.words[a]]
+        if(start != None):
+            yield start, values
+
+    def save(self, fh):
+        """
+        Write the image to the binary file object fh.
+        """
+        fh.write(MODEL_MAGIC)
+        for start, values in self.runs():
+            fh.write(MODEL_RUN.pack(start, len(values)))
+            fh.write(struct.pack("<%dI" % len(values), *values))
+
+    @classmethod
+    def load(cls, fh):
+        """
+        Read an image written by save from the binary file object fh.
+        """
+        if(fh.read(len(MODEL_MAGIC)) != MODEL_MAGIC):
+            raise ValueError("Not a probe memory model file")
+        image = cls()
+        while(True):
+            head = fh.read(MODEL_RUN.size)
+            if(len(head) < MODEL_RUN.size):
+                break
+            start, count = MODEL_RUN.unpack(head)
+            values = struct.unpack("<%dI" % count, fh.read(4 * count))
+            for i, v in enumerate(values):
+                image.words[start + 4 * i] = v
+        return image
+
+
+def readIHex(fh):
+    """
+    Read an Intel HEX file from the text file object fh.
+    """
+    image = ProbeImage()
+    upper = 0
+    for lineno, line in enumerate(fh, start=1):
+        line = line.strip()
+        if(len(line) == 0):
+            continue
+        if(not line.startswith(":")):
+            raise ValueError("line %d: not an Intel HEX record" % lineno)
+        rec = bytes.fromhex(line[1:])
+        if(len(rec) < 5 or len(rec) != 5 + rec[0]):
+            raise ValueError("line %d: bad record length" % lineno)
+        if(sum(rec) & 0xFF != 0):
+            raise ValueError("line %d: bad checksum" % lineno)
+        addr, rtype, data = (rec[1] << 8) | rec[2], rec[3], rec[4:-1]
+        if(rtype == 0x00):
+            image.setBytes(upper + addr, data)
+        elif(rtype == 0x01):
+            break
+        elif(rtype == 0x02):
+            upper = ((data[0] << 8) | data[1]) << 4
+        elif(rtype == 0x04):
+            upper = ((data[0] << 8) | data[1]) << 16
+    return image
+
+
+def readSREC(fh):
+    """
+    Read a Motorola S-record file from the text file object fh.
+    """
+    image = ProbeImage()
+    for lineno, line in enumerate(fh, start=1):
+        line = line.strip()
+        if(len(line) == 0):
+            continue
+        if(len(line) < 4 or line[0] != "S"):
+            raise ValueError("line %d: not an S-record" % lineno)
+        rtype = line[1]
+        rec   = bytes.fromhex(line[2:])
+        if(len(rec) != rec[0] + 1):
+            raise ValueError("line %d: bad record length" % lineno)
+        if((sum(rec) & 0xFF) != 0xFF):
+            raise ValueError("line %d: bad checksum" % lineno)
+        if(rtype in "123"):
+            alen = int(rtype) + 1
+            addr = int.from_bytes(rec[1:1+alen], byteorder="big")
+            image.setBytes(addr, rec[1+alen:-1])
+    return image
+
+
+def readRaw(fh, base):
+    """
+    Read a raw binary image from the binary file object fh, to be placed at
+    address base.
+    """
+    image = ProbeImage()
+    image.setBytes(base, fh.read())
+    return image
+
+
+def readImage(path, fmt=None, base=0):
+    """
+    Read an image file. fmt is one of "ihex", "srec" or "raw". If it is
+    None it is guessed from the file extension, with anything unknown read
+    as raw binary placed at base.
+    """
+    if(fmt == None):
+        ext = os.path.splitext(path)[1].lower()
+        if(ext in (".hex", ".ihex", ".ihx")):
+            fmt = "ihex"
+        elif(ext in (".srec", ".s19", ".s28", ".s37", ".mot")):
+            fmt = "srec"
+        else:
+            fmt = "raw"
+
+    if(fmt == "ihex"):
+        with open(path, "r") as fh:
+            return readIHex(fh)
+    elif(fmt == "srec"):
+        with open(path, "r") as fh:
+            return readSREC(fh)
+    with open(path, "rb") as fh:
+        return readRaw(fh, base)
+
+
+def defaultModel(portname):
+    """
+    Return the path of the file used to remember what was last loaded
+    through the probe on portname.
+    """
+    return os.path.join(pc.CACHE_DIR, "%s.model" % os.path.basename(portname))
+
+
+class ProbeImageLoader(object):
+    """
+    Loads images into memory through a probe, keeping a model of what it
+    has written so far so that later loads only write the words which
+    differ. Each run of changed words is written with writeBlock, which
+    keeps several frames in flight, and the shadow registers are on so
+    that moving the address over a gap between changed words only sends
+    the address bytes which differ.
+    """
+
+    def __init__(self, probe, model=None):
+        """
+        Load images through probe, which should already be open. model is
+        a ProbeImage of what memory is believed to hold, or None if nothing
+        is known.
+        """
+        self.probe = probe
+        self.model = model if model != None else ProbeImage()
+
+    def check(self, image, nwords):
+        """
+        Read back up to nwords words, chosen at random, which the model says
+        already hold their values in image. Returns True if they all match,
+        meaning the model can be trusted.
+        """
+        same = [a for a in image.words if self.model.words.get(a) ==
+                image.words[a]]
+        if(len(same) == 0 or nwords <= 0):
+            return True
+        found = self.probe.readWords(random.sample(same,
+            min(nwords, len(same))))
+        return all(found[a] == image.words[a] for a in found)
+
+    def load(self, image, check=0, full=False):
+        """
+        Load image. Partial words are completed from the model, or read
+        from memory if the model does not know them. If check is non-zero
+        that many unchanged words are read back first, and if any of them
+        differ the model is thrown away. If full is set every word is
+        written. Returns the number of words in the image, the number
+        written and the number of runs they were written in.
+        """
+        shadow = self.probe.shadowEnabled
+        if(not shadow):
+            self.probe.enableShadow(True)
+        try:
+            missing = [a for a in image.partial if a not in self.model.words]
+            known   = self.probe.readWords(missing)
+            known.update(self.model.words)
+            image.fill(lambda a: known[a])
+
+            if(not full and check > 0 and not self.check(image, check)):
+                full = True
+            if(full):
+                self.model = ProbeImage()
+
+            changed = [a for a, v in image.words.items()
+                       if self.model.words.get(a) != v]
+            runs    = list(image.runs(changed))
+
+            for start, values in runs:
+                self.probe.writeBlock(start,
+                    struct.pack("<%dI" % len(values), *values))
+        finally:
+            if(not shadow):
+                self.probe.enableShadow(False)
+
+        for start, values in runs:
+            for i, v in enumerate(values):
+                self.model.words[start + 4 * i] = v
+        return len(image), len(changed), len(runs)
+
+    def loadModel(self, path):
+        """
+        Replace the model with the one saved at path, if there is one.
+        """
+        if(os.path.exists(path)):
+            with open(path, "rb") as fh:
+                self.model = ProbeImage.load(fh)
+
+    def saveModel(self, path):
+        """
+        Save the model to path, creating its directory if need be.
+        """
+        folder = os.path.dirname(path)
+        if(folder != "" and not os.path.isdir(folder)):
+            os.makedirs(folder)
+        with open(path, "wb") as fh:
+            self.model.save(fh)
+
+
+def main():
+    """
+    Print a summary of an image file.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("image", type=str, help="Image file to read.")
+    parser.add_argument("--format", choices=["ihex","srec","raw"],
+        default=None, help="Image format. Guessed from the extension if "
+        "not given.")
+    parser.add_argument("--base", type=str, default="0",
+        help="Hex address of the start of a raw image.")
+    args = parser.parse_args()
+
+    image = readImage(args.image, args.format, int(args.base, base=16))
+    for start, values in image.runs():
+        print("0x%08x - 0x%08x  %d words" % (start,
+            start + 4 * len(values) - 1, len(values)))
+    print("%d words, %d partial" % (len(image), len(image.partial)))
+    return 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())
@@ -1,9 +1,9 @@
 #!/usr/bin/python3
 
 import os
-import sys
-
-from   bitstring import BitArray
+import mmap
+import stat
+import time
 
 import ProbeCommon as pc
 
@@ -19,6 +19,137 @@ class ProbeInterface(object):
         """
         Create the interface.
         """
+        self.shadowEnabled = False
+        self.reliable      = None
+        self.invalidateShadow()
+
+        # Batching state. While batchDepth is non-zero, command frames are
+        # queued in txbuf rather than sent, and each expected response byte
+        # is counted in rxexpect. batchStart holds, per nesting level, the
+        # number of responses expected when that level began.
+        self.batchDepth = 0
+        self.batchStart = []
+        self.txbuf      = bytearray()
+        self.rxbuf      = bytearray()
+        self.rxexpect   = 0
+
+        self.tracer     = None
+
+        # Number of bulk transfer frames kept in flight at once. Links which
+        # can take more (see ProbeLink) may raise it.
+        self.depth      = pc.BLOCK_DEPTH
+
+        # Completion polling (see waitRead/waitWrite). waitTimeout is the
+        # default number of seconds to wait for a transaction, and polls
+        # back off from pollMin to pollMax seconds apart. speculate is
+        # cleared while transactions are found to outlast one round trip,
+        # so that slow peripherals are not sent data fetches which will be
+        # thrown away.
+        self.waitTimeout = 1.0
+        self.pollMin     = 0.0001
+        self.pollMax     = 0.01
+        self.speculate   = True
+
+    def setTracer(self, tracer):
+        """
+        Install a tracer (see ProbeTrace) which is given every chunk of
+        bytes exchanged with the probe, or remove it if tracer is None.
+        Without a tracer exchange is called directly, so tracing costs
+        nothing when it is off.
+        """
+        self.tracer = tracer
+        self.__route__()
+
+    def setReliable(self, reliable):
+        """
+        Install a layer (see ProbeReliable) which checks every exchange
+        stays in step with the probe and recovers when it does not, or
+        remove it if reliable is None. Streams (see stream) are not passed
+        through it, as they check their own response lengths.
+        """
+        self.reliable = reliable
+        if(reliable != None):
+            reliable.forget()
+        self.__route__()
+
+    def __route__(self):
+        """
+        Point exchange at the outermost of the layers turned on: the
+        reliability layer, which sits above the tracer, so that the tracer
+        sees the bytes actually exchanged, including any replays.
+        """
+        if(self.reliable != None):
+            self.exchange = self.__reliableExchange__
+        elif(self.tracer != None):
+            self.exchange = self.__tracedExchange__
+        elif("exchange" in self.__dict__):
+            del self.exchange
+
+    def __reliableExchange__(self, frame, nrsp):
+        """
+        Perform an exchange through the reliability layer.
+        """
+        if(self.tracer != None):
+            raw = self.__tracedExchange__
+        else:
+            raw = lambda f, n: type(self).exchange(self, f, n)
+        return self.reliable.exchange(frame, nrsp, raw, self.discard)
+
+    def __tracedExchange__(self, frame, nrsp):
+        """
+        Perform an exchange, passing the bytes sent and recieved to the
+        tracer.
+        """
+        if(len(frame) > 0):
+            self.tracer.tx(frame)
+        data = type(self).exchange(self, frame, nrsp)
+        if(data):
+            self.tracer.rx(data)
+        return data
+
+    def enableShadow(self, enable=True):
+        """
+        Turn the shadow register cache on or off. When on, values of the
+        host-owned registers (GPO bytes, AXI address, AXI write data and the
+        address auto-increment bit) which are already known are not read
+        back from the probe, and writes which would not change them are
+        skipped. The cache starts out empty either way.
+        """
+        self.shadowEnabled = enable
+        self.invalidateShadow()
+
+    def invalidateShadow(self):
+        """
+        Forget all shadowed register values, so that they are next read
+        from and written to the probe. Call this whenever something other
+        than this interface may have changed the probe registers.
+        """
+        self.shadowGPO   = [None, None, None, None]
+        self.shadowAddr  = None
+        self.shadowWData = None
+        self.shadowAE    = None
+        if(self.reliable != None):
+            self.reliable.forget()
+
+    def resetShadow(self, gpo=pc.GPO_ON_RESET, addr=pc.AXI_ADDR_ON_RESET):
+        """
+        Load the shadow registers with the values the probe takes on reset.
+        gpo and addr should match the GPO_ON_RESET and AXI_ADDR_ON_RESET
+        parameters the probe was built with.
+        """
+        self.invalidateShadow()
+        self.shadowGPO  = list(gpo.to_bytes(4, byteorder="little"))
+        self.shadowAddr = addr
+        self.shadowAE   = 1
+
+    def __shadowGo__(self, ae, nwords=1):
+        """
+        Track the effect on the shadow registers of nwords AXI transactions
+        started with the auto-increment bit set to ae.
+        """
+        self.shadowAE = 1 if ae else 0
+        if(ae and self.shadowAddr != None):
+            self.shadowAddr = (self.shadowAddr + 4 * nwords) & 0xFFFFFFFF
 
     def printRegisters(self):
         """
@@ -29,25 +160,21 @@ class ProbeInterface(object):
         if(not self.connected()):
             return 1
         
-        gpi  = (self.do_RDGPI0(),
-                self.do_RDGPI1(),
-                self.do_RDGPI2(),
-                self.do_RDGPI3())
-        
-        gpo  = (self.do_RDGPO0(),
-                self.do_RDGPO1(),
-                self.do_RDGPO2(),
-                self.do_RDGPO3())
-        
-        axi_a= (self.do_RDAXA0(),
-                self.do_RDAXA1(),
-                self.do_RDAXA2(),
-                self.do_RDAXA3())
+        rsp  = self.transactMany(
+                pc.RDGPI + pc.RDGPO + pc.RDAXA + pc.AXIRB +
+                (pc.COMMANDS["AXIRDRC"], pc.COMMANDS["AXIRDWC"]))
 
-        axi_d= (self.getAXIReadData(),)
+        gpi  = tuple(rsp[i:i+1] for i in range(0,4))
+        gpo  = tuple(rsp[i:i+1] for i in range(4,8))
+        axi_a= tuple(rsp[i:i+1] for i in range(8,12))
+        axi_d= (pc.joinWord(rsp[12:16]),)
         
-        rctrl = (self.do_AXIRDRC(),)
-        wctrl = (self.do_AXIRDWC(),)
+        rctrl = (rsp[16:17],)
+        wctrl = (rsp[17:18],)
+
+        self.shadowGPO  = list(rsp[4:8])
+        self.shadowAddr = pc.joinWord(rsp[8:12])
+        self.shadowAE   = (rsp[16] & pc.AXI_CTRL_AE) >> 1
 
         print("\nProbe Registers:")
         print("\tGPI   : %s %s %s %s" % gpi   )
@@ -63,360 +190,1132 @@ class ProbeInterface(object):
         """
         Return the 32-bit AXI address
         """
-        axi_a = self.do_RDAXA0() + self.do_RDAXA1() + self.do_RDAXA2() + self.do_RDAXA3()
-        address = int.from_bytes(axi_a, byteorder="little")
+        if(self.shadowEnabled and self.shadowAddr != None):
+            return self.shadowAddr
+        address = pc.joinWord(self.transactFrame(FRAME_RDAXA, 4))
+        self.shadowAddr = address
         return address
 
     def setAXIAddress(self, value):
         """
-        Set the address of the AXI bus.
-        """
-        bits = BitArray(hex=hex(value))
-        b0 = bits[-8:].bytes 
-        b1 = bits[-16:-8].bytes 
-        b2 = bits[-24:-16].bytes 
-        b3 = bits[-32:-24].bytes 
-        self.do_WRAXA0(b0)
-        self.do_WRAXA1(b1)
-        self.do_WRAXA2(b2)
-        self.do_WRAXA3(b3)
+        Set the address of the AXI bus. If the current address is known
+        from the shadow registers, only the bytes which differ from it are
+        sent, and nothing is sent if it already matches (for example when
+        auto-increment has moved it on to the requested address).
+        """
+        old = None
+        if(self.shadowEnabled and self.shadowAddr != None):
+            if(self.shadowAddr == value):
+                return
+            old = pc.splitWord(self.shadowAddr)
+        self.__writeWord__(pc.WRAXA, pc.splitWord(value), old)
+        self.shadowAddr = value & 0xFFFFFFFF
 
 
     def getAXIReadData(self):
         """
         Return the most recently read value from the AXI bus.
         """
-        data = self.do_AXIRB0() + self.do_AXIRB1() + self.do_AXIRB2() + self.do_AXIRB3()
-        data = int.from_bytes(data, byteorder="little")
-        return data
+        return pc.joinWord(self.transactFrame(FRAME_AXIRB, 4))
 
-    def doRead(self, autoInc = None):
+    def doRead(self, autoInc = None, wait = False, timeout = None):
         """
-        Perform a single read transaction at the current address
+        Perform a single read transaction at the current address. If wait
+        is set, wait for it to complete and return the read data and AXI
+        response code, as waitRead does.
         """
-        csr = BitArray(bytes=b"0", length=8)
+        if(autoInc == None and self.shadowEnabled):
+            autoInc = self.shadowAE
         if(autoInc == None):
-            csr = BitArray(bytes=self.do_AXIRDRC(), length=8)
-        else:
-            csr[-2] = autoInc
+            autoInc = self.__readRC__()[0] & pc.AXI_CTRL_AE
+
+        if(not wait):
+            self.do_AXIWRRC(pc.csrByte(autoInc, 1))
+            self.__shadowGo__(autoInc)
+            return None
 
-        csr[-1] = 1
-        self.do_AXIWRRC(csr.bytes)
+        # Read the control register before setting go, so that a stale rv
+        # bit left by an earlier transaction is cleared, and fetch the
+        # result in the same frame on the chance it is already done.
+        frame = pc.PROBE_CMD_AXIRDRC + pc.PROBE_CMD_AXIWRRC + \
+                pc.csrByte(autoInc, 1)
+        if(self.speculate):
+            frame += FRAME_RDRC_AXIRB
+        rsp = self.transactFrame(frame, 6 if self.speculate else 1)
+        self.__shadowGo__(autoInc)
+        return self.__finishRead__(rsp[1:], timeout)
 
-    def doWrite(self, autoInc = None):
+    def doWrite(self, autoInc = None, wait = False, timeout = None):
         """
-        Perform a single write transaction at the current address
+        Perform a single write transaction at the current address. If wait
+        is set, wait for it to complete and return the AXI response code,
+        as waitWrite does.
         """
-        csr = BitArray(bytes=b"0", length=8)
+        if(autoInc == None and self.shadowEnabled):
+            autoInc = self.shadowAE
         if(autoInc == None):
-            csr = BitArray(bytes=self.do_AXIRDRC(), length=8)
-        else:
-            csr[-2] = autoInc
+            autoInc = self.__readRC__()[0] & pc.AXI_CTRL_AE
 
-        csr[-1] = 1
-        self.do_AXIWRWC(csr.bytes)
+        if(not wait):
+            self.do_AXIWRWC(pc.csrByte(autoInc, 1))
+            self.__shadowGo__(autoInc)
+            return None
 
-    def setAutoIncrement(self, ae):
-        """
-        Set the auto incrmenet value for addresses when we do reads/writes
-        """
-        csr = BitArray(bytes=self.do_AXIRDRC(), length=8)
-        csr[-2] = ae
-        self.do_AXIWRRC(csr.bytes)
+        frame = pc.PROBE_CMD_AXIRDWC + pc.PROBE_CMD_AXIWRWC + \
+                pc.csrByte(autoInc, 1)
+        if(self.speculate):
+            frame += pc.PROBE_CMD_AXIRDWC
+        rsp = self.transactFrame(frame, 2 if self.speculate else 1)
+        self.__shadowGo__(autoInc)
+        return self.__finishWrite__(rsp[1:], timeout)
 
-    def setAXIWriteData(self, value):
+    def waitRead(self, timeout = None):
+        """
+        Wait for the read transaction started by doRead to complete, and
+        return the read data and the AXI response code (one of
+        pc.AXI_RESP_*). The rv bit is only cleared when the read control
+        register is read, so it must have been clear when the read was
+        started for this to be meaningful: that is the case if the previous
+        read was waited for, and doRead(wait=True) makes sure of it.
+        Raises TimeoutError if the read has not completed within timeout
+        seconds (waitTimeout by default).
+        """
+        rsp = b""
+        if(self.speculate):
+            rsp = self.transactFrame(FRAME_RDRC_AXIRB, 5)
+        return self.__finishRead__(rsp, timeout)
+
+    def waitWrite(self, timeout = None):
         """
-        Set the data to be written on the AXI master bus.
+        Wait for the write transaction started by doWrite to complete, and
+        return the AXI response code. The same caveat about stale status
+        bits applies as for waitRead.
         """
-        hexval = hex(value)[2:]
-        while(len(hexval)<8):
-            hexval = "0"+hexval
-        hexval = "0x"+hexval
-        bits = BitArray(hex=hexval)
-        b0 = bits[-8:].bytes 
-        b1 = bits[-16:-8].bytes 
-        b2 = bits[-24:-16].bytes 
-        b3 = bits[-32:-24].bytes 
-        self.do_AXIWB0(b0)
-        self.do_AXIWB1(b1)
-        self.do_AXIWB2(b2)
-        self.do_AXIWB3(b3)
+        return self.__finishWrite__(b"", timeout)
 
+    def __finishRead__(self, rsp, timeout):
+        """
+        Given the response to a speculative read control register and data
+        fetch (or nothing), poll until the read is done and return its data
+        and response code.
+        """
+        if(len(rsp) == 5 and rsp[0] & pc.AXI_CTRL_RV):
+            return pc.joinWord(rsp[1:5]), rsp[0] >> 6
+        if(len(rsp) == 5):
+            self.speculate = False
+        csr = self.__poll__(self.__readRC__, pc.AXI_CTRL_RV, timeout,
+            "read")
+        return self.getAXIReadData(), csr >> 6
 
-    def getGPIBit(self, bit):
-        """
-        Return the value of a single bit from the GPIs
-        """
-        bank = int(bit / 8)
-        biti = int(bit % 8)
-        byte = self.getGPIByte(bank)
-        bit  = self.getBit(biti,byte)
-        return bit
-    
-    def getGPOBit(self, bit):
-        """
-        Return the value of a single bit from the GPOs
+    def __finishWrite__(self, rsp, timeout):
+        """
+        Given the response to a speculative read of the write control
+        register (or nothing), poll until the write is done and return its
+        response code.
+        """
+        if(len(rsp) == 1 and rsp[0] & pc.AXI_CTRL_WV):
+            return rsp[0] >> 6
+        if(len(rsp) == 1):
+            self.speculate = False
+        csr = self.__poll__(self.__readWC__, pc.AXI_CTRL_WV, timeout,
+            "write")
+        return csr >> 6
+
+    def __readRC__(self):
         """
-        bank = int(bit / 8)
-        biti = int(bit % 8)
-        byte = self.getGPOByte(bank)
-        bit  = self.getBit(biti,byte)
-        return bit
-    
-    def getGPOByte(self, idx):
+        Read the AXI read control register. Unlike do_AXIRDRC this also
+        works inside a batch, which is flushed to get the value.
         """
-        Return the gpO byte addressed by idx.
-        """
-        if(idx == 0):
-            return self.do_RDGPO0()
-        elif(idx == 1):
-            return self.do_RDGPO1()
-        elif(idx == 2):
-            return self.do_RDGPO2()
-        elif(idx == 3):
-            return self.do_RDGPO3()
+        return self.transactFrame(pc.PROBE_CMD_AXIRDRC, 1)
 
-    def setGPOByte(self, idx, val):
+    def __readWC__(self):
         """
-        Return the gpO byte addressed by idx.
+        Read the AXI write control register, flushing any batch.
         """
-        if(idx == 0):
-            return self.do_WRGPO0(val)
-        elif(idx == 1):
-            return self.do_WRGPO1(val)
-        elif(idx == 2):
-            return self.do_WRGPO2(val)
-        elif(idx == 3):
-            return self.do_WRGPO3(val)
+        return self.transactFrame(pc.PROBE_CMD_AXIRDWC, 1)
 
-    def getGPIByte(self, idx):
+    def __poll__(self, read, mask, timeout, what):
+        """
+        Read a control register with read() until one of the bits in mask
+        is set, and return its value. The first poll is sent straight away
+        since the round trip over the UART is usually enough on its own.
+        After that the gap between polls doubles from pollMin up to
+        pollMax. If the first poll finds the transaction done, speculative
+        fetches are turned back on.
+        """
+        if(timeout == None):
+            timeout = self.waitTimeout
+        deadline = time.monotonic() + timeout
+        delay    = self.pollMin
+        first    = True
+        while(True):
+            csr = read()[0]
+            if(csr & mask):
+                if(first):
+                    self.speculate = True
+                return csr
+            first = False
+            now   = time.monotonic()
+            if(now >= deadline):
+                raise TimeoutError("AXI %s did not complete within %gs" %
+                    (what, timeout))
+            time.sleep(min(delay, deadline - now))
+            delay = min(2 * delay, self.pollMax)
+
+    def setAutoIncrement(self, ae):
         """
-        Return the gpi byte addressed by idx.
+        Set the auto incrmenet value for addresses when we do reads/writes
         """
-        if(idx == 0):
-            return self.do_RDGPI0()
-        elif(idx == 1):
-            return self.do_RDGPI1()
-        elif(idx == 2):
-            return self.do_RDGPI2()
-        elif(idx == 3):
-            return self.do_RDGPI3()
+        ae = 1 if ae else 0
+        if(self.shadowEnabled):
+            if(self.shadowAE == ae):
+                return
+            # Only the ae and go fields are writable, so there is no need
+            # to read the register back first.
+            csr = 0
+        else:
+            csr = self.__readRC__()[0]
+        csr = (csr & ~(pc.AXI_CTRL_AE | pc.AXI_CTRL_GO)) | (ae << 1)
+        self.do_AXIWRRC(pc.BYTE[csr])
+        self.shadowAE = ae
 
-    def getBit(self, biti, bval):
+    def setAXIWriteData(self, value):
         """
-        Return a single bit of a byte
+        Set the data to be written on the AXI master bus.
         """
+        old = None
+        if(self.shadowEnabled and self.shadowWData != None):
+            old = pc.splitWord(self.shadowWData)
+        self.__writeWord__(pc.AXIWB, pc.splitWord(value), old)
+        self.shadowWData = value & 0xFFFFFFFF
 
-        hexval = bval.hex()
-        intval = int(hexval,base=16)
-        binval = bin(intval)[2:]
-        while(len(binval) < 8):
-            binval = "0"+binval
-        bit    = binval[7-biti]
+    def __writeWord__(self, cmds, new, old):
+        """
+        Write the bytes of new to a 32-bit register using the byte-wise
+        write commands in cmds, as one frame. If old holds the current
+        bytes of the register, only the bytes which differ are written.
+        """
+        frame = []
+        for i in range(0, 4):
+            if(old == None or old[i] != new[i]):
+                frame.append((cmds[i], new[i]))
+        if(len(frame) > 0):
+            self.transactMany(frame)
 
-        return int(bit)
-    
-    # -----------------------------------------------------------------------
-    # It is expected that functions below this point are overriden. They are
-    # deliberately left as stubs.
-    # -----------------------------------------------------------------------
-    
-    def connected(self):
-        """
-        Have we successfully opened a connection to the probe
-        """
-        return True
+    def readBlockChunks(self, addr, nwords, chunk=pc.BLOCK_WORDS,
+                        depth=None):
+        """
+        Read nwords consecutive 32-bit words starting at addr, yielding the
+        data as little-endian bytes objects of at most chunk words each.
+        The address is set once (unless addr is None, in which case the
+        current address is used) and auto-increment advances it for every
+        subsequent word. Each chunk is sent to the probe as one frame, with
+        up to depth (by default self.depth) frames in flight (see stream)
+        unless we are batching or a reliability layer is installed.
+        If the generator is closed early the frames already sent are still
+        collected, and the shadowed address is forgotten.
 
-    def do_RDGPI0(self):
-        """
-        Perform the command '' and return the result.
-        """
-        return None
+        Every read is followed by a read of the read control register, and
+        words whose reads were not seen to complete in time (see
+        unpackReads) are read again one at a time, before their chunk is
+        yielded. The frames in flight behind a chunk which needed that run
+        on past it, so any read they left outstanding is waited for (see
+        settleAXI), and the rest of the block is read a frame at a time.
+        """
+        if(addr == None):
+            addr = self.getAXIAddress()
+        else:
+            self.setAXIAddress(addr)
+        if(depth == None):
+            depth = self.depth
 
-    def do_RDGPI1(self):
-        """
-        Perform the command '' and return the result.
-        """
-        return None
+        pos = 0
+        if(self.batchDepth == 0 and nwords > chunk and self.reliable == None):
+            frame  = readFrame(chunk)
+            done   = False
+            idle   = True
+            stream = self.stream(frame, 1 + READ_WORD_RSP * chunk, depth,
+                nwords // chunk)
+            try:
+                for stamp, rsp in stream:
+                    data, good, idle = self.unpackReads(rsp, idle)
+                    addrs = range(addr + 4 * pos, addr + 4 * (pos + chunk), 4)
+                    pos  += chunk
+                    if(not all(good)):
+                        stream.close()
+                        self.redoReads(addrs, data, good, None)
+                        yield bytes(data)
+                        break
+                    yield bytes(data)
+                else:
+                    self.__shadowGo__(1, pos)
+                done = True
+            finally:
+                stream.close()
+                if(not done):
+                    self.invalidateShadow()
 
-    def do_RDGPI2(self):
-        """
-        Perform the command '' and return the result.
-        """
-        return None
+        # Streams bypass the reliability layer, so with it on, depth chunks
+        # go out as one frame, which it pipelines and checks.
+        step = chunk
+        if(self.batchDepth == 0 and self.reliable != None):
+            step = chunk * depth
+        while(pos < nwords):
+            count = min(step, nwords - pos)
+            addrs = range(addr + 4 * pos, addr + 4 * (pos + count), 4)
+            rsp   = self.transactFrame(readFrame(count),
+                1 + READ_WORD_RSP * count)
+            self.__shadowGo__(1, count)
+            data, good, idle = self.unpackReads(rsp)
+            if(not all(good)):
+                idle = self.__settleRun__(addr + 4 * (pos + count), idle)
+                self.redoReads(addrs, data, good, idle)
+            for i in range(0, len(data), 4 * chunk):
+                yield bytes(data[i:i+4*chunk])
+            pos += count
 
-    def do_RDGPI3(self):
+    def unpackReads(self, rsp, idle=True):
         """
-        Perform the command '' and return the result.
+        Split the responses to a frame built by readFrame into the data
+        read, as a bytearray of little-endian words, and a list saying
+        which of the words can be trusted. idle says whether the read
+        channel was idle before the frame. Also returns whether it is idle
+        after: True, False, or None if that cannot be told. See the
+        function of the same name.
         """
-        return None
+        return unpackReads(rsp, idle)
 
-    def do_RDGPO0(self):
+    def unpackWrites(self, rsp, idle=True):
         """
-        Perform the command '' and return the result.
+        Given the responses to a frame built by writeFrame, return a list
+        saying which of its writes can be trusted, and whether the write
+        channel is idle after it, as for unpackReads.
         """
-        return None
+        return unpackWrites(rsp, idle)
 
-    def do_RDGPO1(self):
-        """
-        Perform the command '' and return the result.
-        """
-        return None
+    def settleAXI(self, rdIdle=True, wrIdle=True, timeout=None):
+        """
+        Wait for the reads (unless rdIdle) and writes (unless wrIdle) still
+        outstanding after frames checked by unpackReads and unpackWrites.
+        Either may be None if it is not known whether anything is
+        outstanding. Then the wait simply ends if nothing completes within
+        timeout seconds (waitTimeout by default). Otherwise that raises
+        TimeoutError.
+        """
+        for idle, read, mask, what in (
+                (rdIdle, self.__readRC__, pc.AXI_CTRL_RV, "read"),
+                (wrIdle, self.__readWC__, pc.AXI_CTRL_WV, "write")):
+            if(idle == True):
+                continue
+            try:
+                self.__poll__(read, mask, timeout, what)
+            except TimeoutError:
+                if(idle == False):
+                    raise
 
-    def do_RDGPO2(self):
-        """
-        Perform the command '' and return the result.
-        """
-        return None
+    def __settleRun__(self, end, idle):
+        """
+        Tell, where unpackReads or unpackWrites could not (idle is None),
+        whether the channel is idle after a frame of transactions on
+        consecutive words, by reading the address register. Each
+        transaction moves it on as it finishes, so if it has reached end,
+        just past the last word, they all started and finished.
+        """
+        if(idle != None):
+            return idle
+        self.shadowAddr = None
+        return True if self.getAXIAddress() == end else None
 
-    def do_RDGPO3(self):
+    def redoReads(self, addrs, data, good, idle=True):
+        """
+        Read again, one at a time, the words at addrs (a sequence of
+        addresses) whose reads unpackReads did not trust, and put their
+        values into data. idle says whether the read channel was idle
+        after the frame, as for settleAXI. Afterwards the address register
+        is left pointing just past the last word. Returns the number of
+        words read again.
+        """
+        bad = [i for i in range(0, len(good)) if not good[i]]
+        if(len(bad) == 0):
+            return 0
+        self.settleAXI(rdIdle=idle)
+        self.shadowAddr = None
+        for i in bad:
+            self.setAXIAddress(addrs[i])
+            value, resp = self.doRead(1, wait=True)
+            data[4*i:4*i+4] = pc.WORD.pack(value)
+        self.setAXIAddress((addrs[-1] + 4) & 0xFFFFFFFF)
+        return len(bad)
+
+    def redoWrites(self, addrs, data, good, idle=True):
+        """
+        Write again, one at a time, the words at addrs whose writes
+        unpackWrites did not trust, taking their values from data (a
+        bytes-like object of little-endian words). As for redoReads.
+        """
+        bad = [i for i in range(0, len(good)) if not good[i]]
+        if(len(bad) == 0):
+            return 0
+        self.settleAXI(wrIdle=idle)
+        self.shadowAddr  = None
+        self.shadowWData = None
+        for i in bad:
+            self.setAXIAddress(addrs[i])
+            self.setAXIWriteData(pc.WORD.unpack_from(data, 4 * i)[0])
+            self.doWrite(1, wait=True)
+        self.setAXIAddress((addrs[-1] + 4) & 0xFFFFFFFF)
+        return len(bad)
+
+    def readBlockInto(self, addr, buf, chunk=pc.BLOCK_WORDS, depth=None):
+        """
+        Fill buf, a writable bytes-like object, with the words of memory
+        starting at addr. Each chunk is copied into place as it arrives, so
+        nothing else grows with the size of the block. Returns the number of
+        words read.
+        """
+        view   = memoryview(buf).cast("B")
+        nwords = len(view) // 4
+        pos    = 0
+        for part in self.readBlockChunks(addr, nwords, chunk, depth):
+            view[pos:pos+len(part)] = part
+            pos += len(part)
+        return nwords
+
+    def readBlock(self, addr, nwords, chunk=pc.BLOCK_WORDS):
         """
-        Perform the command '' and return the result.
+        Read nwords consecutive 32-bit words starting at addr and return
+        them as a single little-endian bytes object.
         """
-        return None
+        data = bytearray(4 * nwords)
+        self.readBlockInto(addr, data, chunk)
+        return bytes(data)
+
+    def readWords(self, addrs, chunk=pc.BLOCK_WORDS):
+        """
+        Read the words at a list of scattered addresses, and return their
+        values in a dictionary keyed by address. The addresses are read in
+        order, chunk at a time, each chunk one frame and one exchange as for
+        readBlockChunks. Only the address bytes which differ from the word
+        before are sent (or from the shadowed address, for the first word).
+        Reads which were not seen to complete in time are made again, as
+        for readBlockChunks.
+        """
+        addrs  = sorted(addrs)
+        values = {}
+        for pos in range(0, len(addrs), chunk):
+            part  = addrs[pos:pos + chunk]
+            frame = bytearray(pc.PROBE_CMD_AXIRDRC)
+            prev  = self.shadowAddr if self.shadowEnabled else None
+            for a in part:
+                new = pc.splitWord(a)
+                old = pc.splitWord(prev) if prev != None else (None,) * 4
+                for i in range(0, 4):
+                    if(new[i] != old[i]):
+                        frame += pc.WRAXA[i].code + new[i]
+                frame += FRAME_READ_WORD
+                prev   = (a + 4) & 0xFFFFFFFF
+            rsp = self.transactFrame(frame, 1 + READ_WORD_RSP * len(part))
+            self.shadowAddr = prev
+            self.shadowAE   = 1
+            data, good, idle = self.unpackReads(rsp)
+            self.redoReads(part, data, good, idle)
+            values.update((a, pc.joinWord(data[4*i:4*i+4]))
+                for i, a in enumerate(part))
+        return values
+
+    def writeBlock(self, addr, data, chunk=pc.BLOCK_WORDS):
+        """
+        Write data to consecutive 32-bit words starting at addr. data is a
+        bytes-like object holding little-endian words; a trailing partial
+        word is padded with zeros. As with readBlock, the address is set
+        once (or the current address used if addr is None). Each chunk of
+        words is one frame, and unless we are batching depth chunks go out
+        in each exchange.
 
-    def do_WRGPO0(self, value):
+        Every write is followed by a read of the write control register,
+        and words whose writes were not seen to complete in time (see
+        unpackWrites) are written again one at a time. With a reliability
+        layer installed which reads back writes, the whole block is read
+        back at the end as well (see __recheckBlock__), unless we are
+        batching.
+        """
+        if(addr == None):
+            addr = self.getAXIAddress()
+        else:
+            self.setAXIAddress(addr)
+
+        data  = memoryview(data).cast("B")
+        step  = 4 * chunk
+        if(self.batchDepth == 0):
+            step *= self.depth
+        # Full steps all reuse one frame.
+        frame = bytearray(writeFrame(step // 4))
+
+        for start in range(0, len(data), step):
+            part = data[start:start+step]
+            if(len(part) < step):
+                if(len(part) % 4 != 0):
+                    part = bytes(part) + bytes(4 - len(part) % 4)
+                frame = bytearray(writeFrame(len(part) // 4))
+            count = len(part) // 4
+            fillWriteFrame(frame, part)
+            rsp = self.transactFrame(frame, 1 + count)
+            self.__shadowGo__(1, count)
+            self.shadowWData = pc.joinWord(part[-4:])
+            good, idle = self.unpackWrites(rsp)
+            if(not all(good)):
+                end  = addr + start + 4 * count
+                idle = self.__settleRun__(end, idle)
+                self.redoWrites(range(addr + start, end, 4), part, good,
+                    idle)
+
+        if(self.reliable != None and self.reliable.verify and
+           self.batchDepth == 0):
+            self.__recheckBlock__(addr, data)
+
+    def __recheckBlock__(self, addr, data):
+        """
+        Read back the words written by writeBlock, and write again any
+        which differ, until they all match. A byte lost on the link can
+        send writes to words which the reliability layer had already
+        checked, and it only checks the words written by the commands it
+        replays. Words whose writes get an error response are left alone,
+        as they cannot be read back. Raises IOError if words still differ
+        after as many rounds as the layer makes replays.
+        """
+        data = bytes(data)
+        if(len(data) % 4 != 0):
+            data += bytes(4 - len(data) % 4)
+        nwords = len(data) // 4
+        check  = set(range(0, nwords))
+        rounds = self.reliable.retries + 1
+        for attempt in range(0, rounds + 1):
+            got = self.readBlock(addr, nwords)
+            bad = [i for i in sorted(check) if
+                   got[4*i:4*i+4] != data[4*i:4*i+4]]
+            if(len(bad) == 0):
+                return
+            if(attempt == rounds):
+                break
+            self.shadowWData = None
+            for i in bad:
+                self.setAXIAddress((addr + 4 * i) & 0xFFFFFFFF)
+                self.setAXIWriteData(pc.WORD.unpack_from(data, 4 * i)[0])
+                if(self.doWrite(1, wait=True) >= pc.AXI_RESP_SLVERR):
+                    check.discard(i)
+            self.setAXIAddress((addr + 4 * nwords) & 0xFFFFFFFF)
+        raise IOError("%d words written from 0x%08x still differ after %d "
+            "rounds of writing them again" % (len(bad), addr, rounds))
+
+    def readBlockToFile(self, fh, addr, nwords, chunk=pc.BLOCK_WORDS):
+        """
+        Stream nwords words starting at addr into the binary file object
+        fh, from its current position. Regular files opened for reading and
+        writing are extended to their final size up front and filled in
+        place through a memory map, one window at a time. Other files are
+        written one chunk at a time. Either way memory use does not grow
+        with nwords.
+        """
+        if(not __mappable__(fh, write=True)):
+            for part in self.readBlockChunks(addr, nwords, chunk):
+                fh.write(part)
+            return
+
+        fh.flush()
+        start = fh.tell()
+        size  = 4 * nwords
+        if(os.fstat(fh.fileno()).st_size < start + size):
+            os.ftruncate(fh.fileno(), start + size)
+        for view in __mapWindows__(fh, start, size, mmap.ACCESS_WRITE):
+            self.readBlockInto(addr, view, chunk)
+            addr = None
+        fh.seek(start + size)
+
+    def writeBlockFromFile(self, fh, addr, nwords=None, chunk=pc.BLOCK_WORDS):
+        """
+        Stream the contents of the binary file object fh, from its current
+        position, into memory starting at addr. At most nwords words are
+        written, or the whole file if nwords is None. Regular files are
+        read through a memory map one window at a time; other files are
+        read a chunk at a time into one reused buffer. Returns the number
+        of words written.
+        """
+        if(__mappable__(fh)):
+            start = fh.tell()
+            size  = os.fstat(fh.fileno()).st_size - start
+            if(nwords != None):
+                size = min(size, 4 * nwords)
+            for view in __mapWindows__(fh, start, max(size, 0),
+                                       mmap.ACCESS_READ):
+                self.writeBlock(addr, view, chunk)
+                addr = None
+            fh.seek(start + max(size, 0))
+            return (max(size, 0) + 3) // 4
+
+        buf     = memoryview(bytearray(4 * chunk))
+        written = 0
+        while(nwords == None or written < nwords):
+            count = chunk
+            if(nwords != None):
+                count = min(chunk, nwords - written)
+            got = fh.readinto(buf[:4 * count])
+            if(not got):
+                break
+            self.writeBlock(addr, buf[:got], chunk)
+            addr     = None
+            written += (got + 3) // 4
+        return written
+
+    def getGPIBit(self, bit):
         """
-        Perform the command '' and return the result.
+        Return the value of a single bit from the GPIs
         """
-        return None
-
-    def do_WRGPO1(self, value):
+        return (self.readGPI32(1 << bit) >> bit) & 1
+    
+    def getGPOBit(self, bit):
         """
-        Perform the command '' and return the result.
+        Return the value of a single bit from the GPOs
         """
-        return None
-
-    def do_WRGPO2(self, value):
+        return (self.readGPO32(1 << bit) >> bit) & 1
+    
+    def setGPOBit(self, bit, value):
         """
-        Perform the command '' and return the result.
+        Set a single bit of the GPOs to value, leaving the others alone.
+        The bank is only written if the bit actually changes.
         """
-        return None
+        self.writeGPO32((1 if value else 0) << bit, 1 << bit)
 
-    def do_WRGPO3(self, value):
+    def readGPI32(self, mask=0xFFFFFFFF):
         """
-        Perform the command '' and return the result.
+        Return the GPIs as a 32-bit int. Only the banks with bits set in
+        mask are read, in one frame, and the other bits read as 0.
         """
-        return None
+        banks = pc.maskBanks(mask)
+        if(len(banks) == 0):
+            return 0
+        rsp   = self.transactFrame(b"".join(pc.RDGPI[b].code for b in banks),
+            len(banks))
+        return pc.joinBanks(banks, rsp) & mask
 
-    def do_RDAXA0(self):
+    def readGPO32(self, mask=0xFFFFFFFF):
         """
-        Perform the command '' and return the result.
+        Return the GPOs as a 32-bit int. Only the banks with bits set in
+        mask, and not already known from the shadow registers, are read, in
+        one frame. The other bits read as 0.
         """
-        return None
+        banks = pc.maskBanks(mask)
+        old   = self.__gpoBanks__(banks)
+        return pc.joinBanks(banks, [old[b] for b in banks]) & mask
+
+    def waitGPI(self, mask, value, timeout=None, depth=pc.GPI_WAIT_DEPTH):
+        """
+        Wait until the GPIs in mask equal the matching bits of value.
+        Returns the monotonic time in nanoseconds at which the first sample
+        showing them so arrived, and the GPIs it read (as readGPI32(mask)
+        would return them). If they already match, the first sample is
+        returned. Raises TimeoutError if they do not match within timeout
+        seconds (by default waitTimeout).
+        """
+        value &= mask
+        return self.__waitGPI__(mask, timeout, depth,
+            lambda last, now: now == value,
+            "GPIs 0x%08x did not become 0x%08x" % (mask, value))
 
-    def do_RDAXA1(self):
+    def waitGPIRise(self, mask, timeout=None, depth=pc.GPI_WAIT_DEPTH):
         """
-        Perform the command '' and return the result.
+        Wait for any GPI in mask to go from 0 to 1, and return as waitGPI
+        does for the first sample showing it. Inputs already at 1 when the
+        wait starts have to fall and rise again.
         """
-        return None
+        return self.__waitGPI__(mask, timeout, depth,
+            lambda last, now: last != None and (~last & now) != 0,
+            "No GPI in 0x%08x rose" % mask)
 
-    def do_RDAXA2(self):
+    def waitGPIFall(self, mask, timeout=None, depth=pc.GPI_WAIT_DEPTH):
         """
-        Perform the command '' and return the result.
+        Wait for any GPI in mask to go from 1 to 0, and return as waitGPI
+        does for the first sample showing it.
         """
-        return None
+        return self.__waitGPI__(mask, timeout, depth,
+            lambda last, now: last != None and (last & ~now) != 0,
+            "No GPI in 0x%08x fell" % mask)
 
-    def do_RDAXA3(self):
+    def waitGPIChange(self, mask, timeout=None, depth=pc.GPI_WAIT_DEPTH):
         """
-        Perform the command '' and return the result.
+        Wait for any GPI in mask to change, and return as waitGPI does for
+        the first sample showing it.
         """
-        return None
+        return self.__waitGPI__(mask, timeout, depth,
+            lambda last, now: last != None and now != last,
+            "No GPI in 0x%08x changed" % mask)
 
-    def do_WRAXA0(self, value):
+    def __waitGPI__(self, mask, timeout, depth, test, what):
+        """
+        Read the GPI banks covered by mask back to back, with depth reads in
+        flight (see stream), until test(last, now) holds for the masked
+        values of the previous and latest samples. last is None for the
+        first. Returns the time the matching sample arrived and its value.
+        The inputs are sampled every few byte times, so a change is seen
+        within one sample of it happening, but pulses shorter than that may
+        be missed.
+        """
+        if(timeout == None):
+            timeout = self.waitTimeout
+        banks = pc.maskBanks(mask)
+        if(len(banks) == 0):
+            raise ValueError("No GPIs selected by mask 0x%08x" % mask)
+        frame    = b"".join(pc.RDGPI[b].code for b in banks)
+        deadline = time.monotonic_ns() + int(timeout * 1e9)
+        last     = None
+        stream   = self.stream(frame, len(banks), depth)
+        try:
+            for stamp, data in stream:
+                now = pc.joinBanks(banks, data) & mask
+                if(test(last, now)):
+                    return stamp, now
+                if(stamp >= deadline):
+                    raise TimeoutError("%s within %gs" % (what, timeout))
+                last = now
+        finally:
+            stream.close()
+
+    def writeGPO32(self, value, mask=0xFFFFFFFF):
         """
-        Perform the command '' and return the result.
+        Set the GPOs in mask to the matching bits of value, leaving the
+        others alone. Banks only partly covered by mask are read first (all
+        in one frame) unless the shadow registers know them, and then only
+        the banks whose value changes are written, in one frame. Returns
+        the number of banks written.
         """
-        return None
+        banks   = pc.maskBanks(mask)
+        partial = [b for b in banks if (mask >> (8 * b)) & 0xFF != 0xFF]
+        return self.__writeGPO__(value, mask, self.__gpoBanks__(partial))
 
-    def do_WRAXA1(self, value):
+    def setGPOBits(self, mask):
         """
-        Perform the command '' and return the result.
+        Set every GPO in mask to 1. Returns the number of banks written.
         """
-        return None
+        return self.writeGPO32(0xFFFFFFFF, mask)
 
-    def do_WRAXA2(self, value):
+    def clearGPOBits(self, mask):
         """
-        Perform the command '' and return the result.
+        Clear every GPO in mask to 0. Returns the number of banks written.
         """
-        return None
+        return self.writeGPO32(0, mask)
 
-    def do_WRAXA3(self, value):
+    def toggleGPOBits(self, mask):
         """
-        Perform the command '' and return the result.
+        Invert every GPO in mask, reading the banks concerned first unless
+        the shadow registers know them. Returns the number of banks written.
         """
-        return None
+        banks = pc.maskBanks(mask)
+        old   = self.__gpoBanks__(banks)
+        value = pc.joinBanks(banks, [old[b] for b in banks]) ^ 0xFFFFFFFF
+        return self.__writeGPO__(value, mask, old)
+
+    def __gpoBanks__(self, banks):
+        """
+        Return the current values of the GPO banks listed in banks, as a
+        list indexed by bank holding None for the others. Banks known from
+        the shadow registers are not read, and the rest are read in one
+        frame.
+        """
+        old  = [None, None, None, None]
+        need = []
+        for b in banks:
+            if(self.shadowEnabled and self.shadowGPO[b] != None):
+                old[b] = self.shadowGPO[b]
+            else:
+                need.append(b)
+        if(len(need) > 0):
+            rsp = self.transactFrame(b"".join(pc.RDGPO[b].code for b in need),
+                len(need))
+            for b, v in zip(need, rsp):
+                old[b]            = v
+                self.shadowGPO[b] = v
+        return old
 
-    def do_AXIRB0 (self):
+    def __writeGPO__(self, value, mask, old):
+        """
+        Write the GPOs in mask with the matching bits of value, in one
+        frame. old holds the current values of the banks, indexed by bank,
+        and must be known for every bank mask only partly covers. Banks
+        which would not change are skipped. Returns the number written.
+        """
+        frame = []
+        for b in pc.maskBanks(mask):
+            m   = (mask  >> (8 * b)) & 0xFF
+            v   = (value >> (8 * b)) & 0xFF
+            cur = old[b]
+            if(cur == None and self.shadowEnabled):
+                cur = self.shadowGPO[b]
+            new = v if m == 0xFF else (cur & ~m) | (v & m)
+            if(new == cur):
+                continue
+            frame.append((pc.WRGPO[b], pc.BYTE[new]))
+            self.shadowGPO[b] = new
+        if(len(frame) > 0):
+            self.transactMany(frame)
+        return len(frame)
+    
+    def getGPOByte(self, idx):
         """
-        Perform the command '' and return the result.
+        Return the gpO byte addressed by idx.
         """
-        return None
+        if(self.shadowEnabled and self.shadowGPO[idx] != None):
+            return pc.BYTE[self.shadowGPO[idx]]
 
-    def do_AXIRB1 (self):
+        val = self.transact(pc.RDGPO[idx])
+        if(val):
+            self.shadowGPO[idx] = val[0]
+        return val
+
+    def setGPOByte(self, idx, val):
         """
-        Perform the command '' and return the result.
+        Return the gpO byte addressed by idx.
         """
-        return None
+        if(self.shadowEnabled and self.shadowGPO[idx] == val[0]):
+            return None
+        self.shadowGPO[idx] = val[0]
+        return self.transact(pc.WRGPO[idx], val)
 
-    def do_AXIRB2 (self):
+    def getGPIByte(self, idx):
         """
-        Perform the command '' and return the result.
+        Return the gpi byte addressed by idx.
         """
-        return None
+        return self.transact(pc.RDGPI[idx])
 
-    def do_AXIRB3 (self):
+    def getBit(self, biti, bval):
         """
-        Perform the command '' and return the result.
+        Return a single bit of a byte
         """
-        return None
+        return (bval[0] >> biti) & 1
+
+    # -----------------------------------------------------------------------
+    # Command transport. Every command goes through transact, either on its
+    # own or as part of a frame, and from there to exchange.
+    # -----------------------------------------------------------------------
+
+    def transact(self, cmd, payload=b""):
+        """
+        Perform a single command, given as an entry of pc.PROBE_COMMANDS
+        or its name, with its operand bytes in payload. Returns the
+        response bytes, or None if the command has no response or we are
+        batching.
+        """
+        if(type(cmd) == str):
+            cmd = pc.COMMANDS[cmd]
+        assert(len(payload) == cmd.operands)
+        if(self.batchDepth > 0):
+            self.txbuf    += cmd.code
+            self.txbuf    += payload
+            self.rxexpect += cmd.response
+            return None
+        rsp = self.exchange(cmd.code + payload, cmd.response)
+        if(cmd.response == 0):
+            return None
+        return rsp
+
+    def encode(self, cmds):
+        """
+        Encode a sequence of commands into one frame. Each entry is either
+        a command, or a (command, payload) pair for commands with operands.
+        Returns the frame and the number of response bytes it will produce.
+        """
+        size = 0
+        nrsp = 0
+        for c in cmds:
+            if(type(c) == pc.ProbeCommand):
+                size += 1
+                nrsp += c.response
+            else:
+                size += 1 + len(c[1])
+                nrsp += c[0].response
+
+        frame = bytearray(size)
+        i     = 0
+        for c in cmds:
+            if(type(c) == pc.ProbeCommand):
+                frame[i] = c.opcode
+                i       += 1
+            else:
+                cmd, payload = c
+                assert(len(payload) == cmd.operands)
+                frame[i] = cmd.opcode
+                frame[i+1:i+1+len(payload)] = payload
+                i       += 1 + len(payload)
+        return frame, nrsp
 
-    def do_AXIWB0 (self, value):
+    def transactMany(self, cmds):
         """
-        Perform the command '' and return the result.
+        Perform a sequence of commands (see encode) as a single frame, and
+        return all of their response bytes together.
         """
-        return None
+        frame, nrsp = self.encode(cmds)
+        return self.transactFrame(frame, nrsp)
 
-    def do_AXIWB1 (self, value):
+    def transactFrame(self, frame, nrsp):
         """
-        Perform the command '' and return the result.
+        Send an already encoded frame of commands which produce nrsp
+        response bytes, and return those bytes. Inside a batch the frame is
+        queued, and the responses are only waited for if there are any.
         """
-        return None
+        self.beginBatch()
+        self.txbuf    += frame
+        self.rxexpect += nrsp
+        return self.endBatch()
 
-    def do_AXIWB2 (self, value):
+    def stream(self, frame, nrsp, depth=64, count=None):
+        """
+        Send frame over and over, yielding the monotonic time in nanoseconds
+        at which each response arrived and the nrsp response bytes. Up to
+        depth copies of the frame are kept in flight where the interface
+        can manage it, so the link is never left idle waiting for the
+        probe. If count is given the frame is sent that many times, and
+        the stream ends once every response is in. Closing the generator
+        early collects the responses still on their way back. This version
+        has one frame in flight at a time.
+        """
+        assert(self.batchDepth == 0)
+        sent = 0
+        while(count == None or sent < count):
+            data = self.exchange(frame, nrsp)
+            sent += 1
+            if(data == None or len(data) != nrsp):
+                raise IOError("Expected %d response bytes from probe, got %d"
+                    % (nrsp, 0 if data == None else len(data)))
+            yield time.monotonic_ns(), data
+
+    def beginBatch(self):
         """
-        Perform the command '' and return the result.
+        Start queueing commands rather than sending them one at a time.
+        Batches may be nested: only the outermost endBatch flushes
+        write-only commands to the probe.
         """
-        return None
+        self.batchStart.append(self.rxexpect)
+        self.batchDepth += 1
 
-    def do_AXIWB3 (self, value):
+    def endBatch(self):
         """
-        Perform the command '' and return the result.
+        Finish the innermost batch and return the response bytes expected
+        by the commands issued inside it, in the order they were issued.
+        Reads force a flush even for nested batches, and the bytes returned
+        here are not seen again by any enclosing batch.
         """
-        return None
+        assert(self.batchDepth > 0)
+        start = self.batchStart.pop()
+        self.batchDepth -= 1
+
+        if(self.batchDepth == 0 or self.rxexpect > start):
+            self.flush()
+
+        rsp = bytes(self.rxbuf[start:])
+        del self.rxbuf[start:]
+        self.rxexpect = start
+        return rsp
 
-    def do_AXIRDRC(self):
+    def flush(self):
+        """
+        Send all queued commands to the probe in one exchange, and collect
+        every outstanding response byte.
+        """
+        need = self.rxexpect - len(self.rxbuf)
+        if(len(self.txbuf) == 0 and need <= 0):
+            return
+        frame      = bytes(self.txbuf)
+        self.txbuf = bytearray()
+        data       = self.exchange(frame, need)
+        if(data == None or len(data) != need):
+            raise IOError("Expected %d response bytes from probe, got %d"
+                % (need, 0 if data == None else len(data)))
+        self.rxbuf += data
+    
+    # -----------------------------------------------------------------------
+    # It is expected that functions below this point are overriden. They are
+    # deliberately left as stubs.
+    # -----------------------------------------------------------------------
+    
+    def connected(self):
         """
-        Perform the command '' and return the result.
+        Have we successfully opened a connection to the probe
         """
-        return None
+        return True
 
-    def do_AXIWRRC(self, value):
+    def close(self):
         """
-        Perform the command '' and return the result.
+        Close the connection to the probe.
         """
         return None
 
-    def do_AXIRDWC(self):
+    def exchange(self, frame, nrsp):
         """
-        Perform the command '' and return the result.
+        Send the bytes in frame to the probe, then wait for and return the
+        nrsp bytes it sends back. This is the only function an interface
+        needs to implement to carry commands.
         """
         return None
 
-    def do_AXIWRWC(self, value):
+    def discard(self):
         """
-        Perform the command '' and return the result.
+        Wait for any response bytes still on their way back from the probe,
+        and throw them away. Used to get back in step with the probe (see
+        ProbeReliable).
         """
         return None
 
 
+def __commandFunction__(cmd):
+    """
+    Build the do_<name> function which performs cmd.
+    """
+    if(cmd.operands == 0):
+        def do(self):
+            return self.transact(cmd)
+    else:
+        def do(self, value):
+            assert(len(value) == 1)
+            assert(type(value) == bytes)
+            return self.transact(cmd, value)
+    do.__name__ = "do_" + cmd.name
+    do.__doc__  = """
+        Perform the command '%s' and return the result.
+        """ % cmd.name
+    return do
+
+for cmd in pc.PROBE_COMMANDS:
+    setattr(ProbeInterface, "do_" + cmd.name, __commandFunction__(cmd))
+
+def __mappable__(fh, write=False):
+    """
+    Can the file object fh be memory mapped? Only regular files can, and
+    mapping for writing needs a file opened for reading as well.
+    """
+    try:
+        if(write and not fh.readable()):
+            return False
+        return stat.S_ISREG(os.fstat(fh.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        return False
+
+def __mapWindows__(fh, start, length, access):
+    """
+    Map length bytes of fh from offset start, pc.MAP_WINDOW bytes at a
+    time, yielding a memoryview of each window. Each window is unmapped
+    before the next is mapped.
+    """
+    gran = mmap.ALLOCATIONGRANULARITY
+    for offset in range(0, length, pc.MAP_WINDOW):
+        pos  = start + offset
+        base = pos - pos % gran
+        size = min(pc.MAP_WINDOW, length - offset)
+        mm   = mmap.mmap(fh.fileno(), pos - base + size, access=access,
+            offset=base)
+        view = memoryview(mm)[pos-base:pos-base+size]
+        try:
+            yield view
+        finally:
+            view.release()
+            mm.close()
+
+#
+# Frames used by the helper functions, encoded once.
+#
+FRAME_RDAXA      = b"".join(c.code for c in pc.RDAXA)
+FRAME_AXIRB      = b"".join(c.code for c in pc.AXIRB)
+FRAME_RDRC_AXIRB = pc.PROBE_CMD_AXIRDRC + FRAME_AXIRB
+
+#
+# Bulk transfers send one of these per word. Each starts a transaction and
+# then reads its control register back (followed, for reads, by the data),
+# to check it had finished in time. Frames of them start by reading the
+# control register once, to clear a valid bit left from before (see
+# readFrame and writeFrame).
+#
+FRAME_READ_WORD  = pc.PROBE_CMD_AXIWRRC + pc.csrByte(1, 1) + \
+                   pc.PROBE_CMD_AXIRDRC + FRAME_AXIRB
+FRAME_WRITE_WORD = b"".join(c.code + b"\x00" for c in pc.AXIWB) + \
+                   pc.PROBE_CMD_AXIWRWC + pc.csrByte(1, 1) + \
+                   pc.PROBE_CMD_AXIRDWC
+READ_WORD_RSP    = 5
+WRITE_WORD_RSP   = 1
+
+def readFrame(nwords):
+    """
+    Return the frame which reads nwords consecutive words, producing
+    1 + READ_WORD_RSP * nwords response bytes.
+    """
+    return pc.PROBE_CMD_AXIRDRC + FRAME_READ_WORD * nwords
+
+
+def writeFrame(nwords):
+    """
+    Return the frame which writes nwords consecutive words, producing
+    1 + WRITE_WORD_RSP * nwords response bytes, with the write data left
+    as zeros.
+    """
+    return pc.PROBE_CMD_AXIRDWC + FRAME_WRITE_WORD * nwords
+
+
+def fillWriteFrame(frame, data):
+    """
+    Drop the little-endian words in data in to frame, a bytearray holding
+    a writeFrame for as many words, and return it. Each word is a copy of
+    FRAME_WRITE_WORD with its four data bytes in the operand slots.
+    """
+    wlen = len(FRAME_WRITE_WORD)
+    for i in range(0, 4):
+        frame[2*i+2::wlen] = data[i::4]
+    return frame
+
+
+def unpackReads(rsp, idle=True):
+    """
+    Split the responses to a frame built by readFrame into the data read,
+    as a bytearray of little-endian words, and a list saying which of the
+    words can be trusted. idle says whether the read channel was idle
+    before the frame. Also returns whether it is idle after: True, False,
+    or None if that cannot be told.
+
+    The probe ignores a go while a transaction of the same kind is
+    outstanding, and the valid bit only says that some transaction has
+    finished since the control register was last read. So a read is only
+    trusted if it had finished when its control register was read and
+    every read before it was trusted too. After the first which was not,
+    the valid bits seen may belong to the reads before.
+    """
+    count = (len(rsp) - 1) // READ_WORD_RSP
+    data  = bytearray(4 * count)
+    for i in range(0, 4):
+        data[i::4] = rsp[2+i::READ_WORD_RSP]
+    good, idle = trustStatus(bytes(rsp[0:1]) + bytes(rsp[1::READ_WORD_RSP]),
+        pc.AXI_CTRL_RV, idle)
+    return data, good, idle
+
+
+def unpackWrites(rsp, idle=True):
+    """
+    Given the responses to a frame built by writeFrame, return a list
+    saying which of its writes can be trusted, and whether the write
+    channel is idle after it, as for unpackReads. The write data register
+    feeds the bus directly, so an untrusted write may also have had its
+    data changed under it.
+    """
+    return trustStatus(rsp, pc.AXI_CTRL_WV, idle)
+
+
+def trustStatus(status, mask, idle):
+    """
+    Work out which transactions to trust from the control register values
+    read before the first (clearing any valid bit left over) and after
+    each. See unpackReads.
+    """
+    trusted = idle or (status[0] & mask) != 0
+    good    = []
+    for csr in status[1:]:
+        trusted = trusted and (csr & mask) != 0
+        good.append(trusted)
+    if(trusted):
+        return good, True
+    if(len(status) > 1 and not status[-1] & mask):
+        return good, False
+    return good, None
@@ -0,0 +1,339 @@
+#!/usr/bin/python3
+
+"""
+Characterise the serial link to a probe: whether it works at a baud rate,
+the round trip latency, the usable throughput and how far the host can run
+ahead of the responses. The best settings found are remembered for each
+port, so later sessions start tuned without measuring again.
+"""
+
+import os
+import sys
+import time
+
+import ProbeCommon as pc
+import ProbeInterface as pi
+
+#
+# File, under pc.CACHE_DIR, holding the settings chosen for each port.
+#
+LINK_FILE   = "links.json"
+
+class ProbeLink(object):
+    """
+    Measures the link to a probe opened with ProbeIfSerial (or anything
+    else with a pyserial-like port attribute). Only the low byte of the
+    AXI address register is used to carry test patterns, as writing it has
+    no effect outside the probe. The address is put back afterwards.
+    """
+
+    def __init__(self, probe, samples=50, maxDepth=1024):
+        """
+        Measure probe, which should already be open. samples round trips
+        are timed for the latency figures, and pipelines of up to maxDepth
+        write-then-read pairs are tried.
+        """
+        self.probe    = probe
+        self.samples  = samples
+        self.maxDepth = maxDepth
+
+    def __pattern__(self, n):
+        """
+        Return a frame of n write-then-read pairs on the low address byte,
+        and the n response bytes it should produce.
+        """
+        values = bytes((0x5A + 37 * i) & 0xFF for i in range(0, n))
+        frame  = bytearray(3 * n)
+        frame[0::3] = pc.PROBE_CMD_WRAXA0 * n
+        frame[1::3] = values
+        frame[2::3] = pc.PROBE_CMD_RDAXA0 * n
+        return bytes(frame), values
+
+    def resync(self):
+        """
+        Let anything still in flight arrive, and throw it away.
+        """
+        self.probe.discard()
+
+    def __exchange__(self, frame, nrsp):
+        """
+        Exchange a frame with the probe, with the read timeout stretched to
+        cover sending it. Returns None if the exchange failed.
+        """
+        port    = self.probe.port
+        timeout = port.timeout
+        if(timeout != None):
+            port.timeout = timeout + 2 * len(frame) * 10.0 / port.baudrate
+        try:
+            return self.probe.exchange(frame, nrsp)
+        except Exception:
+            return None
+        finally:
+            port.timeout = timeout
+
+    def check(self, n=16):
+        """
+        Does the probe answer n write-then-read pairs, sent in one go,
+        correctly?
+        """
+        frame, want = self.__pattern__(n)
+        return self.__exchange__(frame, n) == want
+
+    def latency(self):
+        """
+        Time single byte round trips. Returns the sorted round trip times in
+        seconds.
+        """
+        times = []
+        for i in range(0, self.samples):
+            start = time.perf_counter()
+            self.probe.exchange(pc.PROBE_CMD_RDAXA0, 1)
+            times.append(time.perf_counter() - start)
+        return sorted(times)
+
+    def throughput(self, nbytes=4096):
+        """
+        Send nbytes of write-only commands followed by one read, and return
+        the number of bytes per second the link carried, or 0 if the
+        response never came.
+        """
+        n     = nbytes // 2
+        frame = (pc.PROBE_CMD_WRAXA0 + b"\x00") * n + pc.PROBE_CMD_RDAXA0
+        start = time.perf_counter()
+        if(self.__exchange__(frame, 1) != b"\x00"):
+            self.resync()
+            return 0
+        return len(frame) / (time.perf_counter() - start)
+
+    def depth(self):
+        """
+        Find the largest number of write-then-read pairs, up to maxDepth,
+        which can be sent in one go without any of their responses going
+        missing or coming back wrong. Returns the number of command bytes
+        that many pairs take, which is how far ahead of its responses the
+        host can safely run, or 0 if even 16 pairs fail. The probe answers
+        each command as it arrives, so this measures the buffering of the
+        host, driver and adapter, not a queue in the probe.
+        """
+        good = 0
+        n    = 16
+        while(n <= self.maxDepth):
+            if(not self.check(n)):
+                self.resync()
+                break
+            good = n
+            n   *= 2
+        return 3 * good
+
+    def measure(self):
+        """
+        Measure the link at its current baud rate. Returns a dictionary of
+        results, or None if the probe does not answer properly.
+        """
+        if(not self.check()):
+            self.resync()
+            return None
+        times = self.latency()
+        return {
+            "baud"       : self.probe.port.baudrate,
+            "rtt"        : times[len(times) // 2],
+            "rtt_p99"    : times[min(len(times) - 1, len(times) * 99 // 100)],
+            "throughput" : self.throughput(),
+            "window"     : self.depth(),
+        }
+
+    def characterise(self, bauds=None, report=None):
+        """
+        Measure the link at each baud rate in turn, or only at the rate the
+        port is open at if bauds is None. report, if given, is
+        called with the baud rate and the results (or None) of each. Returns
+        the settings to use (see settings) for the baud rate with the
+        highest throughput, or None if the probe answered at none of them.
+        The port is left at the chosen rate, or where it started.
+
+        Bytes sent at a baud rate the probe is not running at reach it as
+        arbitrary commands, which may change its outputs, so only list
+        rates which are safe to try on the board at hand.
+        """
+        port    = self.probe.port
+        start   = (port.baudrate, port.timeout)
+        if(bauds == None):
+            bauds = [port.baudrate]
+        best    = None
+        addr    = None
+        # The test patterns are meant to go wrong at some rates, so must not
+        # be checked and replayed by a reliability layer.
+        reliable = self.probe.reliable
+        self.probe.setReliable(None)
+        try:
+            for baud in bauds:
+                port.baudrate = baud
+                port.timeout  = 0.05 + 64 * 10.0 / baud
+                self.resync()
+                if(addr == None):
+                    # Read the address before the test patterns clobber it,
+                    # but only trust it once the probe is seen to answer.
+                    data = self.__exchange__(pi.FRAME_RDAXA, 4)
+                    if(data != None and len(data) == 4 and self.check()):
+                        addr = pc.joinWord(data)
+                result = self.measure()
+                if(report != None):
+                    report(baud, result)
+                if(result != None and result["window"] > 0 and (best == None
+                   or result["throughput"] > best["throughput"])):
+                    best = result
+        finally:
+            port.baudrate, port.timeout = start
+            if(best != None):
+                apply(self.probe, settings(best))
+            self.probe.setReliable(reliable)
+            if(addr != None):
+                self.probe.invalidateShadow()
+                self.probe.setAXIAddress(addr)
+        return None if best == None else settings(best)
+
+
+def settings(result):
+    """
+    Turn the results of ProbeLink.measure into the settings to open the
+    port with: the baud rate, a read timeout which allows for the slowest
+    round trip seen plus the largest bulk response, and the number of bulk
+    transfer frames to keep in flight.
+    """
+    frame   = len(pi.FRAME_READ_WORD) * pc.BLOCK_WORDS
+    rsp     = pi.READ_WORD_RSP * pc.BLOCK_WORDS * 10.0 / result["baud"]
+    tuned   = dict(result)
+    tuned["timeout"] = round(max(0.05, 4 * result["rtt_p99"] + 2 * rsp), 3)
+    tuned["depth"]   = max(1, result["window"] // frame)
+    return tuned
+
+
+def defaultTimeout(baud, depth=pc.BLOCK_DEPTH):
+    """
+    Return the read timeout to open an untuned port with: long enough for
+    depth bulk transfer frames and their responses to cross the link twice
+    over at baud, plus an allowance for the adapter's own latency.
+    """
+    frame   = max(len(pi.FRAME_READ_WORD) + pi.READ_WORD_RSP,
+                  len(pi.FRAME_WRITE_WORD) + pi.WRITE_WORD_RSP)
+    return round(0.1 + 2 * depth * frame * pc.BLOCK_WORDS * 10.0 / baud, 3)
+
+
+def apply(probe, tuned):
+    """
+    Configure an open probe with settings chosen by ProbeLink.
+    """
+    probe.port.baudrate = tuned["baud"]
+    probe.port.timeout  = tuned["timeout"]
+    probe.depth         = tuned["depth"]
+
+
+def linkKey(portname):
+    """
+    Return the name the settings for portname are filed under. Symbolic
+    links are not followed, so ports opened by a stable name such as those
+    under /dev/serial/by-id keep their settings wherever the board is
+    plugged in.
+    """
+    return os.path.abspath(portname)
+
+
+def boardId(portname):
+    """
+    Return the serial number of the USB adapter behind portname, or None if
+    it cannot be found.
+    """
+    try:
+        from serial.tools import list_ports
+    except ImportError:
+        return None
+    real = os.path.realpath(portname)
+    for info in list_ports.comports():
+        if(os.path.realpath(info.device) == real):
+            return info.serial_number
+    return None
+
+
+def sameBoard(portname, tuned):
+    """
+    Is the board behind portname the one the settings in tuned were
+    measured with? Settings saved without a board are trusted, but not
+    when the board they were saved with can no longer be identified.
+    """
+    saved = tuned.get("board")
+    return saved == None or saved == boardId(portname)
+
+
+def loadLinks(path=None):
+    """
+    Return the settings saved for every port, keyed by linkKey.
+    """
+    import json
+    if(path == None):
+        path = os.path.join(pc.CACHE_DIR, LINK_FILE)
+    if(not os.path.exists(path)):
+        return {}
+    with open(path, "r") as fh:
+        return json.load(fh)
+
+
+def saveLink(portname, tuned, path=None):
+    """
+    Save the settings for portname, or forget them if tuned is None.
+    """
+    import json
+    if(path == None):
+        path = os.path.join(pc.CACHE_DIR, LINK_FILE)
+    links = loadLinks(path)
+    if(tuned == None):
+        links.pop(linkKey(portname), None)
+    else:
+        links[linkKey(portname)] = tuned
+    folder = os.path.dirname(path)
+    if(folder != "" and not os.path.isdir(folder)):
+        os.makedirs(folder)
+    with open(path + ".tmp", "w") as fh:
+        json.dump(links, fh, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def tunedLink(portname, path=None):
+    """
+    Return the settings saved for portname, or None.
+    """
+    try:
+        return loadLinks(path).get(linkKey(portname))
+    except (OSError, ValueError):
+        return None
+
+
+def printLink(portname, tuned):
+    """
+    Print the settings saved for a port.
+    """
+    print("%s%s" % (portname, "" if tuned.get("board") == None else
+        " (board %s)" % tuned["board"]))
+    print("  baud       %d" % tuned["baud"])
+    print("  rtt        %.3f ms (p99 %.3f ms)" % (1e3 * tuned["rtt"],
+        1e3 * tuned["rtt_p99"]))
+    print("  throughput %.0f bytes/s" % tuned["throughput"])
+    print("  run ahead  %d bytes" % tuned["window"])
+    print("  timeout    %g s" % tuned["timeout"])
+    print("  depth      %d bulk frames in flight" % tuned["depth"])
+
+
+def main():
+    """
+    Print the settings saved for every port.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.parse_args()
+
+    for key, tuned in sorted(loadLinks().items()):
+        printLink(key, tuned)
+    return 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())
@@ -6,14 +6,16 @@ Software to communicate with a simple UART Probe Module.
 
 import os
 import sys
-import random
+import time
 import argparse
 
-from   bitstring import BitArray
-
 import ProbeCommon as pc
-from   ProbeInterface import ProbeInterface
-from   ProbeIfSerial  import ProbeIfSerial
+
+#
+# Everything else is imported by the code which needs it, so that each
+# command only pays for loading what it uses. Scripts run this program
+# many times over to do a few bytes of work each, so start up time counts.
+#
 
 class ProbeProgram(object):
     """
@@ -26,25 +28,115 @@ class ProbeProgram(object):
         """
         parser = argparse.ArgumentParser(description=__doc__)
         
-        parser.add_argument("port", type=str,
-            help="The name of the TTY/COM port to connect to the probe over.")
-        parser.add_argument("--baud","-b", type=int, default=9600,
-            help="Baud rate of the serial port.")
+        # The port may only be left out when --ports or --socket is used.
+        # argparse cannot tell an optional port from the command name once
+        # other options come between them, so only make it optional then.
+        optport = any(a.startswith("--ports") or a.startswith("--socket")
+            for a in sys.argv[1:])
+        parser.add_argument("port", type=str, nargs="?" if optport else None,
+            help="The name of the TTY/COM port to connect to the probe over, "
+                 "or tcp://host:port for a probe behind a terminal server.")
+        parser.add_argument("--ports", type=str, action="append",
+            default=[], help="Run the command on every probe whose port "
+            "matches this (quoted) glob pattern or comma separated list, "
+            "in parallel. May be given more than once.")
+        parser.add_argument("--baud","-b", type=int, default=None,
+            help="Baud rate of the serial port. Defaults to the rate chosen "
+                 "by 'link --tune' for the port, or 9600.")
+        parser.add_argument("--daemon","-d", action="store_true",
+            help="Talk to the probe through the ProbeDaemon serving the "
+                 "port, rather than opening the port directly.")
+        parser.add_argument("--socket", type=str, default=None,
+            help="Talk to the ProbeDaemon listening on this socket.")
         parser.add_argument("--verbose","-v", action="store_true")
+        parser.add_argument("--trace", type=str, default=None,
+            help="Write a binary log of all bytes exchanged with the probe "
+                 "to this file. Decode it with ProbeTrace.py.")
+        parser.add_argument("--shadow", action="store_true",
+            help="Cache host-written probe registers to avoid reading "
+                 "them back.")
+        parser.add_argument("--reliable", action="store_true",
+            help="Check that responses stay in step with commands, and "
+                 "recover from bytes lost or garbled on the line.")
         
-        subparsers = parser.add_subparsers()
+        # Only the subparser for the command being run is given its
+        # arguments. The rest are left as stubs, which is all that is needed
+        # to pick out the command and list them in the help text.
+        commands = [
+            (pc.CMD_TRY_CONNECT, self.cmdTestOpen, None,
+                "Test a connection on the specified port"),
+            (pc.CMD_DEMO, self.cmdDemo, None,
+                "Run a demo script using the AXI master"),
+            (pc.CMD_FILE, self.cmdFile, self.__args_file__,
+                "Read and write files into & out of the probe"),
+            (pc.CMD_PRINT_REGISTERS, self.cmdPrintRegisters, None,
+                "Print probe register values"),
+            (pc.CMD_GPI, self.cmdGPI, self.__args_gpi__,
+                "Allows for reading of the general purpose inputs"),
+            (pc.CMD_GPO, self.cmdGPO, self.__args_gpo__,
+                "Allows control of the general purpose outputs"),
+            (pc.CMD_AXI, self.cmdAXI, self.__args_axi__,
+                "Read and write data via the AXI master bus interface of "
+                "the probe."),
+            (pc.CMD_RUN, self.cmdRun, self.__args_run__,
+                "Run a script of probe operations, printing the result of "
+                "each as a line of JSON."),
+            (pc.CMD_LOAD, self.cmdLoad, self.__args_load__,
+                "Load an Intel HEX, SREC or raw image into memory, writing "
+                "only the words which changed since the last load."),
+            (pc.CMD_LINK, self.cmdLink, self.__args_link__,
+                "Show, measure or forget the link settings remembered for "
+                "the port."),
+            (pc.CMD_WAVE, self.cmdWave, self.__args_wave__,
+                "Play a timed sequence of changes to the general purpose "
+                "outputs, and report the timing achieved."),
+        ]
+
+        subparsers = parser.add_subparsers(dest="command")
+        stubs      = {}
+        for name, func, build, description in commands:
+            sub = subparsers.add_parser(name, help=description,
+                description=description, add_help=False)
+            sub.set_defaults(func = func)
+            stubs[name] = (sub, build)
+
+        known, _ = parser.parse_known_args()
+        if(known.command in stubs):
+            sub, build = stubs[known.command]
+            sub.add_argument("--help","-h", action="help",
+                help="show this help message and exit")
+            if(build != None):
+                build(sub)
 
-        test_parser = subparsers.add_parser(pc.CMD_TRY_CONNECT)
-        test_parser.set_defaults(func = self.cmdTestOpen)
-        test_parser.description = "Test a connection on the specified port"
+        args = parser.parse_args()
 
-        demo_parser = subparsers.add_parser(pc.CMD_DEMO)
-        demo_parser.set_defaults(func = self.cmdDemo)
-        demo_parser.description = "Run a demo script using the AXI master"
+        if(not hasattr(args, "func")):
+            parser.error("a command is required")
         
-        file_parser = subparsers.add_parser(pc.CMD_FILE)
-        file_parser.set_defaults(func = self.cmdFile)
-        file_parser.description = "Read and write files into & out of the probe"
+        self.ports = []
+        if(args.port != None):
+            self.ports.append(args.port)
+        if(len(args.ports) > 0):
+            import glob
+        for pattern in args.ports:
+            for name in pattern.split(","):
+                self.ports += sorted(glob.glob(name)) or [name]
+        if(len(self.ports) == 0 and args.socket != None):
+            self.ports.append(args.socket)
+        if(len(self.ports) == 0):
+            parser.error("a port or --ports is required")
+
+        self.portname = self.ports[0]
+        self.baudrate = args.baud if args.baud != None else 9600
+        self.args = args
+        if(args.socket != None):
+            self.args.daemon = True
+
+
+    def __args_file__(self, file_parser):
+        """
+        Add the arguments of the file command.
+        """
         file_parser.add_argument("file", type=str,
             help="file to be read or written")
         file_parser.add_argument("--read", action="store_true",
@@ -53,25 +145,70 @@ class ProbeProgram(object):
             help="Write this file into this address")
         file_parser.add_argument("--address", type=str,
             help="Set the AXI address to this value before reading/writing")
-        file_parser.add_argument("--length", type=int, default=8,
-            help="How many words (4 bytes) to read or write?")
+        file_parser.add_argument("--length", type=int, default=None,
+            help="How many words (4 bytes) to read or write? Defaults to 8 "
+                 "words when reading and the whole file when writing.")
+        file_parser.add_argument("--verify", action="store_true",
+            help="Check memory against this file, after writing it if "
+                 "--write is given.")
+        self.__args_verify__(file_parser)
 
-        print_regs_parser = subparsers.add_parser(pc.CMD_PRINT_REGISTERS)
-        print_regs_parser.set_defaults(func = self.cmdPrintRegisters)
-        print_regs_parser.description = "Print probe register values"
 
-        gpi_parser = subparsers.add_parser(pc.CMD_GPI)
-        gpi_parser.set_defaults(func = self.cmdGPI)
-        gpi_parser.description = "Allows for reading of the general purpose inputs"
+    def __args_verify__(self, parser):
+        """
+        Add the arguments which control how memory is verified.
+        """
+        parser.add_argument("--every", type=int, default=None, metavar="N",
+            help="Only verify every Nth word.")
+        parser.add_argument("--sample", type=int, default=None, metavar="N",
+            help="Only verify N words picked at random.")
+        parser.add_argument("--keep-going", action="store_true",
+            help="Report every range which differs rather than stopping "
+                 "at the first.")
+
+
+    def __args_gpi__(self, gpi_parser):
+        """
+        Add the arguments of the gpi command.
+        """
         gpi_single = gpi_parser.add_mutually_exclusive_group(required=True)
         gpi_single.add_argument("--readbit", type=int,choices=range(0,32),
             help="Read an individual input and print its value")
         gpi_single.add_argument("--all", action="store_true",
             help="Print the values of all general purpose inputs.")
-
-        gpo_parser = subparsers.add_parser(pc.CMD_GPO)
-        gpo_parser.set_defaults(func = self.cmdGPO)
-        gpo_parser.description = "Allows control of the general purpose outputs"
+        gpi_single.add_argument("--capture", type=str, metavar="FILE",
+            help="Sample the inputs as fast as possible into this file, "
+                 "until stopped by --samples, --duration or Ctrl-C.")
+        gpi_single.add_argument("--wait", type=str, metavar="MASK",
+            help="Wait for the inputs in this hex mask to equal --value, or "
+                 "for an --edge on any of them, and print when it came.")
+        gpi_parser.add_argument("--value", type=str, default=None,
+            help="Hex value the inputs waited for should take.")
+        gpi_parser.add_argument("--edge", choices=["rise","fall","change"],
+            default=None, help="Kind of change to wait for.")
+        gpi_parser.add_argument("--timeout", type=float, default=10.0,
+            help="Seconds to wait before giving up.")
+        gpi_parser.add_argument("--format", choices=["bin","vcd"],
+            default=None, help="Capture file format. Defaults to vcd for "
+            "files ending .vcd and bin otherwise.")
+        gpi_parser.add_argument("--mask", type=str, default="ffffffff",
+            help="Hex mask of the inputs to capture. Only the banks it "
+                 "covers are read.")
+        gpi_parser.add_argument("--samples", type=int, default=None,
+            help="Stop capturing after this many samples.")
+        gpi_parser.add_argument("--duration", type=float, default=None,
+            help="Stop capturing after this many seconds.")
+        gpi_parser.add_argument("--changes", action="store_true",
+            help="Only store samples which differ from the one before.")
+        gpi_parser.add_argument("--depth", type=int, default=None,
+            help="Number of samples kept in flight on the link. Defaults to "
+                 "64 when capturing and %d when waiting." % pc.GPI_WAIT_DEPTH)
+
+
+    def __args_gpo__(self, gpo_parser):
+        """
+        Add the arguments of the gpo command.
+        """
         gpo_parser.add_argument("--readall", action="store_true",
             help="Print the values of all general purpose outputs.")
         gpo_parser.add_argument("--readbit", type=int,choices=range(0,32),
@@ -84,10 +221,22 @@ class ProbeProgram(object):
             help="Clear an individual output bit to 0")
         gpo_parser.add_argument("--clearall", action="store_true",
             help="Clear all general purpose outputs.")
-
-        axi_parser = subparsers.add_parser(pc.CMD_AXI)
-        axi_parser.set_defaults(func = self.cmdAXI)
-        axi_parser.description = "Read and write data via the AXI master bus interface of the probe."
+        gpo_parser.add_argument("--set", type=str, metavar="MASK",
+            help="Set the outputs in this hex mask to 1.")
+        gpo_parser.add_argument("--clear", type=str, metavar="MASK",
+            help="Clear the outputs in this hex mask to 0.")
+        gpo_parser.add_argument("--toggle", type=str, metavar="MASK",
+            help="Invert the outputs in this hex mask.")
+        gpo_parser.add_argument("--write", type=str, metavar="VALUE",
+            help="Write this hex value to the outputs in --mask.")
+        gpo_parser.add_argument("--mask", type=str, default="ffffffff",
+            help="Hex mask of the outputs --write changes.")
+
+
+    def __args_axi__(self, axi_parser):
+        """
+        Add the arguments of the axi command.
+        """
         axi_parser.add_argument("--set-address", type=str,
             help="Set the AXI address to any 32-bit value.")
         axi_parser.add_argument("--get-address", action="store_true",
@@ -101,51 +250,346 @@ class ProbeProgram(object):
         axi_parser.add_argument("--write", type=str,
             help="Perform an AXI write")
 
-        args = parser.parse_args()
-        
-        self.probe.verbose = args.verbose
-        self.portname = args.port
-        self.baudrate = args.baud
-        self.args = args
+
+    def __args_run__(self, run_parser):
+        """
+        Add the arguments of the run command.
+        """
+        run_parser.add_argument("script", type=str,
+            help="Script to run, or - to read it from stdin. See "
+                 "ProbeScript.py for the operations it may use.")
+        run_parser.add_argument("--max-frame", type=int, default=4096,
+            help="Largest number of bytes to send to the probe at once.")
+
+
+    def __args_load__(self, load_parser):
+        """
+        Add the arguments of the load command.
+        """
+        load_parser.add_argument("image", type=str,
+            help="Image file to load.")
+        load_parser.add_argument("--format", choices=["ihex","srec","raw"],
+            default=None, help="Image format. Guessed from the extension if "
+            "not given, with unknown extensions loaded as raw binary.")
+        load_parser.add_argument("--base", type=str, default="0",
+            help="Hex address to load a raw image at.")
+        load_parser.add_argument("--model", type=str, default=None,
+            help="File remembering what was last loaded through this "
+                 "probe. Defaults to one named after the port under "
+                 "~/.cache/verilog-probe.")
+        load_parser.add_argument("--check", type=int, default=0,
+            metavar="N", help="Read back N unchanged words first, and load "
+            "everything if any of them differ.")
+        load_parser.add_argument("--full", action="store_true",
+            help="Write every word of the image, whatever the model says.")
+        load_parser.add_argument("--verify", action="store_true",
+            help="Check every word of the image once it is loaded.")
+        self.__args_verify__(load_parser)
+
+
+    def __args_wave__(self, wave_parser):
+        """
+        Add the arguments of the wave command.
+        """
+        wave_parser.add_argument("wave", type=str,
+            help="Wave file of events to play. See ProbeWave.py.")
+        wave_parser.add_argument("--lead", type=float, default=0.01,
+            help="Seconds between working out the frames and playing "
+                 "the first.")
+        wave_parser.add_argument("--steps", action="store_true",
+            help="Print the frames each step sends.")
+
+
+    def __args_link__(self, link_parser):
+        """
+        Add the arguments of the link command.
+        """
+        link_parser.add_argument("--tune", action="store_true",
+            help="Measure the link at the port's baud rate, or each of "
+                 "--bauds, and remember the best settings for the port.")
+        link_parser.add_argument("--bauds", type=str, default=None,
+            help="Comma separated baud rates to try when tuning. Bytes "
+                 "sent at the wrong rate reach the probe as garbage "
+                 "commands, which can change its outputs and start AXI "
+                 "writes, so only list rates safe to try on your board.")
+        link_parser.add_argument("--forget", action="store_true",
+            help="Forget the settings remembered for the port.")
+
+
+    def __new_probe__(self, portname):
+        """
+        Create the interface used to talk to the probe on portname, and
+        apply the tracing, shadowing and reliability options to it. When
+        talking to several probes, each gets its own trace file, named
+        after its port, and is closed when main returns.
+        """
+        if(self.args.daemon):
+            from ProbeIfDaemon import ProbeIfDaemon
+            probe = ProbeIfDaemon()
+        elif(portname.startswith("tcp://")):
+            from ProbeIfSocket import ProbeIfSocket
+            probe = ProbeIfSocket()
+        else:
+            from ProbeIfSerial import ProbeIfSerial
+            probe = ProbeIfSerial()
+        if(self.args.verbose):
+            from ProbeTrace import ProbeTracePrint
+            probe.setTracer(ProbeTracePrint())
+        if(self.args.trace != None):
+            from ProbeTrace import ProbeTraceFile
+            path = self.args.trace
+            if(len(self.ports) > 1):
+                path = "%s.%s" % (path, os.path.basename(portname))
+            trace = ProbeTraceFile(open(path, "wb"))
+            self.traces.append(trace)
+            probe.setTracer(trace)
+        probe.enableShadow(self.args.shadow)
+        if(self.args.reliable):
+            from ProbeReliable import ProbeReliable
+            probe.setReliable(ProbeReliable())
+        return probe
+
+
+    def __open_probe__(self, probe, portname):
+        """
+        Open the connection to the probe on portname, directly or through
+        its daemon.
+        """
+        if(self.args.daemon):
+            path = self.args.socket
+            if(path == None or len(self.ports) > 1):
+                from ProbeIfDaemon import defaultSocket
+                path = defaultSocket(portname)
+            probe.open(path)
+        elif(portname.startswith("tcp://")):
+            probe.open(portname)
+        else:
+            tuned = None
+            if(self.args.baud == None):
+                from ProbeLink import tunedLink, sameBoard
+                tuned = tunedLink(portname)
+                if(tuned != None and not sameBoard(portname, tuned)):
+                    print("[WARNING] Ignoring the link settings for '%s': "
+                        "they were measured with board %s, run link --tune "
+                        "again" % (portname, tuned["board"]))
+                    tuned = None
+            if(tuned == None):
+                # Never wait forever for a probe which does not answer.
+                from ProbeLink import defaultTimeout
+                probe.open(portname, baud=self.baudrate,
+                    timeout=defaultTimeout(self.baudrate, probe.depth))
+            else:
+                from ProbeLink import apply
+                probe.open(portname, baud=tuned["baud"],
+                    timeout=tuned["timeout"])
+                apply(probe, tuned)
 
 
     def __init__(self):
         """
         Instance the new program.
         """
-        # Create the instance of the probe interface
-        self.probe = ProbeIfSerial()
         # Parse the command line arguments
         self.__parse_args__()
+        # Create the instance of the probe interface
+        self.probe  = None
+        self.traces = []
+        if(len(self.ports) == 1):
+            self.probe = self.__new_probe__(self.portname)
 
 
     def cmdFile(self):
         """
         Read and write files into and out of probe memory.
         """
-        assert(not (self.args.read and self.args.write))
+        if(self.args.read and self.args.write):
+            print("[ERROR] Specify only one of --read or --write")
+            return 1
+        if(not (self.args.read or self.args.write or self.args.verify)):
+            print("[ERROR] Specify one of --read, --write or --verify")
+            return 1
 
+        address = None
         if(self.args.address != None):
             print("Setting AXI address: %s" % self.args.address)
-            self.probe.set_address(self.args.address)
+            address = int(self.args.address, base=16)
 
-        openmode = None
-        if(args.read):
-            openmode = "rb"
-        else:
-            opemode  = "wb"
+        if(self.args.read):
+            length = self.args.length
+            if(length == None):
+                length = 8
+            with open(self.args.file, "w+b") as fh:
+                self.probe.readBlockToFile(fh, address, length)
+            print("Read %d words into '%s'" % (length, self.args.file))
+            return 0
+
+        if(self.args.verify and address == None):
+            address = self.probe.getAXIAddress()
+
+        if(self.args.write):
+            with open(self.args.file, "rb") as fh:
+                length = self.probe.writeBlockFromFile(fh, address,
+                    self.args.length)
+            print("Wrote %d words from '%s'" % (length, self.args.file))
+
+        if(self.args.verify):
+            with open(self.args.file, "rb") as fh:
+                return self.__verify_file__(address, fh, self.args.length)
+        return 0
+
+
+    def __verify_file__(self, address, fh, nwords):
+        """
+        Verify memory starting at address against the open file fh, as the
+        verify options say.
+        """
+        from ProbeVerify import ProbeVerify, WordView
+        verifier = ProbeVerify(self.probe)
+        if(self.args.every == None and self.args.sample == None):
+            checked, ranges = verifier.verify(address, fh, nwords,
+                stop=not self.args.keep_going)
+            return self.__verify_report__(checked, ranges)
+
+        import mmap
+        size = (os.fstat(fh.fileno()).st_size + 3) // 4
+        if(nwords != None):
+            size = min(size, nwords)
+        if(size == 0):
+            return self.__verify_report__(0, [])
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        checked, bad = verifier.sample(WordView(address, data, size),
+            self.args.every, self.args.sample)
+        return self.__verify_report__(checked, [(a, 1) for a in bad])
+
+
+    def __verify_report__(self, checked, ranges):
+        """
+        Print the outcome of verifying memory, returning 0 if it matched.
+        """
+        if(len(ranges) == 0):
+            print("Verified %d words" % checked)
+            return 0
+        from ProbeVerify import printRanges
+        print("[FAIL] %d words differ out of %d checked" %
+            (sum(n for a, n in ranges), checked))
+        printRanges(ranges)
+        return 1
+
+
+    def cmdLoad(self):
+        """
+        Load an image into memory, writing only what has changed.
+        """
+        import ProbeImage
+        try:
+            image = ProbeImage.readImage(self.args.image, self.args.format,
+                int(self.args.base, base=16))
+        except (OSError, ValueError) as e:
+            print("[ERROR] Could not read '%s': %s" % (self.args.image, e))
+            return 1
+
+        model = self.args.model
+        if(model == None):
+            model = ProbeImage.defaultModel(self.portname)
+
+        loader = ProbeImage.ProbeImageLoader(self.probe)
+        try:
+            loader.loadModel(model)
+        except (OSError, ValueError) as e:
+            print("[WARNING] Ignoring model '%s': %s" % (model, e))
+
+        total, written, runs = loader.load(image, self.args.check,
+            self.args.full)
+        loader.saveModel(model)
+        print("Wrote %d of %d words from '%s' in %d runs" % (written, total,
+            self.args.image, runs))
+
+        if(not (self.args.verify or self.args.every or self.args.sample)):
+            return 0
+        import struct
+        from ProbeVerify import ProbeVerify
+        verifier = ProbeVerify(self.probe)
+        if(self.args.every != None or self.args.sample != None):
+            checked, bad = verifier.sample(image.words, self.args.every,
+                self.args.sample)
+            return self.__verify_report__(checked, [(a, 1) for a in bad])
+        checked, ranges = 0, []
+        for start, values in image.runs():
+            n, r = verifier.verify(start, struct.pack("<%dI" % len(values),
+                *values), stop=not self.args.keep_going)
+            checked += n
+            ranges  += r
+            if(len(ranges) > 0 and not self.args.keep_going):
+                break
+        return self.__verify_report__(checked, ranges)
+
+
+    def cmdWave(self):
+        """
+        Play a wave of GPO events and report the timing jitter.
+        """
+        import ProbeWave
+        try:
+            with open(self.args.wave, "r") as fh:
+                events = ProbeWave.readWave(fh)
+        except (OSError, ValueError) as e:
+            print("[ERROR] Could not read '%s': %s" % (self.args.wave, e))
+            return 1
 
-        with open(args.file,openmode) as fh:
+        player = ProbeWave.ProbeWave(self.probe)
+        if(self.args.steps):
+            steps, final = player.compile(events, self.probe.readGPO32())
+            ProbeWave.printSteps(steps)
+        stats  = ProbeWave.jitter(player.play(events, self.args.lead))
+        print("Played %d events in %d steps. Lateness: mean %.3f ms, "
+            "p99 %.3f ms, max %.3f ms" % (len(events), stats["steps"],
+            1e3 * stats["mean"], 1e3 * stats["p99"], 1e3 * stats["max"]))
+        return 0
 
-            for i in range(0,self.args.length):
 
-                if(args.read):
-                    self.probe.doRead(autoInc=True)
-                    data = getAXIReadData()
-                else:
-                    self.probe.setAXIWriteData("00000000")
-                    self.probe.doWrite(auto_inc=True)
+    def cmdLink(self):
+        """
+        Show, measure or forget the link settings remembered for the port.
+        """
+        import ProbeLink
+        if(self.args.forget):
+            ProbeLink.saveLink(self.portname, None)
+            print("Forgot the link settings for '%s'" % self.portname)
+            return 0
 
+        if(not self.args.tune):
+            tuned = ProbeLink.tunedLink(self.portname)
+            if(tuned == None):
+                print("No link settings saved for '%s'" % self.portname)
+                return 0
+            ProbeLink.printLink(self.portname, tuned)
+            return 0
+
+        if(self.args.daemon or not hasattr(self.probe, "port")):
+            print("[ERROR] Only serial ports opened directly can be tuned")
+            return 1
+
+        bauds = None
+        if(self.args.bauds != None):
+            bauds = [int(b) for b in self.args.bauds.split(",")]
+
+        def report(baud, result):
+            if(result == None):
+                print("%7d  no answer" % baud)
+            else:
+                print("%7d  rtt %.3f ms  %.0f bytes/s  run ahead %d bytes" % (
+                    baud, 1e3 * result["rtt"], result["throughput"],
+                    result["window"]))
+            sys.stdout.flush()
+
+        tuned = ProbeLink.ProbeLink(self.probe).characterise(bauds, report)
+        if(tuned == None):
+            print("[ERROR] The probe did not answer at any baud rate")
+            return 1
+        tuned["board"] = ProbeLink.boardId(self.portname)
+        ProbeLink.saveLink(self.portname, tuned)
+        ProbeLink.printLink(self.portname, tuned)
+        return 0
 
 
     def cmdAXI(self):
@@ -156,22 +600,11 @@ class ProbeProgram(object):
         # Setup auto incrementing.
         if(self.args.auto_inc != None):
 
-            csr = BitArray(bytes=self.probe.do_AXIRDRC(), length=8)
-            ae  = csr[-2]
-            print(csr)
-
-            if(ae and self.args.auto_inc == 0):
-                # We need to clear the autoinc bit
+            if(self.args.auto_inc == 0):
                 print("Clear address auto-increment")
-                csr[-2] = 0
-                self.probe.do_AXIWRRC(csr.bytes)
-
-            elif(not ae and self.args.auto_inc == 1):
-                # We need to set the autoinc bit
+            else:
                 print("Set address auto-increment")
-                csr[-2] = 1
-                self.probe.do_AXIWRRC(csr.bytes)
-            print(csr)
+            self.probe.setAutoIncrement(self.args.auto_inc)
 
         
         # Get the axi master address value
@@ -186,40 +619,39 @@ class ProbeProgram(object):
 
         # Display the current status of the AXI master bus.
         if(self.args.get_status):
-            rs = BitArray(bytes=self.probe.do_AXIRDRC())
-            ws = BitArray(bytes=self.probe.do_AXIRDRC())
+            rs = self.probe.do_AXIRDRC()[0]
+            ws = self.probe.do_AXIRDWC()[0]
 
             print("Read Status:")
-            print(" - Response Valid: %s" % rs[ 4 ])
-            print(" - Response Value: %d" % rs[0:1].uint)
+            print(" - Response Valid: %s" % bool(rs & pc.AXI_CTRL_RV))
+            print(" - Response Value: %d" % ((rs & pc.AXI_CTRL_RESP) >> 6))
 
             print("Write Status:")
-            print(" - Response Valid: %s" % ws[ 4 ])
-            print(" - Response Value: %d" % ws[0:1].uint)
+            print(" - Response Valid: %s" % bool(ws & pc.AXI_CTRL_WV))
+            print(" - Response Value: %d" % ((ws & pc.AXI_CTRL_RESP) >> 6))
 
-            print ("Address auto incremnet: %s" % rs[-2])
+            print ("Address auto incremnet: %s" % bool(rs & pc.AXI_CTRL_AE))
 
         if(self.args.read):
             # Read the current address value?
-            csr = BitArray(bytes=self.probe.do_AXIRDRC(), length=8)
-            csr[1] = 1
-            self.probe.do_AXIWRRC(csr.bytes)
-            data = self.probe.getAXIReadData()
-            print("Read data: %h" % data)
+            data, resp = self.probe.doRead(wait=True)
+            print("Read data: %s" % hex(data))
+            print("Read response: %d" % resp)
 
         if(self.args.write != None):
             # Perform a write to the current address.
-            bits = BitArray(hex = self.args.write)
-            print("Setting write data: %h" % self.args.write)
-            self.probe.setAXIWriteData(bits)
+            print("Setting write data: %s" % self.args.write)
+            self.probe.setAXIWriteData(int(self.args.write, base=16))
             print("Performing write.")
-            self.probe.do_AXIWRWC(bytes(1))
+            resp = self.probe.doWrite(wait=True)
+            print("Write response: %d" % resp)
 
 
     def cmdDemo(self):
         """
         Runs a very simple demo program.
         """
+        import random
         auto_inc     = False
         base_address = int("40000008",base=16)
         print("Setting Base Address: %s" % hex(base_address))
@@ -233,13 +665,10 @@ class ProbeProgram(object):
         
         # Read the switches
 
-        self.probe.doRead()
-
-        csr = self.probe.do_AXIRDRC()
-        print("Read Response: %s" % csr)
+        rdata, resp = self.probe.doRead(wait=True)
+        print("Read Response: %d" % resp)
 
         sys.stdout.write("Read Data: ")
-        rdata = self.probe.getAXIReadData()
         print("dec: %d, hex: %s, bin: %s" % (rdata,hex(rdata),bin(rdata)))
 
         sys.stdout.write("New AXI Address value: ")
@@ -254,13 +683,11 @@ class ProbeProgram(object):
         # Set the write data
         print("Setting Write data: %s" % hex(rdata))
         self.probe.setAXIWriteData(rdata)
-        self.probe.doWrite()
-        csr = self.probe.do_AXIRDWC()
-        print("Write Response: %s" % csr)
+        resp = self.probe.doWrite(wait=True)
+        print("Write Response: %d" % resp)
 
         print("Testing memory: Writing")
         written = []
-        read    = []
         testlen = 127
         self.probe.setAXIAddress(int("C0000000",base=16))
         for i in range(0, testlen):
@@ -270,28 +697,47 @@ class ProbeProgram(object):
             self.probe.doWrite(autoInc=True)
             written.append(wd)
         
-        print("\nTesting memory: Reading")
-        self.probe.setAXIAddress(int("C0000000",base=16))
-        for i in range(0, testlen):
-            self.probe.doRead(autoInc=True)
-            rd = self.probe.getAXIReadData()
-            sys.stdout.write("%d " % rd)
-            read.append(rd)
-
-        if(read == written):
-            print("\n[PASS]")
+        print("\nTesting memory: Verifying")
+        import struct
+        from ProbeVerify import ProbeVerify, printRanges
+        checked, ranges = ProbeVerify(self.probe).verify(
+            int("C0000000",base=16), struct.pack("<%dI" % testlen, *written),
+            stop=False)
+
+        if(len(ranges) == 0):
+            print("[PASS]")
         else:
-            print("\n[FAIL]")
+            print("[FAIL]")
+            printRanges(ranges)
 
         print("\nDONE")
 
         return 0
 
 
+    def cmdRun(self):
+        """
+        Run a script of probe operations.
+        """
+        from ProbeScript import ProbeScript, parseScript
+        try:
+            if(self.args.script == "-"):
+                ops = parseScript(sys.stdin)
+            else:
+                with open(self.args.script, "r") as fh:
+                    ops = parseScript(fh)
+        except (OSError, ValueError) as e:
+            print("[ERROR] %s" % e)
+            return 1
+
+        return ProbeScript(self.probe, maxFrame=self.args.max_frame).run(ops)
+
+
     def cmdTestOpen(self):
         """
         Checks if the port is open. Returns 1 if not, 0 if it is open.
         """
+        import random
         if(self.probe.connected()):
             print("Probe successfully connected on port '%s'" % self.portname)
         else:
@@ -307,9 +753,12 @@ class ProbeProgram(object):
         # Read the general purpose outputs
         print("General Purpose Outputs:")
         for i in range(0,4):
-            tw = BitArray(hex=hex(random.randint(0,255)))[-8:].bytes
+            tw = pc.BYTE[random.randint(0,255)]
             print("Write %s to GPO bank %d" %(tw,i))
             self.probe.setGPOByte(i,tw)
+            # Forget the shadow registers so the value really is read back
+            # from the probe, not from what was just written.
+            self.probe.invalidateShadow()
             v = self.probe.getGPOByte(i)
             print("Read back %s from GPO bank %d" % (v,i))
             if(v != tw):
@@ -326,6 +775,7 @@ class ProbeProgram(object):
         print(" ")
 
         # Get the AXI address back anc check it matches.
+        self.probe.invalidateShadow()
         rb = self.probe.getAXIAddress()
         print("Read back value: %s" % hex(rb))
         print("> %s" % hex(rb))
@@ -352,52 +802,135 @@ class ProbeProgram(object):
         line arguments to the program.
         """
 
+        if(self.args.capture != None):
+            return self.cmdGPICapture()
+
+        if(self.args.wait != None):
+            return self.cmdGPIWait()
+
         if(self.args.all):
             # print all of the general purpose inputs
-            gpi  = (self.probe.do_RDGPI0(),
-                    self.probe.do_RDGPI1(),
-                    self.probe.do_RDGPI2(),
-                    self.probe.do_RDGPI3())
+            gpi  = self.probe.readGPI32()
             sys.stdout.write("GPI: ")
-            for b in gpi:
-                sys.stdout.write("%s " %b.hex())
+            for b in gpi.to_bytes(4, byteorder="little"):
+                sys.stdout.write("%02x " % b)
             print("")
             return 0
 
         else:
             # print a single general purpose input value.
-            bit =  self.probe.getGPIBit(args.readbit)
-            print("GPI[%d] = %s" % (self.args.input, bit))
+            bit =  self.probe.getGPIBit(self.args.readbit)
+            print("GPI[%d] = %s" % (self.args.readbit, bit))
             return 0
 
 
+    def cmdGPICapture(self):
+        """
+        Capture the general purpose inputs to a file.
+        """
+        from ProbeCapture import ProbeCapture, ProbeCaptureFile, \
+                                 ProbeCaptureVCD
+        fmt = self.args.format
+        if(fmt == None):
+            fmt = "vcd" if self.args.capture.endswith(".vcd") else "bin"
+
+        mask    = int(self.args.mask, base=16)
+        depth   = 64 if self.args.depth == None else self.args.depth
+        try:
+            capture = ProbeCapture(self.probe, mask, depth)
+        except ValueError as e:
+            print("[ERROR] %s" % e)
+            return 1
+        if(fmt == "vcd"):
+            writer = ProbeCaptureVCD(open(self.args.capture, "w"), mask)
+        else:
+            writer = ProbeCaptureFile(open(self.args.capture, "wb"), mask)
+
+        print("Capturing GPI banks %s into '%s'" % (
+            ",".join(str(b) for b in capture.banks), self.args.capture))
+        try:
+            taken, written, seconds = capture.capture(writer,
+                self.args.samples, self.args.duration, self.args.changes)
+        finally:
+            writer.close()
+
+        rate = taken / seconds if seconds > 0 else 0.0
+        print("Took %d samples in %.3fs (%.1f samples/s), stored %d" %
+            (taken, seconds, rate, written))
+        return 0
+
+
+    def cmdGPIWait(self):
+        """
+        Wait for a level or an edge on the general purpose inputs.
+        """
+        if((self.args.value == None) == (self.args.edge == None)):
+            print("[ERROR] Specify one of --value or --edge with --wait")
+            return 1
+
+        mask  = int(self.args.wait, base=16) & 0xFFFFFFFF
+        if(mask == 0):
+            print("[ERROR] --wait needs a non-zero mask of GPIs to watch")
+            return 1
+        depth = pc.GPI_WAIT_DEPTH if self.args.depth == None \
+                else self.args.depth
+        start = time.monotonic_ns()
+        try:
+            if(self.args.value != None):
+                stamp, gpi = self.probe.waitGPI(mask,
+                    int(self.args.value, base=16), self.args.timeout, depth)
+            else:
+                wait = {"rise"   : self.probe.waitGPIRise,
+                        "fall"   : self.probe.waitGPIFall,
+                        "change" : self.probe.waitGPIChange}[self.args.edge]
+                stamp, gpi = wait(mask, self.args.timeout, depth)
+        except (TimeoutError, ValueError) as e:
+            print("[ERROR] %s" % e)
+            return 1
+
+        print("GPI: %08x after %.3f ms" % (gpi, (stamp - start) / 1e6))
+        return 0
+
+
     def cmdGPO(self):
         """
         Interract with the general purpose outputs.
         """
         if(self.args.readall):
             # print all of the general purpose outputs
-            gpo  = (self.probe.do_RDGPO3(),
-                    self.probe.do_RDGPO2(),
-                    self.probe.do_RDGPO1(),
-                    self.probe.do_RDGPO0())
+            gpo  = self.probe.readGPO32()
             sys.stdout.write("GPO: ")
-            for b in gpo:
-                sys.stdout.write("%s " %b.hex())
+            for b in gpo.to_bytes(4, byteorder="big"):
+                sys.stdout.write("%02x " % b)
             print("")
             return 0
 
         if(self.args.clearall):
-            # Clear all bytes to zero.
             print("Clearing all GPOs")
-            for i in range(0,4):
-                self.port.setGPOByte(i,bytes(0))
+            self.probe.clearGPOBits(0xFFFFFFFF)
+            return 0
         
         if(self.args.setall):
-            # Set all bytes to one.
             print("Setting all GPOs")
-            for i in range(0,4):
-                self.port.setGPOByte(i,bytes(255))
+            self.probe.setGPOBits(0xFFFFFFFF)
+            return 0
+
+        if(self.args.set != None):
+            self.probe.setGPOBits(int(self.args.set, base=16))
+            return 0
+
+        if(self.args.clear != None):
+            self.probe.clearGPOBits(int(self.args.clear, base=16))
+            return 0
+
+        if(self.args.toggle != None):
+            self.probe.toggleGPOBits(int(self.args.toggle, base=16))
+            return 0
+
+        if(self.args.write != None):
+            self.probe.writeGPO32(int(self.args.write, base=16),
+                int(self.args.mask, base=16))
+            return 0
 
         if(self.args.readbit != None):
             print("Reading GPO[%d]" % self.args.readbit)
@@ -406,45 +939,82 @@ class ProbeProgram(object):
             return 0
 
         if(self.args.setbit != None):
-            bank = int(self.args.setbit / 8)
-            bit  = int(self.args.setbit % 8)
-            byte = BitArray(bytes=self.probe.getGPOByte(bank),length=8)
-            bitv = byte[7-bit]
-            
-            if(bitv == 0):
-                byte[7-bit] = 1
-                self.probe.setGPOByte(bank, byte.bytes)
-
+            self.probe.setGPOBit(self.args.setbit, 1)
             return 0
 
         if(self.args.clearbit != None):
-            bank = int(self.args.clearbit / 8)
-            bit  = int(self.args.clearbit % 8)
-            byte = BitArray(bytes=self.probe.getGPOByte(bank),length=8)
-            bitv = byte[7-bit]
-            
-            if(bitv == 1):
-                byte[7-bit] = 0
-                self.probe.setGPOByte(bank, byte.bytes)
-
+            self.probe.setGPOBit(self.args.clearbit, 0)
             return 0
 
 
+    def mainMany(self):
+        """
+        Run the command on every probe in self.ports at once, and print
+        what each one printed, board by board.
+        """
+        def opener(portname):
+            probe = self.__new_probe__(portname)
+            self.__open_probe__(probe, portname)
+            return probe
+
+        import copy
+        from   ProbeSession import ProbeSession
+
+        def command(probe, portname):
+            program          = copy.copy(self)
+            program.probe    = probe
+            program.portname = portname
+            return self.args.func.__func__(program)
+
+        with ProbeSession(opener) as session:
+            results = session.open(self.ports)
+            results.update(session.runEach(dict(
+                (port, lambda probe, port=port: command(probe, port))
+                for port in session.ports()), capture=True))
+
+        tr = 0
+        for port in self.ports:
+            res = results[port]
+            print("=== %s (%.3fs)" % (port, res.seconds))
+            if(res.output):
+                sys.stdout.write(res.output)
+            if(res.error != None):
+                print("[ERROR] %s" % res.error)
+                tr = max(tr, 1)
+            elif(res.value):
+                tr = max(tr, res.value)
+
+        failed = [p for p in self.ports
+                  if results[p].error != None or results[p].value]
+        print("%d of %d probes succeeded" % (len(self.ports) - len(failed),
+            len(self.ports)))
+        return tr
+
+
     def main(self):
         """
         Main entry point function for the program.
         """
         try:
-            self.probe.open(self.portname, baud=self.baudrate,
-                timeout=None)
-        except Exception as e:
-            print("[ERROR] Could not open port '%s'",self.portname)
-            print(e)
-            return 1
+            if(len(self.ports) > 1):
+                return self.mainMany()
+
+            try:
+                self.__open_probe__(self.probe, self.portname)
+            except Exception as e:
+                print("[ERROR] Could not open port '%s'" % self.portname)
+                print(e)
+                return 1
 
-        tr = self.args.func()
-        
-        return tr
+            try:
+                tr = self.args.func()
+            finally:
+                self.probe.close()
+
+            return tr
+        finally:
+            for trace in self.traces:
+                trace.close()
 
 
 if(__name__ == "__main__"):
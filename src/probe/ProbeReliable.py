@@ -0,0 +1,434 @@
+#!/usr/bin/python3
+
+"""
+Detect when the link to a probe has dropped or gained bytes, get back in
+step with it, and replay the commands which were affected.
+"""
+
+import sys
+
+import ProbeCommon as pc
+
+#
+# Frame appended to each segment of commands sent. It reads back the four
+# GPO bytes and the AXI address, which only change when the host writes
+# them or starts a transaction, so the values it should return are always
+# known. Segments which write to the AXI bus also read back the words they
+# wrote (see ProbeReliable.__canary__).
+#
+CANARY    = b"".join(c.code for c in pc.RDGPO + pc.RDAXA)
+
+#
+# Byte sent to bring the command decoder back to idle. It is a read, so
+# the decoder answers it if it was already idle. If the decoder was waiting
+# for the operand of a write, the byte is taken as that operand instead.
+# The go bit is clear in it, so it never starts an AXI transaction, but
+# the ae bit is set, so if it lands in a control register it turns address
+# auto increment on. Like the register written by any other operand, the
+# control register is put back afterwards.
+#
+REALIGN   = pc.PROBE_CMD_RDGPO0
+
+#
+# Length in bytes (the command and its operands) and response size of each
+# command, indexed by the low six bits of its opcode, which are all the
+# probe decodes. Opcodes which are not commands are one byte long and are
+# ignored by the probe.
+#
+LENGTH    = [1] * 64
+RESPONSE  = [0] * 64
+for c in pc.PROBE_COMMANDS:
+    LENGTH[c.opcode]   = 1 + c.operands
+    RESPONSE[c.opcode] = c.response
+
+OP_WRGPO  = pc.WRGPO[0].opcode
+OP_WRAXA  = pc.WRAXA[0].opcode
+OP_AXIWB  = pc.AXIWB[0].opcode
+OP_GO     = (pc.PROBE_CMD_AXIWRRC[0], pc.PROBE_CMD_AXIWRWC[0])
+OP_WRWC   = pc.PROBE_CMD_AXIWRWC[0]
+
+#
+# Commands which read back one word from the AXI bus at the current
+# address, for checking a word written: start the read, then fetch the read
+# status and data. The read is assumed done a byte time after it starts.
+#
+FRAME_CHECK_WORD = pc.PROBE_CMD_AXIWRRC + pc.csrByte(1, 1) + \
+                   pc.PROBE_CMD_AXIRDRC + b"".join(c.code for c in pc.AXIRB)
+
+class ProbeReliable(object):
+    """
+    A layer between a ProbeInterface and its link which checks that the
+    responses stay in step with the commands. Install one with
+    ProbeInterface.setReliable.
+
+    Each frame is split, at command boundaries, into segments of at least
+    segment bytes, and every segment has a canary appended. The segments
+    still go out together, pipelined as one frame. The layer follows the
+    host-owned registers (GPO bytes, AXI address, write data and address
+    auto increment) through the commands it passes on, so it knows what
+    the canary should read back at the end of each segment. A byte lost or
+    added in either direction leaves the responses short or shifted, or
+    the command decoder waiting for an operand, or a transaction or address
+    write missed, and so the canary wrong. Like the bulk transfer frames,
+    this relies on AXI transactions finishing within a byte time of being
+    started, so that the address has moved on by the time the canary reads
+    it.
+
+    The write data register cannot be read back, and a lost byte can leave
+    it holding a stale byte with everything else in step. So if verify is
+    set, the canary of a segment which writes to the AXI bus also reads
+    back each word written, from the address it was written to, and
+    checks it holds the data the layer followed. This costs a read for
+    every word written, and loses the read data and status left by any
+    read started before the segment. Turn it off for peripherals whose
+    registers do not read back what was written to them, or which have
+    side effects on reads.
+
+    When the canary is wrong the link is flushed, the probe's command
+    decoder is brought back to idle, the registers are put back as they
+    were at the start of the first segment which failed, and it and the
+    segments after it are sent again, split into segments half the size
+    each time a replay fails. Segments which came back intact before it
+    are not repeated. AXI transactions started by the segments sent again
+    may happen twice, which is harmless for memory but not for peripherals
+    with side effects, and a replayed read of a control register may find
+    its valid bit already cleared, making a wait for it time out.
+
+    Errors which leave the registers followed and the responses in step
+    are not caught: a GPI value or read data byte mangled on the line, for
+    example. Nor can writes which a lost byte sends to the wrong address
+    be undone here, though they are kept to the segment the byte was lost
+    from, so smaller segments limit the damage. They may land on words an
+    earlier segment wrote and checked, so ProbeInterface.writeBlock reads
+    its whole block back afterwards when verify is set, but writes which
+    land outside it go unseen. The interface must time out reads which get
+    no answer, or a lost response byte blocks forever.
+    """
+
+    def __init__(self, segment=1024, retries=3, verify=True):
+        """
+        Create the layer. Frames are checked about every segment bytes. If
+        retries replays in a row fail to get any further through a frame
+        once its segments are as small as they go, the exchange gives up
+        with an IOError. verify turns on reading back words written to the
+        AXI bus.
+        """
+        self.segment = segment
+        self.retries = retries
+        self.verify  = verify
+        self.resyncs = 0
+        self.forget()
+
+    def forget(self):
+        """
+        Forget the register values being followed, so that they are read
+        from the probe again before the next exchange. Called whenever the
+        shadow registers of the interface are invalidated.
+        """
+        self.gpo   = None
+        self.addr  = None
+        self.wdata = [None, None, None, None]
+        self.ae    = None
+
+    def exchange(self, frame, nrsp, raw, discard):
+        """
+        Send frame and return the nrsp bytes it should produce, using
+        raw(frame, nrsp) to exchange bytes with the probe and discard() to
+        throw away anything left in flight.
+        """
+        if(self.gpo == None):
+            self.__learn__(raw, discard)
+        size     = self.segment
+        segments = self.__split__(frame, self.__state__(), size)
+        if(sum(s[1] for s in segments) != nrsp):
+            raise ValueError("Frame produces %d response bytes, not %d" % (
+                sum(s[1] for s in segments), nrsp))
+
+        out   = bytearray()
+        tries = 0
+        while(len(segments) > 0):
+            good = self.__attempt__(raw, segments, out)
+            if(good > 0):
+                tries = 0
+                self.gpo, self.addr, self.wdata, self.ae = segments[good-1][3]
+                segments = segments[good:]
+                continue
+            # Try again with the segment which failed split in half, so
+            # that a replay is less likely to be hit by the same trouble.
+            # Only once it cannot be split any further do the replays count
+            # towards giving up.
+            failed   = len(segments[0][0])
+            size     = max(1, size // 2)
+            segments = self.__split__(b"".join(s[0] for s in segments),
+                segments[0][2], size)
+            if(len(segments[0][0]) >= failed):
+                if(tries >= self.retries):
+                    self.forget()
+                    raise IOError("Lost sync with the probe, and %d replays "
+                        "of %d bytes of commands did not recover it" % (
+                        tries, failed))
+                tries += 1
+            self.__recover__(raw, discard, segments[0][2])
+        return bytes(out)
+
+    def __state__(self):
+        """
+        Return the register values followed: GPO bytes, address, write data
+        bytes and auto increment.
+        """
+        return (list(self.gpo), self.addr, list(self.wdata), self.ae)
+
+    def __split__(self, frame, state, segment):
+        """
+        Split frame, starting with the registers in state (see __state__),
+        into segments of at least segment bytes. Returns a list of the
+        commands of each, the number of response bytes they produce, the
+        register values before and after them, and the address and write
+        data bytes of each AXI write they start.
+
+        Segments are only cut just before a command which starts an AXI
+        transaction, so that none of them reads back read data or status
+        left by a transaction started in an earlier one, which a replay
+        could not put back.
+        """
+        frame    = bytes(frame)
+        gpo, addr, wdata, ae = state
+        gpo      = list(gpo)
+        wdata    = list(wdata)
+        before   = (list(gpo), addr, list(wdata), ae)
+        segments = []
+        writes   = []
+        start    = 0
+        nrsp     = 0
+        i        = 0
+        while(i < len(frame)):
+            op    = frame[i] & 0x3F
+            size  = LENGTH[op]
+            if(i + size > len(frame)):
+                raise ValueError("Frame ends part way through a command")
+            go    = (size == 2 and op in OP_GO and frame[i+1] & pc.AXI_CTRL_GO)
+            if(go and i - start >= segment):
+                after = (list(gpo), addr, list(wdata), ae)
+                segments.append((frame[start:i], nrsp, before, after, writes))
+                start, nrsp, before, writes = i, 0, after, []
+            nrsp += RESPONSE[op]
+            if(size == 2):
+                arg = frame[i+1]
+                if(OP_WRGPO <= op < OP_WRGPO + 4):
+                    gpo[op - OP_WRGPO] = arg
+                elif(OP_WRAXA <= op < OP_WRAXA + 4):
+                    shift = 8 * (op - OP_WRAXA)
+                    addr  = (addr & ~(0xFF << shift)) | (arg << shift)
+                elif(OP_AXIWB <= op < OP_AXIWB + 4):
+                    wdata[op - OP_AXIWB] = arg
+                elif(op in OP_GO):
+                    ae    = 1 if arg & pc.AXI_CTRL_AE else 0
+                if(go and op == OP_WRWC):
+                    writes.append((addr, list(wdata)))
+                if(go and ae):
+                    addr  = (addr + 4) & 0xFFFFFFFF
+            i += size
+        if(start < len(frame)):
+            after = (list(gpo), addr, list(wdata), ae)
+            segments.append((frame[start:], nrsp, before, after, writes))
+        return segments
+
+    def __attempt__(self, raw, segments, out):
+        """
+        Send segments, each followed by the canary, in one go. The
+        responses of the segments which came back in step, up to the first
+        which did not, are added to out. Returns how many there were.
+        """
+        frame   = bytearray()
+        want    = 0
+        canary  = []
+        for seg, n, before, after, writes in segments:
+            check, ncheck = self.__canary__(after, writes)
+            frame  += self.__anchor__(before) + seg + check
+            want   += n + ncheck
+            canary.append(ncheck)
+        try:
+            data = raw(bytes(frame), want)
+        except IOError:
+            return 0
+        pos = 0
+        for good, (seg, n, before, after, writes) in enumerate(segments):
+            end = pos + n + canary[good]
+            if(len(data) < end or not self.__expect__(data[pos+n:end],
+               after, writes)):
+                return good
+            out += data[pos:pos+n]
+            pos  = end
+        return len(segments)
+
+    def __anchor__(self, state):
+        """
+        Return the commands sent ahead of each segment, which set the
+        address and auto increment to state again. A lost byte can turn a
+        write data byte into an address write, and the writes after it go
+        astray. This keeps them from carrying on into the segments after,
+        which are sent in the same frame.
+        """
+        frame = bytearray()
+        for i, b in enumerate(pc.splitWord(state[1])):
+            frame += pc.WRAXA[i].code + b
+        return frame + pc.PROBE_CMD_AXIWRRC + pc.csrByte(state[3], 0)
+
+    def __canary__(self, state, writes):
+        """
+        Return the canary to send after a segment which leaves the registers
+        in state and performs writes, and the number of bytes it reads
+        back. Words written are read back by setting the address to each in
+        turn, then the address and auto increment are put back to state.
+        """
+        frame = bytearray(CANARY)
+        if(not self.verify or len(writes) == 0):
+            return frame, len(CANARY)
+        # Clear the read status, so that the first check sees its own read.
+        frame += pc.PROBE_CMD_AXIRDRC
+        addr   = state[1]
+        for waddr, wdata in writes:
+            frame += self.__seek__(addr, waddr) + FRAME_CHECK_WORD
+            addr   = (waddr + 4) & 0xFFFFFFFF
+        frame += self.__seek__(addr, state[1])
+        frame += pc.PROBE_CMD_AXIWRRC + pc.csrByte(state[3], 0)
+        return frame, len(CANARY) + 1 + 5 * len(writes)
+
+    def __seek__(self, addr, to):
+        """
+        Return the commands which change the address from addr to to.
+        """
+        frame = bytearray()
+        for i, (old, new) in enumerate(zip(pc.splitWord(addr),
+                                           pc.splitWord(to))):
+            if(old != new):
+                frame += pc.WRAXA[i].code + new
+        return frame
+
+    def __expect__(self, data, state, writes):
+        """
+        Check data read back by the canary of a segment which leaves the
+        registers in state and performs writes. Words written to an address
+        which gives an error response when read back are not checked.
+        """
+        if(data[0:len(CANARY)] != bytes(state[0]) + pc.WORD.pack(state[1])):
+            return False
+        if(len(data) == len(CANARY)):
+            return True
+        for i, (waddr, wdata) in enumerate(writes):
+            rsp = data[len(CANARY)+1+5*i:len(CANARY)+6+5*i]
+            if(not rsp[0] & pc.AXI_CTRL_RV):
+                return False
+            if(rsp[0] >> 6 >= pc.AXI_RESP_SLVERR):
+                continue
+            for b, want in zip(rsp[1:5], wdata):
+                if(want != None and b != want):
+                    return False
+        return True
+
+    def __realign__(self, raw, discard):
+        """
+        Flush the link and bring the command decoder back to idle. Returns
+        what the canary reads back once it is.
+        """
+        for attempt in range(0, self.retries + 1):
+            try:
+                discard()
+                raw(REALIGN, 0)
+                discard()
+                data = raw(CANARY, len(CANARY))
+            except IOError:
+                continue
+            if(len(data) == len(CANARY)):
+                return data
+        raise IOError("Lost sync with the probe, and could not get back in "
+            "step with it")
+
+    def __learn__(self, raw, discard):
+        """
+        Read the GPO bytes, address and auto increment from the probe,
+        taking them only once two reads agree. Reading the auto increment
+        bit clears the read status, like any read of the control register.
+        """
+        frame = CANARY + pc.PROBE_CMD_AXIRDRC
+        last  = None
+        for attempt in range(0, self.retries + 2):
+            try:
+                data = raw(frame, len(frame))
+            except IOError:
+                data = None
+            if(data == None or len(data) != len(frame)):
+                last = None
+                self.__realign__(raw, discard)
+                continue
+            data = data[:-1] + pc.BYTE[data[-1] & pc.AXI_CTRL_AE]
+            if(data == last):
+                self.gpo   = list(data[0:4])
+                self.addr  = pc.joinWord(data[4:8])
+                self.wdata = [None, None, None, None]
+                self.ae    = 1 if data[8] else 0
+                return
+            last = data
+        raise IOError("Could not read the probe registers reliably")
+
+    def __recover__(self, raw, discard, state):
+        """
+        Get back in step with the probe and put the registers back to
+        state, ready for a segment to be replayed. The registers are read
+        back afterwards, as a byte lost on the way would otherwise send the
+        replay astray. Write data bytes which were never written through
+        this layer are not known, so cannot be put back, and the write data
+        register cannot be read back.
+        """
+        self.resyncs += 1
+        gpo, addr, wdata, ae = state
+        check  = CANARY + pc.PROBE_CMD_AXIRDRC
+        expect = bytes(gpo) + pc.WORD.pack(addr) + pc.BYTE[ae << 1]
+        for attempt in range(0, self.retries + 1):
+            found = self.__realign__(raw, discard)
+            fix   = bytearray()
+            for i in range(0, 4):
+                if(wdata[i] != None):
+                    fix += pc.AXIWB[i].code + pc.BYTE[wdata[i]]
+            for i in range(0, 4):
+                if(found[i] != gpo[i]):
+                    fix += pc.WRGPO[i].code + pc.BYTE[gpo[i]]
+            for i, b in enumerate(pc.splitWord(addr)):
+                fix += pc.WRAXA[i].code + b
+            fix += pc.PROBE_CMD_AXIWRRC + pc.csrByte(ae, 0)
+            try:
+                data = raw(bytes(fix) + check, len(check))
+            except IOError:
+                continue
+            if(len(data) == len(check) and data[:-1] +
+               pc.BYTE[data[-1] & pc.AXI_CTRL_AE] == expect):
+                return
+        raise IOError("Lost sync with the probe, and could not put its "
+            "registers back")
+
+
+def main():
+    """
+    Print how a frame of commands, given in hex, would be split up and
+    which registers it leaves the probe with, starting from reset.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("frame", type=str, help="Command bytes, in hex.")
+    parser.add_argument("--segment", type=int, default=16,
+        help="Segment size in bytes.")
+    args = parser.parse_args()
+
+    layer       = ProbeReliable(segment=args.segment)
+    layer.gpo   = list(pc.GPO_ON_RESET.to_bytes(4, byteorder="little"))
+    layer.addr  = pc.AXI_ADDR_ON_RESET
+    layer.ae    = 1
+    for seg, nrsp, before, after, writes in layer.__split__(
+            bytes.fromhex(args.frame), layer.__state__(), args.segment):
+        print("%-40s %2d responses  gpo %s addr 0x%08x  %d writes" % (
+            seg.hex(), nrsp, bytes(after[0]).hex(), after[1], len(writes)))
+    return 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())
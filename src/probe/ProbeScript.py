@@ -0,0 +1,327 @@
+#!/usr/bin/python3
+
+"""
+Run scripts of probe operations over one open connection, printing the
+result of each operation as a line of JSON.
+"""
+
+import sys
+import json
+import time
+import collections
+
+import ProbeCommon as pc
+import ProbeInterface as pi
+
+#
+# Script syntax
+#
+#   One operation per line. Everything after a '#' is a comment. Numbers
+#   may be given in decimal or with a 0x prefix in hex.
+#
+#       gpo set BIT             Set one general purpose output.
+#       gpo clear BIT           Clear one general purpose output.
+#       gpo write VALUE         Write all 32 general purpose outputs.
+#       gpo read                Read all 32 general purpose outputs.
+#       gpi read                Read all 32 general purpose inputs.
+#       axi write ADDR VALUE..  Write consecutive words starting at ADDR.
+#       axi read ADDR [xN]      Read N (default 1) words starting at ADDR.
+#       wait-gpi BIT VALUE [T]  Wait up to T (default 1) seconds for a
+#                               general purpose input to equal VALUE.
+#       sleep SECONDS           Pause.
+#
+
+ScriptOp = collections.namedtuple("ScriptOp", ["line", "name", "args"])
+
+SCRIPT_OPS = {
+    # name        : (min args, max args)
+    "gpo set"     : (1, 1),
+    "gpo clear"   : (1, 1),
+    "gpo write"   : (1, 1),
+    "gpo read"    : (0, 0),
+    "gpi read"    : (0, 0),
+    "axi write"   : (2, None),
+    "axi read"    : (1, 2),
+    "wait-gpi"    : (2, 3),
+    "sleep"       : (1, 1),
+}
+
+def parseNumber(text):
+    """
+    Parse a decimal or 0x prefixed hex number.
+    """
+    return int(text, 0)
+
+
+def parseScript(lines):
+    """
+    Parse the lines of a script into a list of ScriptOps. Raises ValueError
+    naming the line of the first mistake found.
+    """
+    ops = []
+    for lineno, text in enumerate(lines, start=1):
+        words = text.split("#", 1)[0].split()
+        if(len(words) == 0):
+            continue
+
+        name = words[0]
+        args = words[1:]
+        if(name not in SCRIPT_OPS and len(words) > 1):
+            name = " ".join(words[0:2])
+            args = words[2:]
+        if(name not in SCRIPT_OPS):
+            raise ValueError("line %d: unknown operation '%s'" %
+                (lineno, text.strip()))
+
+        lo, hi = SCRIPT_OPS[name]
+        if(len(args) < lo or (hi != None and len(args) > hi)):
+            raise ValueError("line %d: wrong number of arguments to '%s'" %
+                (lineno, name))
+
+        try:
+            if(name == "axi read" and len(args) == 2):
+                if(not args[1].startswith("x")):
+                    raise ValueError(args[1])
+                args = [parseNumber(args[0]), parseNumber(args[1][1:])]
+            elif(name == "sleep"):
+                args = [float(args[0])]
+            elif(name == "wait-gpi"):
+                args = [parseNumber(a) for a in args[0:2]] + \
+                       [float(a) for a in args[2:]]
+            else:
+                args = [parseNumber(a) for a in args]
+        except ValueError:
+            raise ValueError("line %d: bad argument to '%s'" % (lineno, name))
+
+        if(name in ("gpo set", "gpo clear", "wait-gpi") and
+           not 0 <= args[0] < 32):
+            raise ValueError("line %d: no such bit %d" % (lineno, args[0]))
+        ops.append(ScriptOp(lineno, name, args))
+    return ops
+
+
+class ProbeScript(object):
+    """
+    Runs parsed scripts against a probe. Operations are not sent one at a
+    time: runs of adjacent operations are encoded into a single frame, and
+    only sent when an operation needs to see a response before it can go
+    on (such as wait-gpi), when the frame reaches maxFrame bytes, or at
+    the end of the script. Results are printed once their frame is done.
+    """
+
+    def __init__(self, probe, out=None, maxFrame=4096):
+        """
+        Run scripts on probe, which should already be open, printing the
+        results to out (stdout by default).
+        """
+        self.probe    = probe
+        self.out      = out if out != None else sys.stdout
+        self.maxFrame = maxFrame
+        self.frame    = bytearray()
+        self.nrsp     = 0
+        self.finish   = []
+        self.gpo      = [None, None, None, None]
+        self.rdIdle   = True
+        self.wrIdle   = True
+        self.repairs  = []
+
+    def run(self, ops):
+        """
+        Run a list of ScriptOps. Returns 0 if they all succeeded. The first
+        failure is reported as an error line and stops the script.
+        """
+        if(self.probe.shadowEnabled):
+            self.gpo = list(self.probe.shadowGPO)
+        op = None
+        try:
+            for op in ops:
+                getattr(self, "op_" + op.name.replace(" ", "_").replace(
+                    "-", "_"))(op, *op.args)
+                if(len(self.frame) >= self.maxFrame):
+                    self.flush()
+            self.flush()
+        except Exception as e:
+            self.frame  = bytearray()
+            self.nrsp   = 0
+            self.finish = []
+            self.emit(op, error=str(e))
+            return 1
+        finally:
+            # The script has moved the address and data registers behind
+            # the back of the shadow cache.
+            self.probe.invalidateShadow()
+        return 0
+
+    def emit(self, op, **fields):
+        """
+        Print the result of an operation.
+        """
+        result = collections.OrderedDict()
+        if(op != None):
+            result["line"] = op.line
+            result["op"]   = op.name
+        result.update(fields)
+        self.out.write(json.dumps(result) + "\n")
+
+    def queue(self, op, cmds, done=None):
+        """
+        Add commands to the pending frame. Once it has been sent, done is
+        called with the response bytes for these commands, and should return
+        a dictionary of results to print for op.
+        """
+        frame, nrsp = self.probe.encode(cmds)
+        self.queueFrame(op, frame, nrsp, done)
+
+    def queueFrame(self, op, frame, nrsp, done=None):
+        """
+        Add an already encoded frame to the pending frame.
+        """
+        self.finish.append((op, self.nrsp, nrsp, done))
+        self.frame += frame
+        self.nrsp  += nrsp
+
+    def flush(self):
+        """
+        Send the pending frame, and print the results of the operations in
+        it.
+        """
+        if(len(self.finish) == 0):
+            return
+        frame, nrsp, finish = bytes(self.frame), self.nrsp, self.finish
+        self.frame  = bytearray()
+        self.nrsp   = 0
+        self.finish = []
+
+        rsp = self.probe.transactFrame(frame, nrsp)
+        # AXI transactions which did not finish in time are made again once
+        # the whole frame has been looked at, as any of them may have left
+        # the bus busy for the operations after.
+        self.rdIdle  = True
+        self.wrIdle  = True
+        self.repairs = []
+        results      = []
+        for op, start, count, done in finish:
+            fields = {}
+            if(done != None):
+                fields = done(rsp[start:start+count])
+            results.append((op, fields))
+        if(len(self.repairs) > 0):
+            self.probe.settleAXI(self.rdIdle, self.wrIdle)
+            for repair in self.repairs:
+                repair()
+        for op, fields in results:
+            self.emit(op, **fields)
+
+    # -----------------------------------------------------------------------
+    # Operations
+    # -----------------------------------------------------------------------
+
+    def op_gpo_set(self, op, bit, value=1):
+        bank = bit // 8
+        if(self.gpo[bank] == None):
+            # Needs the current value of the bank before it can go on.
+            self.flush()
+            self.gpo[bank] = self.probe.transact(pc.RDGPO[bank])[0]
+        mask = 1 << (bit % 8)
+        new  = (self.gpo[bank] | mask) if value else (self.gpo[bank] & ~mask)
+        self.queue(op, [(pc.WRGPO[bank], pc.BYTE[new])])
+        self.gpo[bank] = new
+
+    def op_gpo_clear(self, op, bit):
+        self.op_gpo_set(op, bit, 0)
+
+    def op_gpo_write(self, op, value):
+        data     = pc.splitWord(value)
+        self.gpo = [d[0] for d in data]
+        self.queue(op, list(zip(pc.WRGPO, data)))
+
+    def op_gpo_read(self, op):
+        def done(rsp):
+            self.gpo = list(rsp)
+            return {"value" : pc.joinWord(rsp)}
+        self.queue(op, pc.RDGPO, done)
+
+    def op_gpi_read(self, op):
+        def done(rsp):
+            return {"value" : pc.joinWord(rsp)}
+        self.queue(op, pc.RDGPI, done)
+
+    def op_axi_write(self, op, addr, *values):
+        frame, _ = self.probe.encode(list(zip(pc.WRAXA, pc.splitWord(addr))))
+        data     = b"".join(pc.WORD.pack(v & 0xFFFFFFFF) for v in values)
+        words    = pi.fillWriteFrame(bytearray(pi.writeFrame(len(values))),
+            data)
+        def done(rsp):
+            good, idle  = self.probe.unpackWrites(rsp, self.wrIdle)
+            if(not self.rdIdle):
+                # A read still going moves the address on when it ends.
+                good = [False] * len(good)
+            self.wrIdle = idle
+            if(not all(good)):
+                self.repairs.append(lambda: self.probe.redoWrites(
+                    range(addr, addr + 4 * len(values), 4), data, good))
+            return {"addr" : addr, "words" : len(values)}
+        self.queueFrame(op, frame + words, 1 + len(values), done)
+
+    def op_axi_read(self, op, addr, count=1):
+        frame, _ = self.probe.encode(list(zip(pc.WRAXA, pc.splitWord(addr))))
+        def done(rsp):
+            data, good, idle = self.probe.unpackReads(rsp, self.rdIdle)
+            if(not self.wrIdle):
+                good = [False] * len(good)
+            self.rdIdle = idle
+            fields      = {"addr" : addr}
+            def finish():
+                fields["data"] = [pc.joinWord(data[i:i+4])
+                    for i in range(0, len(data), 4)]
+            if(not all(good)):
+                def repair():
+                    self.probe.redoReads(range(addr, addr + 4 * count, 4),
+                        data, good)
+                    finish()
+                self.repairs.append(repair)
+            finish()
+            return fields
+        self.queueFrame(op, frame + pi.readFrame(count),
+            1 + pi.READ_WORD_RSP * count, done)
+
+    def op_wait_gpi(self, op, bit, value, timeout=1.0):
+        self.flush()
+        value = 1 if value else 0
+        start = time.monotonic_ns()
+        try:
+            stamp, gpi = self.probe.waitGPI(1 << bit, value << bit, timeout)
+        except TimeoutError:
+            raise TimeoutError("GPI[%d] did not become %d within %gs" %
+                (bit, value, timeout))
+        self.emit(op, elapsed=(stamp - start) / 1e9)
+
+    def op_sleep(self, op, seconds):
+        self.flush()
+        time.sleep(seconds)
+        self.emit(op)
+
+
+def main():
+    """
+    Check the syntax of script files without running them.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("script", type=str, nargs="+",
+        help="Script files to check.")
+    args = parser.parse_args()
+
+    failed = 0
+    for path in args.script:
+        try:
+            with open(path, "r") as fh:
+                parseScript(fh)
+        except ValueError as e:
+            print("%s: %s" % (path, e))
+            failed = 1
+    return failed
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+
+"""
+Manage sessions with many probes at once, one per board, and run
+operations on all of them in parallel.
+"""
+
+import io
+import sys
+import time
+import threading
+import collections
+import concurrent.futures
+
+#
+# The outcome of running an operation on one probe. value is whatever the
+# operation returned, error the exception it raised (or None), and output
+# anything it printed, if output was being captured.
+#
+ProbeResult = collections.namedtuple("ProbeResult",
+    ["port", "value", "error", "output", "seconds"])
+
+class ThreadOutput(object):
+    """
+    Stands in for sys.stdout, sending writes from each thread to that
+    thread's own buffer if it has one, and to the real stdout otherwise.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local  = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def buffer(self):
+        """
+        Return the calling thread's buffer, or None.
+        """
+        return getattr(self.local, "buf", None)
+
+    def write(self, text):
+        buf = self.buffer()
+        if(buf != None):
+            return buf.write(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        if(self.buffer() == None):
+            self.stream.flush()
+
+
+class ProbeSession(object):
+    """
+    Holds a set of open probes, keyed by port name, and a pool with one
+    worker thread per probe. Serial I/O releases the GIL, so the probes
+    really are driven in parallel. Each probe has its own lock, so
+    operations on one probe never overlap even if the session is used
+    from several threads.
+    """
+
+    def __init__(self, opener=None):
+        """
+        Create the session. opener(portname) should return an open probe
+        interface for the named port. By default ProbeIfSerial is used,
+        with the baud rate and timeout given to open().
+        """
+        self.opener = opener
+        self.probes = collections.OrderedDict()
+        self.locks  = {}
+        self.pool   = None
+        self.npool  = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def open(self, ports, baud=9600, timeout=1):
+        """
+        Open a probe on each of the named ports, in parallel. Returns a
+        dictionary of ProbeResults for the ports which could not be opened;
+        those ports are left out of the session.
+        """
+        ports  = [p for p in ports if p not in self.probes]
+        opener = self.opener
+        if(opener == None):
+            def opener(port):
+                from ProbeIfSerial import ProbeIfSerial
+                probe = ProbeIfSerial()
+                probe.open(port, baud=baud, timeout=timeout)
+                return probe
+
+        self.__grow__(len(self.probes) + len(ports))
+        results = self.__gather__(
+            [(port, None, opener, (port,)) for port in ports], False)
+
+        failed = collections.OrderedDict()
+        for port, res in results.items():
+            if(res.error == None):
+                self.probes[port] = res.value
+                self.locks[port]  = threading.Lock()
+            else:
+                failed[port] = res
+        return failed
+
+    def ports(self):
+        """
+        Return the names of the ports with open probes.
+        """
+        return list(self.probes.keys())
+
+    def close(self):
+        """
+        Close every probe and stop the worker threads.
+        """
+        for probe in self.probes.values():
+            probe.close()
+        self.probes.clear()
+        self.locks.clear()
+        if(self.pool != None):
+            self.pool.shutdown()
+            self.pool  = None
+            self.npool = 0
+
+    def run(self, op, *args, ports=None, capture=False):
+        """
+        Call op(probe, *args) for every probe in the session (or just those
+        on the listed ports), in parallel. Returns an ordered dictionary of
+        ProbeResults keyed by port name. Exceptions raised by op are caught
+        and returned in the results. If capture is set, anything op prints
+        is collected in the results rather than written to stdout.
+        """
+        if(ports == None):
+            ports = self.ports()
+        return self.runEach(collections.OrderedDict(
+            (port, op) for port in ports), *args, capture=capture)
+
+    def runEach(self, ops, *args, capture=False):
+        """
+        Like run, but ops maps port names to the operation to run on that
+        port, so each board can be given something different to do.
+        """
+        jobs = []
+        for port, op in ops.items():
+            if(port not in self.probes):
+                raise KeyError("No probe open on port '%s'" % port)
+            jobs.append((port, self.locks[port], op,
+                (self.probes[port],) + args))
+        return self.__gather__(jobs, capture)
+
+    def __grow__(self, nworkers):
+        """
+        Make sure the pool has at least nworkers threads.
+        """
+        nworkers = max(1, nworkers)
+        if(self.pool != None and self.npool >= nworkers):
+            return
+        if(self.pool != None):
+            self.pool.shutdown()
+        self.npool = nworkers
+        self.pool  = concurrent.futures.ThreadPoolExecutor(
+            max_workers=nworkers, thread_name_prefix="probe")
+
+    def __gather__(self, jobs, capture):
+        """
+        Run each (port, lock, func, args) job on the pool and wait for them
+        all to finish.
+        """
+        self.__grow__(len(jobs))
+        installed = False
+        if(capture and not isinstance(sys.stdout, ThreadOutput)):
+            sys.stdout = ThreadOutput(sys.stdout)
+            installed  = True
+        try:
+            futures = [(port, self.pool.submit(self.__job__, port, lock,
+                func, args, capture)) for port, lock, func, args in jobs]
+            return collections.OrderedDict(
+                (port, fut.result()) for port, fut in futures)
+        finally:
+            if(installed):
+                sys.stdout = sys.stdout.stream
+
+    def __job__(self, port, lock, func, args, capture):
+        """
+        Run one job in a worker thread and package up its result.
+        """
+        value, error, output = None, None, None
+        if(capture):
+            sys.stdout.local.buf = io.StringIO()
+        start = time.monotonic()
+        try:
+            if(lock != None):
+                with lock:
+                    value = func(*args)
+            else:
+                value = func(*args)
+        except Exception as e:
+            error = e
+        seconds = time.monotonic() - start
+        if(capture):
+            output = sys.stdout.local.buf.getvalue()
+            sys.stdout.local.buf = None
+        return ProbeResult(port, value, error, output, seconds)
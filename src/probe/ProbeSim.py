@@ -0,0 +1,489 @@
+#!/usr/bin/python3
+
+"""
+Pure-python simulation of the uartprobe module, for testing and
+benchmarking the probe software without any hardware.
+"""
+
+import os
+import sys
+import time
+import random
+import collections
+
+import ProbeCommon as pc
+
+class ProbeModel(object):
+    """
+    Byte for byte model of the command decoder and registers of
+    src/hdl/uartprobe.v, with a sparse, word addressed memory sat on the
+    AXI master.
+
+    AXI transactions take latency seconds to complete. Until then the read
+    data register holds its old value and further "go" requests of the same
+    kind are ignored. As in the hardware, the rv/wv bits are set when a
+    transaction completes and cleared only when their register is read.
+    The response code for each transaction is taken from the errors list
+    of (low, high, resp) address ranges, and is OKAY for any address not
+    covered by it.
+    """
+
+    def __init__(self, gpo=pc.GPO_ON_RESET, addr=pc.AXI_ADDR_ON_RESET,
+                 latency=0.0):
+        """
+        Create the model. gpo and addr are the reset values of the GPO and
+        AXI address registers.
+        """
+        self.gpoOnReset  = gpo
+        self.addrOnReset = addr
+        self.latency     = latency
+        self.memory      = {}
+        self.errors      = []
+        self.gpi         = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Put the registers into their reset state. Memory is left as is.
+        """
+        self.fsm    = None
+        self.gpo    = self.gpoOnReset
+        self.addr   = self.addrOnReset
+        self.wdata  = 0
+        self.rdata  = 0
+        self.ae     = 1
+        self.rv     = 1
+        self.wv     = 1
+        self.rr     = 0
+        self.wr     = 0
+        self.rdDue  = None
+        self.wrDue  = None
+
+    def sampleGPI(self, t):
+        """
+        Return the value of the 32 GPIs at time t. Override this to model
+        inputs which change over time.
+        """
+        return self.gpi
+
+    def response(self, addr, write):
+        """
+        Return the AXI response code for a transaction at addr.
+        """
+        for low, high, resp in self.errors:
+            if(low <= addr <= high):
+                return resp
+        return pc.AXI_RESP_OKAY
+
+    def advance(self, t):
+        """
+        Complete any AXI transactions which have finished by time t.
+        """
+        due = []
+        if(self.rdDue != None and self.rdDue[0] <= t):
+            due.append(self.rdDue + (False,))
+            self.rdDue = None
+        if(self.wrDue != None and self.wrDue[0] <= t):
+            due.append(self.wrDue + (True,))
+            self.wrDue = None
+
+        for when, addr, data, write in sorted(due, key=lambda d: d[0]):
+            resp = self.response(addr, write)
+            okay = resp in (pc.AXI_RESP_OKAY, pc.AXI_RESP_EXOKAY)
+            if(write):
+                if(okay):
+                    self.memory[addr & ~3] = data
+                self.wr = resp
+                self.wv = 1
+            else:
+                self.rdata = self.memory.get(addr & ~3, 0) if okay else 0
+                self.rr = resp
+                self.rv = 1
+            if(self.ae):
+                self.addr = (self.addr + 4) & 0xFFFFFFFF
+
+    def rx(self, byte, t=0.0):
+        """
+        Handle one byte sent to the probe at time t, and return the bytes
+        (if any) it sends back.
+        """
+        self.advance(t)
+
+        if(self.fsm == None):
+            # Only the low six bits of a command are decoded.
+            cmd = byte & 0x3F
+            if(0x02 <= cmd <= 0x05):
+                return [(self.sampleGPI(t) >> (8 * (cmd - 0x02))) & 0xFF]
+            elif(0x06 <= cmd <= 0x09):
+                return [(self.gpo   >> (8 * (cmd - 0x06))) & 0xFF]
+            elif(0x0E <= cmd <= 0x11):
+                return [(self.addr  >> (8 * (cmd - 0x0E))) & 0xFF]
+            elif(0x16 <= cmd <= 0x19):
+                return [(self.rdata >> (8 * (cmd - 0x16))) & 0xFF]
+            elif(cmd == pc.PROBE_CMD_AXIRDRC[0]):
+                csr = (self.rr << 6) | (self.rv << 3) | (self.ae << 1)
+                self.rv = 0
+                return [csr]
+            elif(cmd == pc.PROBE_CMD_AXIRDWC[0]):
+                csr = (self.wr << 6) | (self.wv << 3) | (self.ae << 1)
+                self.wv = 0
+                return [csr]
+            elif(0x0A <= cmd <= 0x0D or 0x12 <= cmd <= 0x15 or
+                 0x1A <= cmd <= 0x1D or cmd == pc.PROBE_CMD_AXIWRRC[0] or
+                 cmd == pc.PROBE_CMD_AXIWRWC[0]):
+                # Wait for the operand.
+                self.fsm = cmd
+            return []
+
+        cmd      = self.fsm
+        self.fsm = None
+
+        if(0x0A <= cmd <= 0x0D):
+            self.gpo   = self.__setByte__(self.gpo,   cmd - 0x0A, byte)
+        elif(0x12 <= cmd <= 0x15):
+            self.addr  = self.__setByte__(self.addr,  cmd - 0x12, byte)
+        elif(0x1A <= cmd <= 0x1D):
+            self.wdata = self.__setByte__(self.wdata, cmd - 0x1A, byte)
+        else:
+            self.ae = (byte & pc.AXI_CTRL_AE) >> 1
+            if(byte & pc.AXI_CTRL_GO):
+                when = t + self.latency
+                if(cmd == pc.PROBE_CMD_AXIWRRC[0] and self.rdDue == None):
+                    self.rdDue = (when, self.addr, None)
+                elif(cmd == pc.PROBE_CMD_AXIWRWC[0] and self.wrDue == None):
+                    self.wrDue = (when, self.addr, self.wdata)
+                self.advance(t)
+        return []
+
+    def __setByte__(self, reg, idx, byte):
+        """
+        Return reg with byte idx replaced by byte.
+        """
+        shift = 8 * idx
+        return (reg & ~(0xFF << shift)) | (byte << shift)
+
+
+class ProbeSimLink(object):
+    """
+    Models the UART between the host and a ProbeModel. With a baud rate
+    set, each byte takes ten bit times (8N1) to cross the line in either
+    direction, and bytes queue up behind one another. With baud set to
+    None the line is infinitely fast. With loss set, each byte has that
+    chance of going missing on the way in either direction, for testing
+    recovery from a noisy line.
+    """
+
+    def __init__(self, model, baud=None, loss=0.0, seed=None):
+        """
+        Create the link. seed seeds the choice of which bytes are lost.
+        """
+        self.model  = model
+        self.baud   = baud
+        self.loss   = loss
+        self.rng    = random.Random(seed)
+        self.txFree = 0.0
+        self.rxFree = 0.0
+        self.rxq    = collections.deque()
+
+    def byteTime(self):
+        """
+        Seconds taken to send one byte over the line.
+        """
+        if(self.baud == None):
+            return 0.0
+        return 10.0 / self.baud
+
+    def send(self, data, now=None):
+        """
+        Send bytes from the host to the probe starting at time now. The
+        probe's responses are queued along with the time they finish
+        arriving back at the host.
+        """
+        if(now == None):
+            now = time.monotonic()
+        bt = self.byteTime()
+        t  = max(now, self.txFree)
+        for b in data:
+            t += bt
+            if(self.loss > 0 and self.rng.random() < self.loss):
+                continue
+            for r in self.model.rx(b, t):
+                rt = max(t, self.rxFree) + bt
+                self.rxFree = rt
+                if(self.loss > 0 and self.rng.random() < self.loss):
+                    continue
+                self.rxq.append((rt, r))
+        self.txFree = t
+
+    def nextDue(self):
+        """
+        Return the time at which the next response byte arrives, or None if
+        there is nothing on its way back.
+        """
+        if(len(self.rxq) == 0):
+            return None
+        return self.rxq[0][0]
+
+    def receive(self, now=None, limit=None):
+        """
+        Return the response bytes which have arrived by time now, up to
+        limit of them.
+        """
+        if(now == None):
+            now = time.monotonic()
+        out = bytearray()
+        while(len(self.rxq) > 0 and self.rxq[0][0] <= now):
+            if(limit != None and len(out) >= limit):
+                break
+            out.append(self.rxq.popleft()[1])
+        return bytes(out)
+
+
+class ProbeSimPort(object):
+    """
+    Stands in for a serial.Serial object, passing data to and from a
+    ProbeSimLink. Reads sleep until the requested bytes have arrived. Reads
+    which can never be satisfied return short rather than blocking forever.
+    """
+
+    def __init__(self, link, timeout=None):
+        """
+        Create the port.
+        """
+        self.link     = link
+        self.timeout  = timeout
+        self.is_open  = True
+
+    @property
+    def baudrate(self):
+        return self.link.baud
+
+    @baudrate.setter
+    def baudrate(self, baud):
+        self.link.baud = baud
+
+    @property
+    def in_waiting(self):
+        return len(self.link.rxq)
+
+    def write(self, data):
+        """
+        Send data to the simulated probe.
+        """
+        self.link.send(data)
+        return len(data)
+
+    def read(self, size=1):
+        """
+        Read up to size bytes from the simulated probe.
+        """
+        deadline = None
+        if(self.timeout != None):
+            deadline = time.monotonic() + self.timeout
+        out = bytearray()
+        while(len(out) < size):
+            due = self.link.nextDue()
+            if(due == None):
+                break
+            if(deadline != None and due > deadline):
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                break
+            wait = due - time.monotonic()
+            if(wait > 0):
+                time.sleep(wait)
+            out += self.link.receive(limit=size - len(out))
+        return bytes(out)
+
+    def reset_input_buffer(self):
+        """
+        Throw away any response bytes still on their way back.
+        """
+        self.link.rxq.clear()
+
+    def reset_output_buffer(self):
+        return None
+
+    def close(self):
+        self.is_open = False
+
+
+class ProbeSimServer(object):
+    """
+    Serves a ProbeModel on one side of a pty pair, so that programs which
+    open a serial port by name (such as ProbeProgram) can talk to it.
+    """
+
+    def __init__(self, model, baud=None, loss=0.0):
+        """
+        Create the pty pair. The name of the port to connect to is held in
+        the portname attribute. loss is passed on to the ProbeSimLink.
+        """
+        import pty
+        import tty
+        self.link             = ProbeSimLink(model, baud, loss)
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        tty.setraw(self.master)
+        self.portname         = os.ttyname(self.slave)
+        self.running          = False
+
+    def serve(self):
+        """
+        Pass bytes between the pty and the model until stop() is called.
+        """
+        import select
+        self.running = True
+        while(self.running):
+            timeout = 0.1
+            due     = self.link.nextDue()
+            if(due != None):
+                timeout = max(0.0, min(timeout, due - time.monotonic()))
+            ready, _, _ = select.select([self.master], [], [], timeout)
+            if(ready):
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    data = b""
+                self.link.send(data)
+            out = self.link.receive()
+            if(len(out) > 0):
+                os.write(self.master, out)
+
+    def start(self):
+        """
+        Serve the model from a background thread.
+        """
+        import threading
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop serving.
+        """
+        self.running = False
+
+
+class ProbeSimTCPServer(ProbeSimServer):
+    """
+    Serves a ProbeModel on a TCP port, as a terminal server or ser2net
+    would serve a real probe's UART. One client is served at a time, and
+    the model keeps its state from one connection to the next.
+    """
+
+    def __init__(self, model, baud=None, host="127.0.0.1", port=0,
+                 loss=0.0):
+        """
+        Listen on host and port (any free port if 0). The address to
+        connect to is held in the portname attribute, as tcp://host:port.
+        loss is passed on to the ProbeSimLink.
+        """
+        import socket
+        self.link     = ProbeSimLink(model, baud, loss)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1)
+        self.address  = self.listener.getsockname()
+        self.portname = "tcp://%s:%d" % self.address
+        self.client   = None
+        self.running  = False
+
+    def serve(self):
+        """
+        Pass bytes between the client and the model until stop() is
+        called.
+        """
+        import select
+        self.running = True
+        while(self.running):
+            timeout = 0.1
+            due     = self.link.nextDue()
+            if(due != None):
+                timeout = max(0.0, min(timeout, due - time.monotonic()))
+            client = self.client
+            watch  = [self.listener] if client == None else [client]
+            try:
+                ready, _, _ = select.select(watch, [], [], timeout)
+            except (OSError, ValueError):
+                # Dropped or stopped from another thread.
+                continue
+            if(self.listener in ready):
+                self.client, _ = self.listener.accept()
+                continue
+            out = self.link.receive()
+            try:
+                if(client in ready):
+                    data = client.recv(4096)
+                    if(len(data) == 0):
+                        raise OSError("Client went away")
+                    self.link.send(data)
+                if(len(out) > 0 and client != None):
+                    client.sendall(out)
+            except OSError:
+                self.drop()
+
+    def drop(self):
+        """
+        Close the connection to the current client, as if the network
+        between it and the probe had failed.
+        """
+        client, self.client = self.client, None
+        if(client != None):
+            client.close()
+
+    def stop(self):
+        """
+        Stop serving.
+        """
+        self.running = False
+        self.drop()
+        self.listener.close()
+
+
+def main():
+    """
+    Serve a simulated probe on a pty until interrupted.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--baud","-b", type=int, default=None,
+        help="Emulate the timing of a UART running at this baud rate.")
+    parser.add_argument("--latency", type=float, default=0.0,
+        help="Seconds taken by each AXI transaction.")
+    parser.add_argument("--gpi", type=str, default="0",
+        help="Value of the general purpose inputs, in hex.")
+    parser.add_argument("--tcp", type=int, default=None, metavar="PORT",
+        help="Serve the probe on this TCP port rather than on a pty.")
+    parser.add_argument("--loss", type=float, default=0.0,
+        help="Chance of each byte going missing on the line, to test "
+             "recovery with 'ProbeProgram.py --reliable'.")
+    parser.add_argument("--error", type=str, action="append", default=[],
+        help="LOW:HIGH:RESP - respond to AXI accesses in the hex address "
+             "range LOW to HIGH with response code RESP.")
+    args = parser.parse_args()
+
+    model         = ProbeModel(latency=args.latency)
+    model.gpi     = int(args.gpi, base=16)
+    for spec in args.error:
+        low, high, resp = spec.split(":")
+        model.errors.append((int(low, base=16), int(high, base=16),
+            int(resp)))
+
+    if(args.tcp != None):
+        server = ProbeSimTCPServer(model, args.baud, port=args.tcp,
+            loss=args.loss)
+    else:
+        server = ProbeSimServer(model, args.baud, args.loss)
+    print("Simulated probe on port '%s'" % server.portname)
+    sys.stdout.flush()
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())
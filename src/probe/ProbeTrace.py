@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+
+"""
+Record and decode traces of the bytes sent to and recieved from a probe.
+"""
+
+import sys
+import time
+import struct
+import collections
+
+import ProbeCommon as pc
+
+#
+# Trace log format
+#
+#   A header of TRACE_MAGIC followed by the wall clock time the trace
+#   started (float64). Then one record per chunk of bytes written to or read
+#   from the probe: the time since the start of the trace in nanoseconds
+#   (uint64), the direction (uint8), the number of bytes (uint16), and the
+#   bytes themselves. All values are little-endian.
+#
+
+TRACE_MAGIC  = b"PRBT\x01"
+TRACE_HEADER = struct.Struct("<d")
+TRACE_RECORD = struct.Struct("<QBH")
+TRACE_TX     = 0
+TRACE_RX     = 1
+
+class ProbeTracer(object):
+    """
+    Base class for tracers. A tracer is given every chunk of bytes sent to
+    (tx) or recieved from (rx) the probe. Install one with
+    ProbeInterface.setTracer.
+    """
+
+    def __init__(self):
+        """
+        Create the tracer.
+        """
+        self.start     = time.monotonic_ns()
+        self.startWall = time.time()
+
+    def tx(self, data):
+        """
+        Called with bytes just written to the probe.
+        """
+        self.record(TRACE_TX, data)
+
+    def rx(self, data):
+        """
+        Called with bytes just read from the probe.
+        """
+        self.record(TRACE_RX, data)
+
+    def record(self, direction, data):
+        """
+        Record one chunk of bytes.
+        """
+        return None
+
+    def encode(self, direction, data):
+        """
+        Return the log record for a chunk of bytes, splitting chunks which
+        are too long for one record.
+        """
+        stamp = time.monotonic_ns() - self.start
+        out   = bytearray()
+        for i in range(0, max(1, len(data)), 0xFFFF):
+            part = data[i:i+0xFFFF]
+            out += TRACE_RECORD.pack(stamp, direction, len(part))
+            out += part
+        return out
+
+    def header(self):
+        """
+        Return the header which starts a log.
+        """
+        return TRACE_MAGIC + TRACE_HEADER.pack(self.startWall)
+
+
+class ProbeTraceFile(ProbeTracer):
+    """
+    Writes a binary trace log to a file as it goes.
+    """
+
+    def __init__(self, fh):
+        """
+        Write the log to fh, a file opened in binary mode.
+        """
+        ProbeTracer.__init__(self)
+        self.fh = fh
+        self.fh.write(self.header())
+
+    def record(self, direction, data):
+        self.fh.write(self.encode(direction, data))
+
+    def close(self):
+        self.fh.close()
+
+
+class ProbeTraceRing(ProbeTracer):
+    """
+    Keeps the most recent records of a trace in memory, using at most
+    capacity bytes, so that a long session can be traced cheaply and the
+    tail end written out when something goes wrong.
+    """
+
+    def __init__(self, capacity=1 << 20):
+        """
+        Create the ring buffer.
+        """
+        ProbeTracer.__init__(self)
+        self.capacity = capacity
+        self.size     = 0
+        self.records  = collections.deque()
+
+    def record(self, direction, data):
+        rec = self.encode(direction, data)
+        self.records.append(rec)
+        self.size += len(rec)
+        while(self.size > self.capacity):
+            self.size -= len(self.records.popleft())
+
+    def dump(self, fh):
+        """
+        Write the buffered records to fh as a trace log.
+        """
+        fh.write(self.header())
+        for rec in self.records:
+            fh.write(rec)
+
+
+class ProbeTracePrint(ProbeTracer):
+    """
+    Prints every byte as it is sent or recieved, as --verbose always has.
+    """
+
+    def record(self, direction, data):
+        if(direction == TRACE_TX):
+            arrow, col = ">>", "GREEN"
+        else:
+            arrow, col = "<<", "RED"
+        pc.color_stdout(col)
+        for v in data:
+            print("%s %s\t - %s\t - %d"% (arrow,hex(v),bin(v),v))
+        pc.color_stdout("RESET")
+
+
+def readTrace(fh):
+    """
+    Read a trace log from fh. Returns the wall clock start time and a list
+    of (time in seconds, direction, bytes) records.
+    """
+    magic = fh.read(len(TRACE_MAGIC))
+    if(magic != TRACE_MAGIC):
+        raise ValueError("Not a probe trace log")
+    start   = TRACE_HEADER.unpack(fh.read(TRACE_HEADER.size))[0]
+    records = []
+    while(True):
+        head = fh.read(TRACE_RECORD.size)
+        if(len(head) < TRACE_RECORD.size):
+            break
+        stamp, direction, length = TRACE_RECORD.unpack(head)
+        records.append((stamp / 1e9, direction, fh.read(length)))
+    return start, records
+
+
+def annotate(records):
+    """
+    Turn trace records into lines of text naming each command, its operand
+    and the response it got, using the command table in ProbeCommon.
+    """
+    lines   = []
+    waiting = collections.deque()   # Commands still owed a response byte.
+    operand = None                  # Command whose operand comes next.
+
+    for stamp, direction, data in records:
+        for v in data:
+            if(direction == TRACE_TX):
+                if(operand != None):
+                    lines.append("%12.6f >> %-7s %-18s <- 0x%02x" %
+                        (stamp, operand.name, operand.register, v))
+                    operand = None
+                    continue
+                cmd = pc.COMMANDS_BY_OPCODE.get(v & 0x3F)
+                if(cmd == None):
+                    lines.append("%12.6f >> 0x%02x    (unknown command)" %
+                        (stamp, v))
+                elif(cmd.operands > 0):
+                    operand = cmd
+                else:
+                    waiting.append(cmd)
+            else:
+                if(len(waiting) > 0):
+                    cmd = waiting.popleft()
+                    lines.append("%12.6f << %-7s %-18s  = 0x%02x" %
+                        (stamp, cmd.name, cmd.register, v))
+                else:
+                    lines.append("%12.6f << 0x%02x    (unexpected)" %
+                        (stamp, v))
+
+    for cmd in waiting:
+        lines.append("%12s << %-7s %-18s  (no response)" %
+            ("", cmd.name, cmd.register))
+    return lines
+
+
+def main():
+    """
+    Print an annotated version of a trace log.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("trace", type=str, help="Trace log to decode.")
+    args = parser.parse_args()
+
+    with open(args.trace, "rb") as fh:
+        start, records = readTrace(fh)
+
+    print("Trace started %s" % time.strftime("%Y-%m-%d %H:%M:%S",
+        time.localtime(start)))
+    for line in annotate(records):
+        print(line)
+    return 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())
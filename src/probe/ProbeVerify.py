@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+
+"""
+Check the contents of probe memory against a file, an image or a checksum,
+without waiting on one round trip per word.
+"""
+
+import os
+import sys
+import zlib
+import random
+
+import ProbeCommon as pc
+
+class ProbeVerify(object):
+    """
+    Reads memory back in chunks of words, keeping several chunks in flight
+    on the link, and compares each against what it should hold as it
+    arrives. Nothing more than a chunk of the expected data and a chunk of
+    memory is held at once.
+    """
+
+    def __init__(self, probe, chunk=pc.BLOCK_WORDS, depth=None):
+        """
+        Verify memory through probe, which should already be open. Reads
+        are made chunk words at a time, with depth chunks in flight (by
+        default as many as the probe interface keeps).
+        """
+        self.probe = probe
+        self.chunk = chunk
+        self.depth = depth
+
+    def readChunks(self, addr, nwords):
+        """
+        Read nwords words starting at addr, yielding the data a chunk at a
+        time as little-endian bytes.
+        """
+        return self.probe.readBlockChunks(addr, nwords, self.chunk,
+            self.depth)
+
+    def verify(self, addr, expected, nwords=None, stop=True):
+        """
+        Compare memory starting at addr with expected, which is either a
+        bytes-like object or a binary file object, holding little-endian
+        words. A trailing partial word is padded with zeros, as writeBlock
+        pads it. At most nwords words are compared, or all of expected if
+        nwords is None. If stop is set, reading stops at the end of the
+        first chunk which differs. Returns the number of words compared
+        and a list of (address, word count) ranges which differ.
+        """
+        if(hasattr(expected, "read")):
+            source = expected
+            if(nwords == None):
+                here   = source.tell()
+                nwords = (source.seek(0, os.SEEK_END) - here + 3) // 4
+                source.seek(here)
+        else:
+            source = memoryview(expected).cast("B")
+            if(nwords == None or nwords > (len(source) + 3) // 4):
+                nwords = (len(source) + 3) // 4
+
+        ranges   = []
+        compared = 0
+        chunks   = self.readChunks(addr, nwords)
+        try:
+            for data in chunks:
+                count = len(data) // 4
+                if(hasattr(source, "read")):
+                    want = source.read(len(data))
+                else:
+                    want = source[4*compared:4*compared+len(data)]
+                if(len(want) < len(data)):
+                    want = bytes(want) + bytes(len(data) - len(want))
+                base      = addr + 4 * compared
+                compared += count
+                if(data == want):
+                    continue
+                self.__differ__(base, data, want, ranges)
+                if(stop):
+                    break
+        finally:
+            chunks.close()
+        return compared, ranges
+
+    def __differ__(self, base, data, want, ranges):
+        """
+        Add the ranges of words at which data and want differ to ranges,
+        extending the last range if it runs on from the one before.
+        """
+        for i in range(0, len(data) // 4):
+            if(data[4*i:4*i+4] == want[4*i:4*i+4]):
+                continue
+            a = base + 4 * i
+            if(len(ranges) > 0 and ranges[-1][0] + 4 * ranges[-1][1] == a):
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+            else:
+                ranges.append((a, 1))
+
+    def checksum(self, addr, nwords):
+        """
+        Return the CRC-32 of nwords words of memory starting at addr, for
+        comparing against a checksum of what it should hold (see
+        ProbeVerify.crc).
+        """
+        crc = 0
+        for data in self.readChunks(addr, nwords):
+            crc = zlib.crc32(data, crc)
+        return crc
+
+    @staticmethod
+    def crc(data):
+        """
+        Return the CRC-32 of a bytes-like object or the rest of a binary
+        file object, as checksum would compute it for memory holding it,
+        with a trailing partial word padded with zeros.
+        """
+        if(not hasattr(data, "read")):
+            return zlib.crc32(bytes(-len(data) % 4), zlib.crc32(data))
+        crc  = 0
+        size = 0
+        while(True):
+            part = data.read(1 << 16)
+            if(len(part) == 0):
+                return zlib.crc32(bytes(-size % 4), crc)
+            crc   = zlib.crc32(part, crc)
+            size += len(part)
+
+    def sample(self, expected, every=None, count=None, seed=None):
+        """
+        Spot check memory. expected maps word addresses to the values they
+        should hold. Either every Nth address (in order) or count addresses
+        picked at random are read back, pc.BLOCK_WORDS to an exchange (see
+        ProbeInterface.readWords). Returns the number of words compared and
+        the list of addresses which differ.
+        """
+        addrs = expected.keys()
+        if(type(addrs) != range):
+            addrs = sorted(addrs)
+        if(every != None):
+            addrs = addrs[::every]
+        if(count != None and count < len(addrs)):
+            addrs = sorted(random.Random(seed).sample(addrs, count))
+        found = self.probe.readWords(addrs)
+        return len(addrs), [a for a in addrs if found[a] != expected[a]]
+
+
+class WordView(object):
+    """
+    Presents nwords little-endian words of a bytes-like object (or mmap)
+    placed at addr as a read-only mapping from address to value, for use
+    with ProbeVerify.sample, without unpacking every word up front. A
+    trailing partial word is padded with zeros, as writeBlock pads it.
+    """
+
+    def __init__(self, addr, data, nwords=None):
+        self.addr   = addr
+        self.data   = data
+        self.nwords = (len(data) + 3) // 4 if nwords == None else nwords
+
+    def keys(self):
+        return range(self.addr, self.addr + 4 * self.nwords, 4)
+
+    def __getitem__(self, addr):
+        pos = addr - self.addr
+        if(pos + 4 <= len(self.data)):
+            return pc.WORD.unpack_from(self.data, pos)[0]
+        tail = bytes(self.data[pos:pos+4])
+        return pc.WORD.unpack(tail + bytes(4 - len(tail)))[0]
+
+
+def printRanges(ranges, limit=16):
+    """
+    Print a list of (address, word count) ranges which differ.
+    """
+    for addr, count in ranges[:limit]:
+        print("  0x%08x - 0x%08x  %d words" % (addr, addr + 4 * count - 1,
+            count))
+    if(len(ranges) > limit):
+        print("  ... and %d more ranges" % (len(ranges) - limit))
+
+
+def main():
+    """
+    Print the CRC-32 of a file, as ProbeVerify.checksum would compute it
+    for memory holding the file.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("file", type=str, help="File to checksum.")
+    args = parser.parse_args()
+
+    with open(args.file, "rb") as fh:
+        print("%08x" % ProbeVerify.crc(fh))
+    return 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+
+"""
+Play timed sequences of changes to the general purpose outputs, such as
+board reset and power rail sequences, and report how closely the timing
+was kept to.
+"""
+
+import sys
+import time
+import collections
+
+import ProbeCommon as pc
+
+#
+# Wave file format
+#
+#   One event per line: the time from the start of the wave, the value to
+#   drive the outputs with in hex, and optionally a hex mask of the outputs
+#   the event changes (all of them by default). Times are in seconds unless
+#   followed by ms or us. Events are played in time order, with events at
+#   the same time played in the order they are listed. Blank lines and
+#   anything after a # are ignored.
+#
+#       0       00000000
+#       10ms    00000001 00000001   # rail 0 on
+#       25ms    00000003 00000002   # rail 1 on
+#       100ms   80000000 80000000   # release reset
+#
+
+WAVE_UNITS = {"s" : 1.0, "ms" : 1e-3, "us" : 1e-6}
+
+#
+# Seconds before each step at which the player stops sleeping and spins on
+# the clock instead, to allow for the operating system waking it late.
+#
+WAVE_SPIN  = 0.002
+
+ProbeWaveStep = collections.namedtuple("ProbeWaveStep",
+    ["offset", "frame", "events"])
+
+def readWave(fh):
+    """
+    Read a wave from the text file object fh. Returns a list of
+    (offset in seconds, value, mask) events.
+    """
+    events = []
+    for lineno, line in enumerate(fh, start=1):
+        fields = line.split("#", 1)[0].split()
+        if(len(fields) == 0):
+            continue
+        if(len(fields) not in (2, 3)):
+            raise ValueError("line %d: expected TIME VALUE [MASK]" % lineno)
+        when  = fields[0].lower()
+        scale = 1.0
+        for unit in ("ms", "us", "s"):
+            if(when.endswith(unit)):
+                when, scale = when[:-len(unit)], WAVE_UNITS[unit]
+                break
+        try:
+            offset = float(when) * scale
+            value  = int(fields[1], base=16)
+            mask   = int(fields[2], base=16) if len(fields) == 3 \
+                     else 0xFFFFFFFF
+        except ValueError:
+            raise ValueError("line %d: bad time or value" % lineno)
+        if(offset < 0):
+            raise ValueError("line %d: negative time" % lineno)
+        events.append((offset, value & 0xFFFFFFFF, mask & 0xFFFFFFFF))
+    return events
+
+
+class ProbeWave(object):
+    """
+    Plays waves of GPO events through a probe. Each event is turned, before
+    playing starts, into the fewest bank writes which make it, and events
+    which fall closer together than the UART can send the bytes of the one
+    before go out together as one frame, as they could not be separated
+    anyway. Steps are timed against the monotonic clock: the player sleeps
+    until shortly before each is due, then spins.
+
+    The times kept to are those at which each frame is handed to the
+    interface. The outputs change once the frame has crossed the link, a
+    little later, but by the same amount for frames of the same length.
+    """
+
+    def __init__(self, probe, baud=None):
+        """
+        Play waves through probe, which should already be open (or None, to
+        only compile them). baud is the rate of the UART, used to decide
+        which events to send together. If None it is taken from the serial
+        port of the probe, if it has one, and otherwise only events at the
+        same time are sent together.
+        """
+        self.probe = probe
+        if(baud == None and hasattr(probe, "port")):
+            baud = probe.port.baudrate
+        self.byteTime = 10.0 / baud if baud else 0.0
+
+    def compile(self, events, gpo):
+        """
+        Turn a list of (offset, value, mask) events into a list of
+        ProbeWaveSteps, starting with the outputs holding gpo. Events which
+        change nothing add nothing to their step, and steps which send
+        nothing are dropped. Returns the steps and the value the outputs
+        are left holding.
+        """
+        cur   = list(gpo.to_bytes(4, byteorder="little"))
+        steps = []
+        for offset, value, mask in sorted(events, key=lambda e: e[0]):
+            frame = bytearray()
+            for b in pc.maskBanks(mask):
+                m   = (mask  >> (8 * b)) & 0xFF
+                new = (cur[b] & ~m) | ((value >> (8 * b)) & m)
+                if(new != cur[b]):
+                    frame  += pc.WRGPO[b].code + pc.BYTE[new]
+                    cur[b]  = new
+            if(len(steps) > 0 and offset <= steps[-1].offset +
+               len(steps[-1].frame) * self.byteTime):
+                last       = steps[-1]
+                steps[-1]  = ProbeWaveStep(last.offset, last.frame + frame,
+                                           last.events + 1)
+            elif(len(frame) > 0):
+                steps.append(ProbeWaveStep(offset, bytes(frame), 1))
+        return steps, pc.joinBanks(range(0, 4), cur)
+
+    def play(self, events, lead=0.01):
+        """
+        Play a list of (offset, value, mask) events, starting lead seconds
+        from now. The outputs are read first, unless the shadow registers
+        know them. Returns the lateness of each step in nanoseconds, which
+        jitter summarises.
+        """
+        steps, final = self.compile(events, self.probe.readGPO32())
+        late  = []
+        done  = False
+        start = time.monotonic_ns() + int(lead * 1e9)
+        try:
+            for step in steps:
+                target = start + int(step.offset * 1e9)
+                self.__waitUntil__(target)
+                late.append(time.monotonic_ns() - target)
+                self.probe.transactFrame(step.frame, 0)
+            done = True
+        finally:
+            if(done):
+                self.probe.shadowGPO = list(final.to_bytes(4,
+                    byteorder="little"))
+            else:
+                self.probe.invalidateShadow()
+        return late
+
+    def __waitUntil__(self, target):
+        """
+        Return once the monotonic clock reaches target nanoseconds.
+        """
+        spin = int(WAVE_SPIN * 1e9)
+        while(True):
+            left = target - time.monotonic_ns()
+            if(left <= 0):
+                return
+            if(left > spin):
+                time.sleep((left - spin) / 1e9)
+
+
+def jitter(late):
+    """
+    Summarise the lateness of the steps of a wave, as returned by
+    ProbeWave.play. Returns a dictionary of the number of steps and the
+    mean, 99th percentile and worst lateness, in seconds.
+    """
+    if(len(late) == 0):
+        return {"steps" : 0, "mean" : 0.0, "p99" : 0.0, "max" : 0.0}
+    ordered = sorted(late)
+    return {
+        "steps" : len(late),
+        "mean"  : sum(late) / len(late) / 1e9,
+        "p99"   : ordered[min(len(late) - 1, len(late) * 99 // 100)] / 1e9,
+        "max"   : ordered[-1] / 1e9,
+    }
+
+
+def printSteps(steps):
+    """
+    Print the frames a wave was compiled into.
+    """
+    for step in steps:
+        print("%10.6fs  %d event%s  %s" % (step.offset, step.events,
+            "" if step.events == 1 else "s", step.frame.hex()))
+
+
+def main():
+    """
+    Print the frames a wave file compiles to, starting from the outputs
+    the probe takes on reset.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("wave", type=str, help="Wave file to read.")
+    parser.add_argument("--baud", "-b", type=int, default=None,
+        help="Baud rate of the UART, for sending close events together.")
+    args = parser.parse_args()
+
+    with open(args.wave, "r") as fh:
+        events = readWave(fh)
+
+    steps, final = ProbeWave(None, args.baud).compile(events,
+        pc.GPO_ON_RESET)
+    printSteps(steps)
+    print("%d events in %d steps, leaving the outputs at %08x" % (
+        len(events), len(steps), final))
+    return 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())